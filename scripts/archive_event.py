@@ -38,8 +38,21 @@ def archive_event(event_id: str):
         print("❌ キャンセルしました")
         return
 
-    # Update status
-    event_ref.update({"status": "archived", "archived_at": firestore.SERVER_TIMESTAMP})
+    # Update status (and the event_codes index, so JOIN stops resolving the code)
+    batch = db.batch()
+    batch.update(event_ref, {"status": "archived", "archived_at": firestore.SERVER_TIMESTAMP})
+    if event_data.get("event_code"):
+        batch.set(
+            db.collection("event_codes").document(event_data["event_code"]),
+            {
+                "event_id": event_id,
+                "event_name": event_data.get("event_name"),
+                "status": "archived",
+                "account_id": event_data.get("account_id"),
+                "updated_at": firestore.SERVER_TIMESTAMP,
+            },
+        )
+    batch.commit()
 
     print("")
     print("✅ イベントをアーカイブしました")
@@ -23,6 +23,7 @@ def create_event(
     event_date: str,
     account_id: str,
     status: str = "active",
+    result_delivery: str = "single",
 ):
     """Create a new event in Firestore"""
     db = firestore.Client()
@@ -37,8 +38,10 @@ def create_event(
     # Generate unique event_code for LINE Bot JOIN command
     event_code = str(uuid.uuid4())
 
-    # Create event
-    event_ref.set(
+    # Create event together with the event_codes index the webhook resolves JOIN codes through
+    batch = db.batch()
+    batch.set(
+        event_ref,
         {
             "event_id": event_id,
             "event_name": event_name,
@@ -52,9 +55,21 @@ def create_event(
                 "max_uploads_per_user": 10,
                 "similarity_threshold": 8,
                 "similarity_penalty": 0.33,
+                "result_delivery": result_delivery,
             },
-        }
+        },
     )
+    batch.set(
+        db.collection("event_codes").document(event_code),
+        {
+            "event_id": event_id,
+            "event_name": event_name,
+            "status": status,
+            "account_id": account_id,
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        },
+    )
+    batch.commit()
 
     print("Event created successfully!")
     print("")
@@ -65,6 +80,7 @@ def create_event(
     print(f"  Event Code: {event_code}")
     print(f"  Account ID: {account_id}")
     print(f"  Status: {status}")
+    print(f"  Result Delivery: {result_delivery}")
     print("")
     print("Guests join via LINE Bot by sending:")
     print(f"  JOIN {event_code}")
@@ -90,6 +106,12 @@ def main():
         choices=["test", "active", "archived"],
         help="Event status (default: active)",
     )
+    parser.add_argument(
+        "--result-delivery",
+        default="single",
+        choices=["single", "two_phase"],
+        help="two_phase pushes the smile score before the AI comment (default: single)",
+    )
 
     args = parser.parse_args()
 
@@ -99,6 +121,7 @@ def main():
         event_date=args.event_date,
         account_id=args.account_id,
         status=args.status,
+        result_delivery=args.result_delivery,
     )
 
 
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Migration script: Backfill event_codes/{event_code} index documents.
+
+The webhook resolves a JOIN code with one point read of its index document
+and falls back to querying events for codes without one. This script writes
+the index for every event that has an event_code, copying event_id,
+event_name, status and account_id from the event (the event is the source of
+truth, so existing index documents are overwritten).
+
+Usage:
+    python scripts/migrate_add_event_code_index.py [--dry-run]
+"""
+
+import argparse
+
+from google.cloud import firestore
+
+
+def migrate(dry_run: bool = False):
+    """Write event_codes index documents from events."""
+    db = firestore.Client()
+    event_codes_ref = db.collection("event_codes")
+
+    written = 0
+    skipped = 0
+
+    for event_doc in db.collection("events").stream():
+        data = event_doc.to_dict()
+        event_code = data.get("event_code")
+        if not event_code:
+            skipped += 1
+            print(f"  SKIP {event_doc.id} (no event_code, run migrate_add_event_code.py first)")
+            continue
+
+        index = {
+            "event_id": event_doc.id,
+            "event_name": data.get("event_name"),
+            "status": data.get("status"),
+            "account_id": data.get("account_id"),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }
+
+        if dry_run:
+            print(f"  DRY-RUN {event_code}: would point at {event_doc.id} ({index['status']})")
+        else:
+            event_codes_ref.document(event_code).set(index)
+            print(f"  WRITTEN {event_code} -> {event_doc.id} ({index['status']})")
+
+        written += 1
+
+    print("")
+    print(f"Written: {written}, Skipped: {skipped}")
+    if dry_run:
+        print("(dry-run mode, no changes written)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill event_codes index documents")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Preview changes without writing",
+    )
+    args = parser.parse_args()
+    migrate(dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Migration script: Backfill line_users/{line_user_id} pointer documents.
+
+The webhook finds a guest's active registration through the pointer (one point
+read) and falls back to querying users for guests without one. This script
+creates the pointer for every guest with an active (pending_name or registered)
+registration. Pointers that already exist (e.g. written by a JOIN while the
+script runs) are left untouched.
+
+Usage:
+    python scripts/migrate_add_line_user_pointers.py [--dry-run] [--deactivate-extra]
+"""
+
+import argparse
+from datetime import UTC, datetime
+
+from google.api_core.exceptions import Conflict
+from google.cloud import firestore
+
+# Same precedence as the webhook lookup: a pending registration wins
+ACTIVE_JOIN_STATUSES = ["pending_name", "registered"]
+
+
+def _pick_active(docs: list) -> tuple:
+    """Return (active doc, other active docs) for one guest."""
+    oldest = datetime.min.replace(tzinfo=UTC)
+    ordered = sorted(
+        docs,
+        key=lambda d: (
+            ACTIVE_JOIN_STATUSES.index(d.to_dict().get("join_status")),
+            -(d.to_dict().get("created_at") or oldest).timestamp(),
+        ),
+    )
+    return ordered[0], ordered[1:]
+
+
+def migrate(dry_run: bool = False, deactivate_extra: bool = False):
+    """Create line_users pointers from active user registrations."""
+    db = firestore.Client()
+    users_ref = db.collection("users")
+    query = users_ref.where(filter=firestore.FieldFilter("join_status", "in", ACTIVE_JOIN_STATUSES))
+
+    registrations: dict[str, list] = {}
+    for user_doc in query.stream():
+        line_user_id = user_doc.to_dict().get("line_user_id")
+        if line_user_id:
+            registrations.setdefault(line_user_id, []).append(user_doc)
+
+    created = 0
+    skipped = 0
+    extra = 0
+
+    for line_user_id, docs in registrations.items():
+        active, others = _pick_active(docs)
+        data = active.to_dict()
+        pointer = {
+            "user_doc_id": active.id,
+            "event_id": data.get("event_id"),
+            "join_status": data.get("join_status"),
+            "name": data.get("name"),
+            "has_uploads": bool(data.get("total_uploads")),
+            "updated_at": firestore.SERVER_TIMESTAMP,
+        }
+
+        if others:
+            extra += len(others)
+            other_ids = ", ".join(d.id for d in others)
+            action = "deactivating" if deactivate_extra else "keeping"
+            print(
+                f"  WARN {line_user_id}: {len(docs)} active registrations, pointing at {active.id}, {action} {other_ids}"
+            )
+
+        if dry_run:
+            print(f"  DRY-RUN {line_user_id}: would point at {active.id} ({pointer['join_status']})")
+            created += 1
+            continue
+
+        try:
+            db.collection("line_users").document(line_user_id).create(pointer)
+        except Conflict:
+            skipped += 1
+            print(f"  SKIP {line_user_id} (pointer already exists)")
+            continue
+
+        if deactivate_extra:
+            for other in others:
+                users_ref.document(other.id).update({"join_status": "left"})
+
+        created += 1
+        print(f"  CREATED {line_user_id} -> {active.id} ({pointer['join_status']})")
+
+    print("")
+    print(f"Created: {created}, Skipped: {skipped}, Extra active registrations: {extra}")
+    if dry_run:
+        print("(dry-run mode, no changes written)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill line_users pointer documents")
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Preview changes without writing",
+    )
+    parser.add_argument(
+        "--deactivate-extra",
+        action="store_true",
+        help="Set join_status to 'left' on active registrations the pointer does not name",
+    )
+    args = parser.parse_args()
+    migrate(dry_run=args.dry_run, deactivate_extra=args.deactivate_extra)
+
+
+if __name__ == "__main__":
+    main()
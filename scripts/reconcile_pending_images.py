@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Reconcile pending images batch script.
+
+Re-drives images stuck in status "pending" (lost scoring trigger, timeout,
+instance crash) through the scoring path, and marks images that keep failing
+as poisoned. Uses the same logic as the scheduled reconcile function.
+
+Usage:
+    # Dry run (count stuck images)
+    python scripts/reconcile_pending_images.py --dry-run
+
+    # Re-drive images pending for more than 10 minutes (default)
+    python scripts/reconcile_pending_images.py
+
+    # Re-drive images pending for more than 30 minutes, 8 at a time, without confirmation
+    python scripts/reconcile_pending_images.py --stale-minutes 30 --workers 8 -y
+"""
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+# LINE token is required to send re-driven results to guests
+if not os.environ.get("LINE_CHANNEL_ACCESS_TOKEN"):
+    print("❌ LINE_CHANNEL_ACCESS_TOKEN を設定してください（結果をLINEに送信するため）")
+    sys.exit(1)
+
+# Add src directory to path for imports
+src_path = Path(__file__).parent.parent / "src" / "functions" / "scoring"
+sys.path.insert(0, str(src_path.parent))
+
+from scoring.main import (  # noqa: E402
+    RECONCILE_MAX_ATTEMPTS,
+    RECONCILE_MAX_WORKERS,
+    RECONCILE_PAGE_SIZE,
+    RECONCILE_STALE_MINUTES,
+    reconcile_pending_images,
+)
+from tqdm import tqdm  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-drive images stuck in pending status")
+    parser.add_argument(
+        "--stale-minutes",
+        type=int,
+        default=RECONCILE_STALE_MINUTES,
+        help=f"Only images pending for at least this many minutes (default: {RECONCILE_STALE_MINUTES})",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=RECONCILE_MAX_ATTEMPTS,
+        help=f"Re-drive attempts before an image is poisoned (default: {RECONCILE_MAX_ATTEMPTS})",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=RECONCILE_MAX_WORKERS,
+        help=f"Concurrent re-driven scorings (default: {RECONCILE_MAX_WORKERS})",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=RECONCILE_PAGE_SIZE,
+        help=f"Image documents per page (default: {RECONCILE_PAGE_SIZE})",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Preview only, don't score or update Firestore",
+    )
+    parser.add_argument("-y", "--yes", action="store_true", help="Skip confirmation prompt")
+
+    args = parser.parse_args()
+
+    print("🔁 保留中の画像の再スコアリング")
+    print(f"  対象: {args.stale_minutes}分以上 pending のままの画像")
+    print(f"  {args.max_attempts}回失敗した画像は poisoned としてマークされます")
+
+    if args.dry_run:
+        print("\n⚠️  ドライランモード: 実際には処理されません")
+
+    # Confirmation
+    if not args.dry_run and not args.yes:
+        confirm = input("\n続行しますか？ [y/N]: ")
+        if confirm.lower() != "y":
+            print("キャンセルしました。")
+            return 0
+
+    with tqdm(desc="Reconciling", unit="img") as progress:
+        stats = reconcile_pending_images(
+            stale_minutes=args.stale_minutes,
+            max_attempts=args.max_attempts,
+            dry_run=args.dry_run,
+            page_size=args.page_size,
+            max_workers=args.workers,
+            on_progress=progress.update,
+        )
+
+    print("\n" + "=" * 50)
+    print("📊 サマリー")
+    print("=" * 50)
+    print(f"  スキャン: {stats['scanned']}件")
+    print(f"  {'再実行対象' if args.dry_run else '再実行'}: {stats['redriven']}件")
+    if not args.dry_run:
+        print(f"    成功: {stats['succeeded']}件")
+        print(f"    失敗: {stats['failed']}件")
+    print(f"  poisoned: {stats['poisoned']}件")
+    print(f"  破棄（削除済み）: {stats['discarded']}件")
+    print(f"  スキップ（ユーザー不明）: {stats['skipped']}件")
+
+    if args.dry_run:
+        print("\n⚠️  これはドライランでした。実際には処理されていません。")
+
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Refresh signed URLs batch script.
+
+Re-signs storage URLs of images whose signed URL expires soon (or already has),
+so post-event galleries keep working for the whole data retention period.
+Uses the same logic as the scheduled url_refresh function.
+
+Usage:
+    # Dry run (count images that would be refreshed)
+    python scripts/refresh_signed_urls.py --dry-run
+
+    # Refresh URLs expiring within the next 48 hours (default)
+    python scripts/refresh_signed_urls.py
+
+    # Refresh URLs expiring within the next 3 days, without confirmation
+    python scripts/refresh_signed_urls.py --window-hours 72 -y
+"""
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+# Set dummy LINE token before importing main.py (not used for URL refresh)
+if not os.environ.get("LINE_CHANNEL_ACCESS_TOKEN"):
+    os.environ["LINE_CHANNEL_ACCESS_TOKEN"] = "dummy_token_for_refresh_script"
+
+# Add src directory to path for imports
+src_path = Path(__file__).parent.parent / "src" / "functions" / "scoring"
+sys.path.insert(0, str(src_path.parent))
+
+from scoring.main import (  # noqa: E402
+    URL_REFRESH_PAGE_SIZE,
+    URL_REFRESH_WINDOW_HOURS,
+    refresh_expiring_signed_urls,
+)
+from tqdm import tqdm  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-sign image URLs that are about to expire")
+    parser.add_argument(
+        "--window-hours",
+        type=int,
+        default=URL_REFRESH_WINDOW_HOURS,
+        help=f"Refresh URLs expiring within this many hours (default: {URL_REFRESH_WINDOW_HOURS})",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=URL_REFRESH_PAGE_SIZE,
+        help=f"Image documents per page (default: {URL_REFRESH_PAGE_SIZE})",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Preview only, don't sign or update Firestore",
+    )
+    parser.add_argument("-y", "--yes", action="store_true", help="Skip confirmation prompt")
+
+    args = parser.parse_args()
+
+    print("🔗 署名付きURLの更新")
+    print(f"  対象: {args.window_hours}時間以内に期限切れになるURL")
+
+    if args.dry_run:
+        print("\n⚠️  ドライランモード: 実際には更新されません")
+
+    # Confirmation
+    if not args.dry_run and not args.yes:
+        confirm = input("\n続行しますか？ [y/N]: ")
+        if confirm.lower() != "y":
+            print("キャンセルしました。")
+            return 0
+
+    with tqdm(desc="Refreshing", unit="img") as progress:
+        stats = refresh_expiring_signed_urls(
+            window_hours=args.window_hours,
+            dry_run=args.dry_run,
+            page_size=args.page_size,
+            on_progress=progress.update,
+        )
+
+    print("\n" + "=" * 50)
+    print("📊 サマリー")
+    print("=" * 50)
+    print(f"  スキャン: {stats['scanned']}件")
+    print(f"  {'更新対象' if args.dry_run else '更新'}: {stats['refreshed']}件")
+    print(f"  スキップ（削除済み・保持期間切れ）: {stats['skipped']}件")
+    print(f"  失敗: {stats['failed']}件")
+
+    if args.dry_run:
+        print("\n⚠️  これはドライランでした。実際には更新されていません。")
+
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
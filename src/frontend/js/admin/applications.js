@@ -10,8 +10,8 @@ import {
   orderBy,
   limit,
   doc,
-  addDoc,
   updateDoc,
+  writeBatch,
   serverTimestamp,
 } from "https://www.gstatic.com/firebasejs/10.7.1/firebase-firestore.js";
 
@@ -26,7 +26,7 @@ import {
   currentApplicationId,
   setCurrentApplicationId,
 } from "./state.js";
-import { loadEvents } from "./events.js";
+import { loadEvents, setEventCodeIndex } from "./events.js";
 
 const APPLICATION_STATUS_BADGE = {
   pending: { label: "Pending", cssClass: "status-draft" },
@@ -274,12 +274,15 @@ export async function createEventFromApplication(applicationId) {
       venue_name: app.venue_name,
     };
 
-    const eventRef = await addDoc(collection(db, "events"), eventData);
-
-    await updateDoc(doc(db, "applications", applicationId), {
+    const eventRef = doc(collection(db, "events"));
+    const batch = writeBatch(db);
+    batch.set(eventRef, eventData);
+    setEventCodeIndex(batch, eventRef.id, eventData);
+    batch.update(doc(db, "applications", applicationId), {
       status: "event_created",
       event_id: eventRef.id,
     });
+    await batch.commit();
 
     showToast("Event created successfully", "success");
 
@@ -12,9 +12,6 @@ import {
   where,
   writeBatch,
   doc,
-  addDoc,
-  updateDoc,
-  deleteDoc,
   serverTimestamp,
 } from "https://www.gstatic.com/firebasejs/10.7.1/firebase-firestore.js";
 
@@ -51,6 +48,19 @@ export async function fetchEventNames(eventIds) {
   }
 }
 
+// --- Event code index (the LINE webhook resolves JOIN codes through it) ---
+
+export function setEventCodeIndex(batch, eventId, data) {
+  if (!data.event_code) return;
+  batch.set(doc(db, "event_codes", data.event_code), {
+    event_id: eventId,
+    event_name: data.event_name || null,
+    status: data.status,
+    account_id: data.account_id || null,
+    updated_at: serverTimestamp(),
+  });
+}
+
 // --- Status constants ---
 
 const STATUS_BADGE = {
@@ -115,7 +125,7 @@ function createEventCard(docId, data) {
       option.addEventListener("click", (e) => {
         e.stopPropagation();
         dropdown.classList.add("hidden");
-        updateEventStatus(docId, s);
+        updateEventStatus(docId, data, s);
       });
       dropdown.appendChild(option);
     }
@@ -271,7 +281,12 @@ export async function hardDeleteEvent(eventId) {
   }
 
   const eventRef = doc(db, "events", eventId);
-  await deleteDoc(eventRef);
+  const eventSnap = await getDoc(eventRef);
+  const eventCode = eventSnap.exists() ? eventSnap.data().event_code : null;
+  const batch = writeBatch(db);
+  if (eventCode) batch.delete(doc(db, "event_codes", eventCode));
+  batch.delete(eventRef);
+  await batch.commit();
 }
 
 // --- Select all events ---
@@ -370,7 +385,7 @@ export function copyToClipboard(text) {
 
 // --- Event status management ---
 
-async function updateEventStatus(eventId, newStatus) {
+async function updateEventStatus(eventId, data, newStatus) {
   const confirmMsg = {
     draft: "Change status to Draft?",
     active: "Activate this event?\nGuests will be able to join via QR code.",
@@ -384,7 +399,10 @@ async function updateEventStatus(eventId, newStatus) {
   if (!confirmed) return;
 
   try {
-    await updateDoc(doc(db, "events", eventId), { status: newStatus });
+    const batch = writeBatch(db);
+    batch.update(doc(db, "events", eventId), { status: newStatus });
+    setEventCodeIndex(batch, eventId, { ...data, status: newStatus });
+    await batch.commit();
     await loadEvents();
   } catch (error) {
     console.error("Error updating event status:", error);
@@ -483,10 +501,15 @@ export async function createEvent() {
         max_uploads_per_user: 10,
         similarity_threshold: 8,
         similarity_penalty: 0.33,
+        result_delivery: "single",
       },
     };
 
-    await addDoc(collection(db, "events"), eventData);
+    const eventRef = doc(collection(db, "events"));
+    const batch = writeBatch(db);
+    batch.set(eventRef, eventData);
+    setEventCodeIndex(batch, eventRef.id, eventData);
+    await batch.commit();
 
     document.getElementById("newEventName").value = "";
     setDefaultEventDate();
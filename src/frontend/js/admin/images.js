@@ -90,7 +90,7 @@ export async function loadImages(forceRefresh = false) {
         const d = docSnap.data();
         return {
           id: docSnap.id,
-          thumbnail: d.storage_url || "",
+          thumbnail: getImageUrl({ id: docSnap.id, ...d }),
           user_name:
             d.user_name || userNameCache.get(d.user_id) || d.user_id || "N/A",
           event_id: d.event_id || "",
@@ -112,9 +112,11 @@ export async function loadImages(forceRefresh = false) {
         };
       })
       .filter((img) => {
-        // Signed URL expiration check
-        if (img.storage_url_expires_at && img.storage_url_expires_at < now) {
-          return false;
+        // The redirect endpoint signs on demand, so only stored URLs can expire
+        if (window.IMAGE_FUNCTION_URL) return true;
+        // Signed URL expiration check (refreshed URLs outlive the upload + 7 days)
+        if (img.storage_url_expires_at) {
+          return img.storage_url_expires_at >= now;
         }
         // Fallback: signed URLs are max 7 days, so older images are always expired
         const SIGNED_URL_MAX_MS = 7 * 24 * 60 * 60 * 1000;
@@ -250,7 +252,12 @@ export async function loadImages(forceRefresh = false) {
 // --- Image URL and download helpers ---
 
 function getImageUrl(imageData) {
-  if (imageData.storage_url) return imageData.storage_url;
+  const expiresAt = imageData.storage_url_expires_at?.seconds;
+  const signedUrlExpired = expiresAt && expiresAt * 1000 < Date.now();
+  if (imageData.storage_url && !signedUrlExpired) return imageData.storage_url;
+  if (window.IMAGE_FUNCTION_URL && imageData.id) {
+    return `${window.IMAGE_FUNCTION_URL}/${encodeURIComponent(imageData.id)}`;
+  }
   console.warn(`No signed URL for image: ${imageData.id || "unknown"}`);
   return "";
 }
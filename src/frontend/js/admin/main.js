@@ -154,6 +154,22 @@ function switchTab(tabName) {
 
 // --- Bulk delete ---
 
+// A deleted registration must not stay the guest's active one: drop the
+// line_users pointer naming it, so the webhook asks the guest to JOIN again.
+// User doc IDs are "{line_user_id}_{event_id}" (LINE user IDs have no "_").
+async function deleteLineUserPointers(batch, userDocIds) {
+  await Promise.all(
+    userDocIds.map(async (userDocId) => {
+      const lineUserId = userDocId.split("_")[0];
+      const pointerRef = doc(db, "line_users", lineUserId);
+      const pointer = await getDoc(pointerRef);
+      if (pointer.exists() && pointer.data().user_doc_id === userDocId) {
+        batch.delete(pointerRef);
+      }
+    })
+  );
+}
+
 async function deleteSelected(type) {
   const count = selectedItems[type].size;
   if (count === 0) return;
@@ -179,6 +195,9 @@ async function deleteSelected(type) {
           const docRef = doc(db, collectionName, id);
           batch.delete(docRef);
         });
+        if (type === "users") {
+          await deleteLineUserPointers(batch, chunk);
+        }
 
         await batch.commit();
       }
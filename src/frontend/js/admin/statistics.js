@@ -425,8 +425,9 @@ export async function loadStatistics() {
         ...docSnap.data(),
       }))
       .filter((img) => {
+        if (window.IMAGE_FUNCTION_URL) return true;
         const expiresAt = img.storage_url_expires_at?.seconds;
-        if (expiresAt && expiresAt * 1000 < now) return false;
+        if (expiresAt) return expiresAt * 1000 >= now;
         const SIGNED_URL_MAX_MS = 7 * 24 * 60 * 60 * 1000;
         const uploadAt = img.upload_timestamp?.seconds;
         if (uploadAt && now - uploadAt * 1000 > SIGNED_URL_MAX_MS) return false;
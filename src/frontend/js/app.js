@@ -133,33 +133,44 @@ function getTopImages(images, count = 3) {
  * @param {number} startRank - Starting rank number (default 4)
  */
 /**
- * Get image URL from image data, using signed URL only
- * Falls back to empty string if no signed URL is available
+ * Get image URL from image data.
+ * Uses the stored signed URL while it is valid, otherwise the on-demand
+ * image redirect endpoint (if configured). Falls back to empty string.
  */
 function getImageUrl(imageData) {
-  if (imageData.storage_url) {
+  if (imageData.storage_url && !isSignedUrlExpired(imageData)) {
     return imageData.storage_url;
   }
+  if (window.IMAGE_FUNCTION_URL && imageData.id) {
+    return `${window.IMAGE_FUNCTION_URL}/${encodeURIComponent(imageData.id)}`;
+  }
   console.warn(`No signed URL for image: ${imageData.id}`);
   return "";
 }
 
-function isImageExpired(img) {
+function isSignedUrlExpired(img) {
   const now = Date.now();
   const expiresAt = img.storage_url_expires_at?.seconds;
-  if (expiresAt && expiresAt * 1000 < now) return true;
+  if (expiresAt) return expiresAt * 1000 < now;
+  // No expiry recorded: signed URLs are max 7 days, so older images are expired
   const SIGNED_URL_MAX_MS = 7 * 24 * 60 * 60 * 1000;
   const uploadAt = img.upload_timestamp?.seconds;
   if (uploadAt && now - uploadAt * 1000 > SIGNED_URL_MAX_MS) return true;
   return false;
 }
 
+function isImageExpired(img) {
+  // The redirect endpoint signs on demand, so only stored URLs can expire
+  if (window.IMAGE_FUNCTION_URL) return false;
+  return isSignedUrlExpired(img);
+}
+
 async function filterByImageAvailability(images) {
   const results = await Promise.all(
     images.map(
       (img) =>
         new Promise((resolve) => {
-          const url = img.storage_url;
+          const url = getImageUrl(img);
           if (!url) {
             resolve(null);
             return;
@@ -1996,11 +2007,11 @@ async function downloadAllImages() {
       ...doc.data(),
     }));
 
-    // Filter out deleted, expired, and images without signed URLs
+    // Filter out deleted, expired, and images without a loadable URL
     images = images.filter(
       (img) =>
         !img.deleted_at &&
-        img.storage_url &&
+        (img.storage_url || window.IMAGE_FUNCTION_URL) &&
         !isImageExpired(img)
     );
     images = await filterByImageAvailability(images);
@@ -2028,7 +2039,7 @@ async function downloadAllImages() {
       await Promise.all(
         batch.map(async (img) => {
           try {
-            const response = await fetch(img.storage_url);
+            const response = await fetch(getImageUrl(img));
             if (!response.ok) throw new Error(`HTTP ${response.status}`);
             const blob = await response.blob();
 
@@ -24,3 +24,7 @@ window.LIFF_ID = "2009017477-064Ui1a1";
 
 // Application notification function URL
 window.APPLICATION_NOTIFY_URL = "https://asia-northeast1-wedding-smile-catcher.cloudfunctions.net/application-notify";
+
+// On-demand image redirect function URL (signs image URLs when requested).
+// Leave empty to rely on signed URLs stored on image documents only.
+window.IMAGE_FUNCTION_URL = "https://asia-northeast1-wedding-smile-catcher.cloudfunctions.net/image";
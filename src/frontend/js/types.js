@@ -29,6 +29,7 @@
  * @property {string} name - User display name
  * @property {string} event_id - Associated event ID
  * @property {number} total_uploads - Number of images uploaded
+ * @property {number} [active_uploads] - Images not deleted (draft upload limit)
  * @property {number} [best_score] - Best total_score achieved
  * @property {import("firebase/firestore").Timestamp} [created_at]
  * @property {import("firebase/firestore").Timestamp} [deleted_at]
@@ -9,14 +9,23 @@ Analyzes uploaded images using:
 - Format face count as "大勢" for 10+ people
 """
 
+import base64
+import binascii
+import hashlib
+import heapq
 import io
+import itertools
 import json
 import logging
 import os
+import queue
 import random
+import threading
 import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from datetime import UTC, datetime, timedelta
 from typing import Any
 
@@ -25,7 +34,7 @@ import google.auth
 import google.auth.transport.requests
 import imagehash
 import vertexai
-from flask import Request, jsonify
+from flask import Request, Response, jsonify
 from google.cloud import firestore, storage, vision
 from google.cloud import logging as cloud_logging
 from linebot.v3.messaging import (
@@ -77,6 +86,98 @@ gemini_model = GenerativeModel("gemini-2.5-flash")
 
 # Signed URL configuration (7 days - sufficient for wedding event + post-event viewing)
 SIGNED_URL_EXPIRATION_HOURS = 168
+# Existing URLs with at least this much validity left are reused instead of re-signed
+SIGNED_URL_MIN_REMAINING_HOURS = 24
+SIGNING_MAX_WORKERS = 8
+
+# Persist week-long signed URLs on image documents (disable when clients use the
+# webhook source's image_redirect endpoint instead)
+STORE_SIGNED_URLS = os.environ.get("STORE_SIGNED_URLS", "true").lower() == "true"
+
+# Images up to this size may be handed over inline by the webhook (skips the
+# Cloud Storage download)
+INLINE_IMAGE_MAX_BYTES = int(os.environ.get("INLINE_IMAGE_MAX_BYTES", str(4 * 1024 * 1024)))
+
+# Signed URL refresh job: re-sign URLs expiring within this window
+URL_REFRESH_WINDOW_HOURS = int(os.environ.get("URL_REFRESH_WINDOW_HOURS", "48"))
+URL_REFRESH_PAGE_SIZE = 200
+
+# Pending-image reconciler: images still "pending" after RECONCILE_STALE_MINUTES
+# (longer than the scoring timeout) are re-driven; after RECONCILE_MAX_ATTEMPTS
+# they are marked "poisoned" and the user is told scoring failed
+RECONCILE_STALE_MINUTES = int(os.environ.get("RECONCILE_STALE_MINUTES", "10"))
+RECONCILE_MAX_ATTEMPTS = int(os.environ.get("RECONCILE_MAX_ATTEMPTS", "3"))
+RECONCILE_MAX_WORKERS = 4
+RECONCILE_PAGE_SIZE = 100
+
+# Cached signing credentials and signing metrics (per instance)
+_signing_credentials = None
+_signing_lock = threading.Lock()
+signing_stats = {"signed": 0, "failed": 0, "skipped": 0, "total_seconds": 0.0}
+
+# Vision API micro-batching (1 = disabled, each scoring calls face_detection directly).
+# batch_annotate_images accepts at most 16 images per request.
+VISION_BATCH_MAX_SIZE = min(int(os.environ.get("VISION_BATCH_MAX_SIZE", "1")), 16)
+VISION_BATCH_LINGER_MS = int(os.environ.get("VISION_BATCH_LINGER_MS", "20"))
+VISION_BATCH_RESULT_TIMEOUT_SECONDS = 60
+
+# Scoring backlog gauge maintained together with the webhook
+# (scoring_backlog/{event_id}); completion buckets older than this are pruned,
+# at most once per minute per event on each instance
+BACKLOG_BUCKET_RETENTION_MINUTES = 10
+BACKLOG_PRUNE_CACHE_MAX_ENTRIES = 256
+_backlog_pruned_buckets: OrderedDict[str, str] = OrderedDict()  # event_id -> minute bucket last pruned
+_backlog_pruned_buckets_lock = threading.Lock()
+
+# Fair scheduling of concurrent scorings on this instance: at most
+# SCORING_MAX_CONCURRENCY run at once, waiting ones are admitted by weighted fair
+# queuing. A guest's first upload weighs more than repeat uploads.
+SCORING_MAX_CONCURRENCY = int(os.environ.get("SCORING_MAX_CONCURRENCY", "4"))
+SCORING_CLASS_WEIGHTS = {"first": 4.0, "repeat": 1.0}
+
+# Bulk mode of the scoring endpoint ({"image_ids": [...]}, NDJSON response).
+# A request holds at most BULK_SCORING_MAX_IMAGES, which at SCORING_MAX_CONCURRENCY
+# and a few seconds per image fits the 300 s function timeout. Items not started
+# within BULK_SCORING_TIME_BUDGET_SECONDS are returned as "deferred" and listed in
+# the summary's remaining_image_ids; callers send those as the next chunk.
+BULK_SCORING_MAX_IMAGES = 100
+BULK_SCORING_TIME_BUDGET_SECONDS = 240
+
+# The combined result of an image set is claimed (notifying_at) before it is
+# pushed; a claim older than this belongs to a failed push and may be taken over
+IMAGE_SET_NOTIFY_CLAIM_SECONDS = 60
+
+
+def _get_signing_credentials():
+    """
+    Return (credentials, service_account_email) for IAM-based URL signing.
+
+    google.auth.default() is resolved once per instance; the cached credentials
+    are refreshed only when their access token has expired.
+    """
+    global _signing_credentials
+
+    with _signing_lock:
+        if _signing_credentials is None:
+            _signing_credentials, _project = google.auth.default()
+        if not _signing_credentials.valid:
+            _signing_credentials.refresh(google.auth.transport.requests.Request())
+        credentials = _signing_credentials
+
+    # Compute Engine credentials only expose the real email after refresh
+    service_account_email = getattr(credentials, "service_account_email", None)
+    if not service_account_email or service_account_email == "default":
+        # Fallback for local development or other credential types
+        service_account_email = f"scoring-function-sa@{GCP_PROJECT_ID}.iam.gserviceaccount.com"
+
+    return credentials, service_account_email
+
+
+def needs_signed_url(expires_at: datetime | None) -> bool:
+    """Return True if a stored signed URL is missing or expires within SIGNED_URL_MIN_REMAINING_HOURS."""
+    if not expires_at:
+        return True
+    return expires_at - datetime.now(UTC) < timedelta(hours=SIGNED_URL_MIN_REMAINING_HOURS)
 
 
 def generate_signed_url(
@@ -96,36 +197,283 @@ def generate_signed_url(
     Returns:
         Tuple of (signed_url, expiration_time)
     """
+    start_time = time.time()
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(storage_path)
 
     expiration = timedelta(hours=expiration_hours)
     expiration_time = datetime.now(UTC) + expiration
 
-    # Get credentials and refresh if needed
-    credentials, project = google.auth.default()
-    if not credentials.valid:
-        credentials.refresh(google.auth.transport.requests.Request())
+    credentials, service_account_email = _get_signing_credentials()
 
-    # Get service account email for IAM signing
-    if hasattr(credentials, "service_account_email"):
-        service_account_email = credentials.service_account_email
-    else:
-        # Fallback for local development or other credential types
-        service_account_email = f"scoring-function-sa@{GCP_PROJECT_ID}.iam.gserviceaccount.com"
+    try:
+        url = blob.generate_signed_url(
+            version="v4",
+            expiration=expiration,
+            method="GET",
+            service_account_email=service_account_email,
+            access_token=credentials.token,
+        )
+    except Exception:
+        with _signing_lock:
+            signing_stats["failed"] += 1
+        raise
 
-    url = blob.generate_signed_url(
-        version="v4",
-        expiration=expiration,
-        method="GET",
-        service_account_email=service_account_email,
-        access_token=credentials.token,
-    )
+    elapsed_time = time.time() - start_time
+    with _signing_lock:
+        signing_stats["signed"] += 1
+        signing_stats["total_seconds"] += elapsed_time
 
-    logger.info(f"Generated signed URL for {storage_path}, expires at {expiration_time.isoformat()}")
+    logger.info(
+        f"Generated signed URL for {storage_path}, expires at {expiration_time.isoformat()}",
+        extra={"elapsed_time": round(elapsed_time, 3), "event": "signed_url_generated"},
+    )
     return url, expiration_time
 
 
+def generate_signed_urls(
+    bucket_name: str, storage_paths: list[str], expiration_hours: int = SIGNED_URL_EXPIRATION_HOURS
+) -> dict[str, tuple[str, datetime]]:
+    """
+    Generate signed URLs for many objects concurrently.
+
+    Each signature is a separate IAM signBlob call, so paths are signed in a
+    bounded thread pool sharing the cached credentials. Failures are logged and
+    left out of the result so callers can retry them later.
+
+    Args:
+        bucket_name: Name of the Cloud Storage bucket
+        storage_paths: Paths to the objects in the bucket
+        expiration_hours: URL validity period in hours (default: 168)
+
+    Returns:
+        Dict of storage_path -> (signed_url, expiration_time)
+    """
+    if not storage_paths:
+        return {}
+
+    start_time = time.time()
+    results: dict[str, tuple[str, datetime]] = {}
+
+    with ThreadPoolExecutor(max_workers=min(SIGNING_MAX_WORKERS, len(storage_paths))) as executor:
+        futures = {
+            executor.submit(generate_signed_url, bucket_name, path, expiration_hours): path for path in storage_paths
+        }
+        for future, path in futures.items():
+            try:
+                results[path] = future.result()
+            except Exception as e:
+                logger.warning(f"Failed to generate signed URL for {path}: {str(e)}")
+
+    logger.info(
+        "Signed URL batch completed",
+        extra={
+            "requested": len(storage_paths),
+            "signed": len(results),
+            "elapsed_time": round(time.time() - start_time, 2),
+            "event": "signed_url_batch_completed",
+        },
+    )
+    return results
+
+
+class FaceDetectionBatcher:
+    """
+    Collects face detection requests from concurrent scorings on this instance
+    and sends them to Vision API in a single batch_annotate_images call.
+
+    A batch is dispatched when max_batch_size images are waiting or the oldest
+    one has waited linger_ms, whichever comes first. Each caller receives its
+    own AnnotateImageResponse, so an error on one image does not affect the
+    others in the same batch.
+    """
+
+    def __init__(self, client, max_batch_size: int, linger_ms: int, max_in_flight: int = 4):
+        self._client = client
+        self._max_batch_size = max(1, max_batch_size)
+        self._linger_seconds = linger_ms / 1000
+        self._queue: queue.Queue = queue.Queue()
+        self._dispatcher = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="vision-batch")
+        self._collector: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self.stats = {"batches": 0, "images": 0, "failed_batches": 0}
+
+    def detect_faces(self, image_bytes: bytes, timeout: float = VISION_BATCH_RESULT_TIMEOUT_SECONDS):
+        """
+        Queue an image for face detection and wait for its response.
+
+        Raises:
+            Exception: If the whole batch request failed (e.g. 429 / 503)
+        """
+        future: Future = Future()
+        self._ensure_collector()
+        self._queue.put((image_bytes, future))
+        return future.result(timeout=timeout)
+
+    def _ensure_collector(self):
+        with self._lock:
+            if self._collector is None or not self._collector.is_alive():
+                self._collector = threading.Thread(
+                    target=self._collect_loop, name="vision-batch-collector", daemon=True
+                )
+                self._collector.start()
+
+    def _collect_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._linger_seconds
+
+            while len(batch) < self._max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._dispatcher.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: list[tuple[bytes, Future]]):
+        annotate_requests = [
+            vision.AnnotateImageRequest(
+                image=vision.Image(content=image_bytes),
+                features=[vision.Feature(type_=vision.Feature.Type.FACE_DETECTION)],
+            )
+            for image_bytes, _future in batch
+        ]
+
+        start_time = time.time()
+        try:
+            response = self._client.batch_annotate_images(requests=annotate_requests)
+        except Exception as e:
+            with self._lock:
+                self.stats["failed_batches"] += 1
+            for _image_bytes, future in batch:
+                future.set_exception(e)
+            logger.warning(f"Vision batch request failed ({len(batch)} images): {str(e)}")
+            return
+
+        with self._lock:
+            self.stats["batches"] += 1
+            self.stats["images"] += len(batch)
+            avg_batch_size = self.stats["images"] / self.stats["batches"]
+
+        for (_image_bytes, future), image_response in zip(batch, response.responses, strict=False):
+            future.set_result(image_response)
+        for _image_bytes, future in batch[len(response.responses) :]:
+            future.set_exception(Exception("Vision API error: missing response in batch"))
+
+        logger.info(
+            "Vision batch dispatched",
+            extra={
+                "batch_size": len(batch),
+                "max_batch_size": self._max_batch_size,
+                "fill_ratio": round(len(batch) / self._max_batch_size, 2),
+                "avg_batch_size": round(avg_batch_size, 2),
+                "elapsed_time": round(time.time() - start_time, 2),
+                "event": "vision_batch_dispatched",
+            },
+        )
+
+
+face_detection_batcher = FaceDetectionBatcher(vision_client, VISION_BATCH_MAX_SIZE, VISION_BATCH_LINGER_MS)
+
+
+class FairScoringScheduler:
+    """
+    Admits concurrent scorings on this instance to a bounded number of slots
+    using self-clocked weighted fair queuing.
+
+    Each (event_id, user_id) pair is a flow. A request's finish tag is
+    max(virtual time, the flow's previous tag) + 1 / weight, and waiting
+    requests are admitted in tag order; the virtual time is the tag of the
+    last admitted request. Guests of all events on the deployment share one
+    queue, so a busy event cannot starve a quiet one. The weight comes from the
+    upload class; a "first" upload only keeps its weight while its flow has
+    nothing else queued or running.
+    """
+
+    def __init__(self, max_concurrency: int, class_weights: dict[str, float]):
+        self._max_concurrency = max(1, max_concurrency)
+        self._class_weights = class_weights
+        self._lock = threading.Lock()
+        self._waiting: list[tuple[float, int, threading.Event]] = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._virtual_time = 0.0
+        self._flow_tags: dict[tuple[str, str], float] = {}
+        self._flow_active: dict[tuple[str, str], int] = {}
+        self.stats = {
+            upload_class: {"requests": 0, "queue_wait_seconds": 0.0, "service_seconds": 0.0}
+            for upload_class in class_weights
+        }
+
+    def _finish_tag(self, flow: tuple[str, str], upload_class: str) -> float:
+        """Assign the next finish tag of a flow (caller holds the lock)."""
+        if self._flow_active.get(flow):
+            upload_class = "repeat"
+        weight = self._class_weights.get(upload_class, 1.0)
+
+        tag = max(self._virtual_time, self._flow_tags.get(flow, 0.0)) + 1 / weight
+        self._flow_tags[flow] = tag
+        self._flow_active[flow] = self._flow_active.get(flow, 0) + 1
+        return tag
+
+    @contextmanager
+    def slot(self, event_id: str, user_id: str, upload_class: str):
+        """
+        Wait for a scoring slot and hold it for the duration of the block.
+
+        Yields:
+            Seconds spent waiting in the queue
+        """
+        upload_class = upload_class if upload_class in self.stats else "repeat"
+        flow = (event_id or "", user_id)
+        queued_at = time.monotonic()
+
+        with self._lock:
+            tag = self._finish_tag(flow, upload_class)
+            if self._running < self._max_concurrency and not self._waiting:
+                self._running += 1
+                self._virtual_time = tag
+                admitted = None
+            else:
+                admitted = threading.Event()
+                heapq.heappush(self._waiting, (tag, next(self._sequence), admitted))
+
+        if admitted:
+            admitted.wait()
+        queue_wait = time.monotonic() - queued_at
+        started_at = time.monotonic()
+
+        try:
+            yield queue_wait
+        finally:
+            service_time = time.monotonic() - started_at
+            with self._lock:
+                self._flow_active[flow] -= 1
+                if not self._flow_active[flow]:
+                    del self._flow_active[flow]
+                    del self._flow_tags[flow]
+
+                stats = self.stats[upload_class]
+                stats["requests"] += 1
+                stats["queue_wait_seconds"] += queue_wait
+                stats["service_seconds"] += service_time
+
+                if self._waiting:
+                    # Hand the slot over directly to the smallest finish tag
+                    next_tag, _sequence, next_admitted = heapq.heappop(self._waiting)
+                    self._virtual_time = next_tag
+                    next_admitted.set()
+                else:
+                    self._running -= 1
+
+
+scoring_scheduler = FairScoringScheduler(SCORING_MAX_CONCURRENCY, SCORING_CLASS_WEIGHTS)
+
+
 @functions_framework.http
 def scoring(request: Request):
     """
@@ -152,6 +500,35 @@ def scoring(request: Request):
 
     image_id = request_json.get("image_id")
     user_id = request_json.get("user_id")
+    image_set_id = request_json.get("image_set_id")
+    image_set_index = request_json.get("image_set_index")
+    event_id = request_json.get("event_id")
+    upload_class = request_json.get("upload_class") or "repeat"
+    two_phase = request_json.get("result_delivery") == "two_phase"
+    inline_image = decode_inline_image(request_json)
+
+    # Bulk mode: many images in one request, results streamed as NDJSON
+    if "image_ids" in request_json:
+        image_ids = request_json["image_ids"]
+        if (
+            not isinstance(image_ids, list)
+            or not image_ids
+            or len(image_ids) > BULK_SCORING_MAX_IMAGES
+            or not all(isinstance(i, str) and i for i in image_ids)
+        ):
+            return jsonify({"error": f"image_ids must be a list of 1-{BULK_SCORING_MAX_IMAGES} image IDs"}), 400
+
+        notify = bool(request_json.get("notify", True))
+        lines = (
+            json.dumps(item, ensure_ascii=False) + "\n" for item in score_images_bulk(image_ids, request_id, notify)
+        )
+        return Response(lines, status=200, mimetype="application/x-ndjson")
+
+    # Finalize-only request: the webhook accounted for the last image of a set
+    if image_set_id and not image_id:
+        if not record_image_set_result(image_set_id):
+            return jsonify({"error": "Failed to send image set result", "request_id": request_id}), 500
+        return jsonify({"status": "success", "image_set_id": image_set_id, "request_id": request_id}), 200
 
     if not image_id or not user_id:
         logger.warning(
@@ -174,14 +551,18 @@ def scoring(request: Request):
     start_time = time.time()
 
     try:
-        # Generate scores using Vision API
-        scores = generate_scores_with_vision_api(image_id, request_id)
-
-        # Update Firestore
-        update_firestore(image_id, user_id, scores)
-
-        # Send result to LINE
-        send_result_to_line(user_id, scores)
+        result = process_scoring(
+            image_id,
+            user_id,
+            request_id,
+            image_bytes=inline_image,
+            image_set_id=image_set_id,
+            image_set_index=image_set_index,
+            event_id=event_id,
+            upload_class=upload_class,
+            two_phase=two_phase,
+        )
+        scores = result["scores"]
 
         elapsed_time = time.time() - start_time
 
@@ -193,6 +574,9 @@ def scoring(request: Request):
                 "image_id": image_id,
                 "user_id": user_id,
                 "total_score": scores.get("total_score"),
+                "upload_class": upload_class,
+                "queue_wait": round(result["queue_wait"], 2),
+                "service_time": round(result["service_time"], 2),
                 "elapsed_time": round(elapsed_time, 2),
                 "event": "scoring_completed",
             },
@@ -228,9 +612,14 @@ def scoring(request: Request):
             exc_info=True,
         )
 
-        # Try to send error message to user
+        # Try to send error message to user (unless the score already reached them)
         try:
-            send_error_to_line(user_id)
+            if isinstance(e, ResultAlreadyDeliveredError):
+                pass
+            elif image_set_id:
+                record_image_set_result(image_set_id, image_id, None, image_set_index)
+            else:
+                send_error_to_line(user_id)
         except Exception:
             pass
 
@@ -247,6 +636,673 @@ def scoring(request: Request):
         )
 
 
+class ResultAlreadyDeliveredError(Exception):
+    """Raised when storing a result failed after it was already sent to the user."""
+
+
+def _deliver_result(
+    image_id: str,
+    user_id: str,
+    scores: dict[str, Any],
+    image_set_id: str | None,
+    image_set_index: int | None,
+    follow_up: bool = False,
+) -> bool:
+    """
+    Send a scoring result to LINE, or record it in its image set.
+
+    Returns:
+        True if the result reached the user (or was recorded in its set),
+        False if the LINE push failed
+    """
+    start_time = time.time()
+    if image_set_id:
+        if not record_image_set_result(image_set_id, image_id, scores, image_set_index):
+            return False
+    elif not send_result_to_line(user_id, scores, follow_up=follow_up):
+        return False
+
+    logger.info(
+        "Scoring result delivered",
+        extra={
+            "image_id": image_id,
+            "image_set_id": image_set_id,
+            "elapsed_time": round(time.time() - start_time, 2),
+            "event": "scoring_result_delivered",
+        },
+    )
+    return True
+
+
+def _send_provisional_result(
+    image_id: str, event_id: str | None, line_user_id: str | None, vision_result: dict[str, Any]
+) -> bool:
+    """
+    Push the smile score as soon as Vision finishes (two-phase delivery).
+
+    Skipped when Vision fell back to an estimate, so a guest is never told a
+    smile score that the final result would contradict. Each provisional push
+    is counted on the event, since it is an extra message against the LINE
+    push quota.
+
+    Returns:
+        True if the provisional message was sent
+    """
+    if not line_user_id or vision_result.get("error"):
+        return False
+
+    face_count_display = format_face_count(
+        vision_result.get("smiling_faces", vision_result["face_count"]), vision_result["face_count"]
+    )
+    message = TextMessage(
+        text=f"😊 笑顔: {vision_result['smile_score']}点（{face_count_display}）\n\n"
+        "🎨 AI評価を計算中です…\n最終スコアはこのあとお届けします！"
+    )
+    if not _send_line_message_with_retry(line_user_id, message):
+        return False
+
+    if event_id:
+        try:
+            db.collection("events").document(event_id).update({"provisional_push_count": firestore.Increment(1)})
+        except Exception as e:
+            logger.warning(f"Failed to count provisional push for event {event_id}: {str(e)}")
+
+    logger.info(
+        "Provisional result sent",
+        extra={
+            "image_id": image_id,
+            "event_id": event_id,
+            "smile_score": vision_result["smile_score"],
+            "event": "provisional_result_sent",
+        },
+    )
+    return True
+
+
+def _mark_notified(image_id: str):
+    """Record that the result of an image reached the user (best effort)."""
+    try:
+        db.collection("images").document(image_id).update({"notified_at": firestore.SERVER_TIMESTAMP})
+    except Exception as e:
+        logger.warning(f"Failed to mark image {image_id} as notified: {str(e)}")
+
+
+def process_scoring(
+    image_id: str,
+    user_id: str,
+    request_id: str,
+    image_bytes: bytes | None = None,
+    image_set_id: str | None = None,
+    image_set_index: int | None = None,
+    event_id: str | None = None,
+    upload_class: str = "repeat",
+    notify: bool = True,
+    two_phase: bool = False,
+) -> dict[str, Any]:
+    """
+    Score one image, store the result and deliver it to the user.
+
+    This is the path shared by the scoring endpoint and the pending-image
+    reconciler.
+
+    Args:
+        image_id: Image document ID
+        user_id: LINE user ID
+        request_id: Request ID for tracing
+        image_bytes: Inline image content (downloaded from Cloud Storage when omitted)
+        image_set_id: imageSet ID when the image is part of a multi-image send
+        image_set_index: 1-based position of the image within the set
+        event_id: Event ID (scheduling and backlog gauge)
+        upload_class: Scheduling class ("first" or "repeat")
+        notify: Whether to send the result to LINE
+        two_phase: Push the smile score as soon as Vision finishes and the
+            full result (AI score, comment, total) as a follow-up. Ignored for
+            multi-image sends, which get one combined message.
+
+    The result is delivered to LINE concurrently with the Firestore
+    transaction (and URL signing), so the guest does not wait for
+    bookkeeping. A delivered image is marked with notified_at, and images
+    already marked are not delivered again (e.g. when re-driven).
+
+    Returns:
+        Dict with scores, queue_wait and service_time (seconds)
+
+    Raises:
+        ResultAlreadyDeliveredError: If the Firestore update failed after the result was delivered
+        Exception: If scoring or the Firestore update fails
+    """
+    provisional = {"sent": False}
+    on_smile_score = None
+    if notify and two_phase and not image_set_id:
+
+        def on_smile_score(line_user_id, vision_result):
+            provisional["sent"] = _send_provisional_result(image_id, event_id, line_user_id, vision_result)
+
+    # Generate scores using Vision API (fairly scheduled across guests and events)
+    with scoring_scheduler.slot(event_id, user_id, upload_class) as queue_wait:
+        service_start = time.time()
+        scores = generate_scores_with_vision_api(
+            image_id, request_id, image_bytes=image_bytes, on_smile_score=on_smile_score
+        )
+    service_time = time.time() - service_start
+
+    deliver = notify and not scores.get("notified_at")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Send result to LINE first (multi-image sends get one combined message)
+        delivery = (
+            executor.submit(
+                _deliver_result, image_id, user_id, scores, image_set_id, image_set_index, provisional["sent"]
+            )
+            if deliver
+            else None
+        )
+        try:
+            update_firestore(image_id, user_id, scores)
+            persist_error = None
+        except Exception as e:
+            persist_error = e
+        delivered = delivery is not None and delivery.exception() is None and delivery.result()
+        if delivery is not None and not delivered:
+            reason = delivery.exception() or "LINE push failed"
+            logger.error(f"Failed to deliver result for image {image_id}: {str(reason)}")
+
+    if delivered:
+        _mark_notified(image_id)
+    if persist_error:
+        if delivered:
+            raise ResultAlreadyDeliveredError(str(persist_error)) from persist_error
+        raise persist_error
+
+    if event_id:
+        prune_backlog_buckets(event_id)
+
+    return {"scores": scores, "queue_wait": queue_wait, "service_time": service_time}
+
+
+def _stored_scoring_options(data: dict) -> dict[str, Any]:
+    """
+    Build process_scoring options from a stored image document.
+
+    Re-driven and bulk scorings keep the image's set position, scheduling
+    class and the event's result delivery mode recorded at ingest. The
+    provisional push of two-phase delivery is left out once the result was
+    delivered.
+    """
+    return {
+        "image_set_id": data.get("image_set_id"),
+        "image_set_index": data.get("image_set_index"),
+        "event_id": data.get("event_id"),
+        "upload_class": data.get("upload_class") or "repeat",
+        "two_phase": data.get("result_delivery") == "two_phase" and not data.get("notified_at"),
+    }
+
+
+def score_images_bulk(image_ids: list[str], request_id: str, notify: bool = True):
+    """
+    Score many images in one request, yielding per-item results as they finish.
+
+    Image documents are fetched with one get_all() call. Scorings run on a
+    pool sized to SCORING_MAX_CONCURRENCY and still pass through the shared
+    fair scheduler, so a bulk request cannot take more than its share of the
+    instance. A failure only affects its own item. Items that would start
+    after BULK_SCORING_TIME_BUDGET_SECONDS are deferred so the request ends
+    within the function timeout. Re-scoring completed images leaves the
+    backlog gauge alone; it only counts images leaving pending.
+
+    Args:
+        image_ids: Image document IDs (duplicates are scored once)
+        request_id: Request ID for tracing (suffixed per item)
+        notify: Whether results are sent to LINE
+
+    Yields:
+        {"image_id", "status": "success"|"error"|"not_found"|"skipped"|"deferred", ...}
+        per image, then {"summary": counts, "remaining_image_ids": deferred IDs
+        in request order, "request_id"}
+    """
+    start_time = time.time()
+    deadline = time.monotonic() + BULK_SCORING_TIME_BUDGET_SECONDS
+    summary = {"total": 0, "succeeded": 0, "failed": 0, "not_found": 0, "skipped": 0, "deferred": 0}
+    deferred = set()
+    unique_ids = list(dict.fromkeys(image_ids))
+    summary["total"] = len(unique_ids)
+
+    refs = [db.collection("images").document(image_id) for image_id in unique_ids]
+    snapshots = {snapshot.id: snapshot for snapshot in db.get_all(refs)}
+
+    def score_item(*args, **kwargs):
+        if time.monotonic() > deadline:
+            return None
+        return process_scoring(*args, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=max(1, SCORING_MAX_CONCURRENCY)) as executor:
+        futures = {}
+        for position, image_id in enumerate(unique_ids):
+            snapshot = snapshots.get(image_id)
+            if not snapshot or not snapshot.exists:
+                summary["not_found"] += 1
+                yield {"image_id": image_id, "status": "not_found"}
+                continue
+
+            data = snapshot.to_dict()
+            if data.get("deleted_at") or not data.get("user_id"):
+                summary["skipped"] += 1
+                yield {"image_id": image_id, "status": "skipped"}
+                continue
+
+            future = executor.submit(
+                score_item,
+                image_id,
+                data["user_id"],
+                f"{request_id}-{position}",
+                notify=notify,
+                **_stored_scoring_options(data),
+            )
+            futures[future] = image_id
+
+        for future in as_completed(futures):
+            image_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                summary["failed"] += 1
+                logger.warning(f"Bulk scoring failed for image {image_id}: {str(e)}")
+                yield {"image_id": image_id, "status": "error", "error": str(e)}
+                continue
+
+            if result is None:
+                summary["deferred"] += 1
+                deferred.add(image_id)
+                yield {"image_id": image_id, "status": "deferred"}
+                continue
+
+            scores = result["scores"]
+
+            summary["succeeded"] += 1
+            yield {
+                "image_id": image_id,
+                "status": "success",
+                "total_score": scores.get("total_score"),
+                "smile_score": scores.get("smile_score"),
+                "ai_score": scores.get("ai_score"),
+                "is_similar": scores.get("is_similar"),
+            }
+
+    logger.info(
+        "Bulk scoring completed",
+        extra={
+            **summary,
+            "request_id": request_id,
+            "notify": notify,
+            "elapsed_time": round(time.time() - start_time, 2),
+            "event": "bulk_scoring_completed",
+        },
+    )
+    remaining_image_ids = [image_id for image_id in unique_ids if image_id in deferred]
+    yield {"summary": summary, "remaining_image_ids": remaining_image_ids, "request_id": request_id}
+
+
+def _record_backlog_progress(transaction, event_id: str, completed: bool = True):
+    """
+    Count an image leaving pending in the event's scoring backlog gauge.
+
+    Decrements the pending count the webhook incremented and, for images that
+    went through scoring, counts the image in the current minute's completion
+    bucket. Called inside the transaction that moves the image out of pending
+    (scored, poisoned or discarded), so each image drains the gauge exactly
+    once however often it is re-driven.
+
+    Args:
+        transaction: Firestore transaction moving the image out of pending
+        event_id: Event ID of the gauge
+        completed: False for images dropped without scoring, which do not
+            count toward throughput
+    """
+    updates = {"pending": firestore.Increment(-1), "updated_at": firestore.SERVER_TIMESTAMP}
+    if completed:
+        updates["completed_minutes"] = {datetime.now(UTC).strftime("%Y%m%d%H%M"): firestore.Increment(1)}
+    transaction.set(db.collection("scoring_backlog").document(event_id), updates, merge=True)
+
+
+def prune_backlog_buckets(event_id: str):
+    """
+    Remove completion buckets older than BACKLOG_BUCKET_RETENTION_MINUTES from the gauge.
+
+    Runs at most once per minute per event on this instance (one gauge read,
+    plus a write when stale buckets exist). Errors are logged and ignored.
+    """
+    now = datetime.now(UTC)
+    bucket = now.strftime("%Y%m%d%H%M")
+    with _backlog_pruned_buckets_lock:
+        if _backlog_pruned_buckets.get(event_id) == bucket:
+            return
+        _backlog_pruned_buckets[event_id] = bucket
+        _backlog_pruned_buckets.move_to_end(event_id)
+        while len(_backlog_pruned_buckets) > BACKLOG_PRUNE_CACHE_MAX_ENTRIES:
+            _backlog_pruned_buckets.popitem(last=False)
+
+    cutoff = (now - timedelta(minutes=BACKLOG_BUCKET_RETENTION_MINUTES)).strftime("%Y%m%d%H%M")
+    try:
+        gauge_ref = db.collection("scoring_backlog").document(event_id)
+        snapshot = gauge_ref.get(["completed_minutes"])
+        buckets = (snapshot.to_dict() or {}).get("completed_minutes") or {}
+        # Bucket keys start with digits, so they are quoted in the field path
+        expired = {f"completed_minutes.`{key}`": firestore.DELETE_FIELD for key in buckets if key <= cutoff}
+        if expired:
+            gauge_ref.update(expired)
+    except Exception as e:
+        logger.warning(f"Failed to prune backlog gauge for event {event_id}: {str(e)}")
+
+
+def refresh_expiring_signed_urls(
+    window_hours: int = URL_REFRESH_WINDOW_HOURS,
+    dry_run: bool = False,
+    page_size: int = URL_REFRESH_PAGE_SIZE,
+    on_progress=None,
+) -> dict[str, int]:
+    """
+    Re-sign storage URLs of images whose signed URL expires within window_hours.
+
+    Images are read page by page in storage_url_expires_at order, signed in
+    parallel with generate_signed_urls(), and written back with a BulkWriter.
+    Images past their retention (expire_at) or soft-deleted are skipped since
+    their storage objects are gone or hidden.
+
+    Args:
+        window_hours: Refresh URLs expiring within this many hours (already expired ones included)
+        dry_run: If True, only count candidates without signing or writing
+        page_size: Number of image documents processed per page
+        on_progress: Optional callback receiving the number of documents processed in each page
+
+    Returns:
+        Dict with scanned, refreshed, skipped, and failed counts
+    """
+    now = datetime.now(UTC)
+    cutoff = now + timedelta(hours=window_hours)
+    stats = {"scanned": 0, "refreshed": 0, "skipped": 0, "failed": 0}
+    start_time = time.time()
+
+    base_query = (
+        db.collection("images")
+        .where(filter=firestore.FieldFilter("storage_url_expires_at", "<", cutoff))
+        .order_by("storage_url_expires_at")
+        .limit(page_size)
+    )
+    last_doc = None
+
+    while True:
+        query = base_query.start_after(last_doc) if last_doc else base_query
+        docs = list(query.stream())
+        if not docs:
+            break
+        last_doc = docs[-1]
+
+        candidates: dict[str, object] = {}
+        for doc in docs:
+            data = doc.to_dict()
+            expire_at = data.get("expire_at")
+            if data.get("deleted_at") or not data.get("storage_path") or (expire_at and expire_at <= now):
+                stats["skipped"] += 1
+                continue
+            candidates[data["storage_path"]] = doc.reference
+
+        stats["scanned"] += len(docs)
+
+        if dry_run:
+            stats["refreshed"] += len(candidates)
+        elif candidates:
+            signed = generate_signed_urls(STORAGE_BUCKET, list(candidates))
+            writer = db.bulk_writer()
+            for storage_path, (signed_url, expiration_time) in signed.items():
+                writer.update(
+                    candidates[storage_path],
+                    {"storage_url": signed_url, "storage_url_expires_at": expiration_time},
+                )
+            writer.close()
+            stats["refreshed"] += len(signed)
+            stats["failed"] += len(candidates) - len(signed)
+
+        logger.info(
+            "Signed URL refresh page processed",
+            extra={**stats, "dry_run": dry_run, "event": "url_refresh_progress"},
+        )
+        if on_progress:
+            on_progress(len(docs))
+
+        if len(docs) < page_size:
+            break
+
+    logger.info(
+        "Signed URL refresh completed",
+        extra={
+            **stats,
+            "dry_run": dry_run,
+            "window_hours": window_hours,
+            "elapsed_time": round(time.time() - start_time, 2),
+            "event": "url_refresh_completed",
+        },
+    )
+    return stats
+
+
+@functions_framework.http
+def url_refresh(request: Request):
+    """
+    Cloud Functions HTTP entrypoint for the scheduled signed URL refresh.
+
+    Optional JSON body: {"window_hours": 48, "dry_run": false}
+
+    Returns:
+        JSON response with refresh counts
+    """
+    request_json = request.get_json(silent=True) or {}
+
+    try:
+        window_hours = int(request_json.get("window_hours", URL_REFRESH_WINDOW_HOURS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "window_hours must be an integer"}), 400
+    dry_run = bool(request_json.get("dry_run", False))
+
+    try:
+        stats = refresh_expiring_signed_urls(window_hours=window_hours, dry_run=dry_run)
+    except Exception as e:
+        logger.error(f"Signed URL refresh failed: {str(e)}", exc_info=True)
+        return jsonify({"status": "error", "error": str(e)}), 500
+
+    return jsonify({"status": "success", "dry_run": dry_run, **stats}), 200
+
+
+@firestore.transactional
+def _poison_image_transaction(transaction, image_ref, event_id: str | None) -> bool:
+    """Mark a still-pending image poisoned; returns False if it left pending meanwhile."""
+    snapshot = image_ref.get(transaction=transaction)
+    if not snapshot.exists or (snapshot.to_dict() or {}).get("status") != "pending":
+        return False
+
+    transaction.update(image_ref, {"status": "poisoned", "poisoned_at": firestore.SERVER_TIMESTAMP})
+    if event_id:
+        _record_backlog_progress(transaction, event_id)
+    return True
+
+
+@firestore.transactional
+def _discard_image_transaction(transaction, image_ref, event_id: str | None) -> bool:
+    """Mark a soft-deleted pending image discarded; returns False if it left pending meanwhile."""
+    snapshot = image_ref.get(transaction=transaction)
+    if not snapshot.exists or (snapshot.to_dict() or {}).get("status") != "pending":
+        return False
+
+    transaction.update(image_ref, {"status": "discarded", "discarded_at": firestore.SERVER_TIMESTAMP})
+    if event_id:
+        _record_backlog_progress(transaction, event_id, completed=False)
+    return True
+
+
+def _poison_image(doc, data: dict, dry_run: bool):
+    """Give up on an image: mark it poisoned and tell the user scoring failed."""
+    if dry_run:
+        return
+
+    event_id = data.get("event_id")
+    if not _poison_image_transaction(db.transaction(), doc.reference, event_id):
+        logger.info(f"Image {doc.id} left pending before it was poisoned")
+        return
+    if event_id:
+        prune_backlog_buckets(event_id)
+
+    try:
+        if data.get("image_set_id"):
+            record_image_set_result(data["image_set_id"], doc.id, None)
+        else:
+            send_error_to_line(data["user_id"])
+    except Exception as e:
+        logger.warning(f"Failed to notify user about poisoned image {doc.id}: {str(e)}")
+
+
+def _redrive_image(doc, data: dict) -> bool:
+    """Count a reconcile attempt and run the image through the scoring path again."""
+    doc.reference.update(
+        {"reconcile_attempts": firestore.Increment(1), "last_reconciled_at": firestore.SERVER_TIMESTAMP}
+    )
+    try:
+        process_scoring(
+            doc.id,
+            data["user_id"],
+            f"reconcile-{uuid.uuid4()}",
+            **_stored_scoring_options(data),
+        )
+        return True
+    except Exception as e:
+        logger.warning(f"Re-driven scoring failed for image {doc.id}: {str(e)}")
+        try:
+            doc.reference.update({"last_error": str(e)[:500]})
+        except Exception:
+            pass
+        return False
+
+
+def reconcile_pending_images(
+    stale_minutes: int = RECONCILE_STALE_MINUTES,
+    max_attempts: int = RECONCILE_MAX_ATTEMPTS,
+    dry_run: bool = False,
+    page_size: int = RECONCILE_PAGE_SIZE,
+    max_workers: int = RECONCILE_MAX_WORKERS,
+    on_progress=None,
+) -> dict[str, int]:
+    """
+    Re-drive images stuck in "pending" through the scoring path.
+
+    Images are read page by page with the (status, upload_timestamp) index and
+    re-scored with at most max_workers in parallel. Each attempt is counted in
+    reconcile_attempts; images that already used max_attempts are marked
+    "poisoned" instead. Soft-deleted images are marked "discarded" without
+    scoring, and images without a user are skipped.
+
+    Args:
+        stale_minutes: Only images uploaded at least this many minutes ago are considered
+        max_attempts: Re-drive attempts before an image is poisoned
+        dry_run: If True, only count candidates without scoring or writing
+        page_size: Number of image documents processed per page
+        max_workers: Concurrent re-driven scorings
+        on_progress: Optional callback receiving the number of documents processed in each page
+
+    Returns:
+        Dict with scanned, redriven, succeeded, failed, poisoned, discarded and
+        skipped counts
+    """
+    cutoff = datetime.now(UTC) - timedelta(minutes=stale_minutes)
+    stats = {"scanned": 0, "redriven": 0, "succeeded": 0, "failed": 0, "poisoned": 0, "discarded": 0, "skipped": 0}
+    start_time = time.time()
+
+    base_query = (
+        db.collection("images")
+        .where(filter=firestore.FieldFilter("status", "==", "pending"))
+        .where(filter=firestore.FieldFilter("upload_timestamp", "<", cutoff))
+        .order_by("upload_timestamp")
+        .limit(page_size)
+    )
+    last_doc = None
+
+    while True:
+        query = base_query.start_after(last_doc) if last_doc else base_query
+        docs = list(query.stream())
+        if not docs:
+            break
+        last_doc = docs[-1]
+        stats["scanned"] += len(docs)
+
+        redrive = []
+        for doc in docs:
+            data = doc.to_dict()
+            if data.get("deleted_at"):
+                if not dry_run:
+                    _discard_image_transaction(db.transaction(), doc.reference, data.get("event_id"))
+                stats["discarded"] += 1
+            elif not data.get("user_id"):
+                stats["skipped"] += 1
+            elif data.get("reconcile_attempts", 0) >= max_attempts:
+                _poison_image(doc, data, dry_run)
+                stats["poisoned"] += 1
+            else:
+                redrive.append((doc, data))
+
+        stats["redriven"] += len(redrive)
+        if not dry_run and redrive:
+            with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+                results = list(executor.map(lambda item: _redrive_image(*item), redrive))
+            stats["succeeded"] += sum(results)
+            stats["failed"] += len(results) - sum(results)
+
+        logger.info(
+            "Pending image reconcile page processed",
+            extra={**stats, "dry_run": dry_run, "event": "reconcile_progress"},
+        )
+        if on_progress:
+            on_progress(len(docs))
+
+        if len(docs) < page_size:
+            break
+
+    logger.info(
+        "Pending image reconcile completed",
+        extra={
+            **stats,
+            "dry_run": dry_run,
+            "stale_minutes": stale_minutes,
+            "elapsed_time": round(time.time() - start_time, 2),
+            "event": "reconcile_completed",
+        },
+    )
+    return stats
+
+
+@functions_framework.http
+def reconcile_pending(request: Request):
+    """
+    Cloud Functions HTTP entrypoint for the scheduled pending-image reconciler.
+
+    Optional JSON body: {"stale_minutes": 10, "max_attempts": 3, "dry_run": false}
+
+    Returns:
+        JSON response with reconcile counts
+    """
+    request_json = request.get_json(silent=True) or {}
+
+    try:
+        stale_minutes = int(request_json.get("stale_minutes", RECONCILE_STALE_MINUTES))
+        max_attempts = int(request_json.get("max_attempts", RECONCILE_MAX_ATTEMPTS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "stale_minutes and max_attempts must be integers"}), 400
+    dry_run = bool(request_json.get("dry_run", False))
+
+    try:
+        stats = reconcile_pending_images(stale_minutes=stale_minutes, max_attempts=max_attempts, dry_run=dry_run)
+    except Exception as e:
+        logger.error(f"Pending image reconcile failed: {str(e)}", exc_info=True)
+        return jsonify({"status": "error", "error": str(e)}), 500
+
+    return jsonify({"status": "success", "dry_run": dry_run, **stats}), 200
+
+
 def get_joy_likelihood_score(joy_likelihood, detection_confidence: float) -> float:
     """
     Convert joy likelihood enum to numeric score with detection_confidence adjustment.
@@ -367,11 +1423,11 @@ def calculate_smile_score(image_bytes: bytes) -> dict[str, Any]:
 
     for attempt in range(max_retries):
         try:
-            # Create Vision API image object
-            image = vision.Image(content=image_bytes)
-
-            # Detect faces
-            response = vision_client.face_detection(image=image)
+            # Detect faces (shared batch request when micro-batching is enabled)
+            if VISION_BATCH_MAX_SIZE > 1:
+                response = face_detection_batcher.detect_faces(image_bytes)
+            else:
+                response = vision_client.face_detection(image=vision.Image(content=image_bytes))
 
             if response.error.message:
                 raise Exception(f"Vision API error: {response.error.message}")
@@ -452,6 +1508,40 @@ def calculate_smile_score(image_bytes: bytes) -> dict[str, Any]:
     }
 
 
+def decode_inline_image(request_json: dict[str, Any]) -> bytes | None:
+    """
+    Decode an image handed over inline in a scoring request.
+
+    The webhook sends small images as base64 with their SHA-256 so scoring can
+    skip downloading the object it just uploaded.
+
+    Args:
+        request_json: Scoring request body
+
+    Returns:
+        Image bytes, or None if absent or invalid (caller falls back to Cloud Storage)
+    """
+    encoded = request_json.get("image_base64")
+    if not encoded:
+        return None
+
+    try:
+        image_bytes = base64.b64decode(encoded, validate=True)
+    except (binascii.Error, ValueError) as e:
+        logger.warning(f"Invalid inline image, falling back to Storage: {str(e)}")
+        return None
+
+    if len(image_bytes) > INLINE_IMAGE_MAX_BYTES:
+        logger.warning(f"Inline image exceeds {INLINE_IMAGE_MAX_BYTES} bytes, falling back to Storage")
+        return None
+
+    if hashlib.sha256(image_bytes).hexdigest() != request_json.get("image_sha256"):
+        logger.warning("Inline image checksum mismatch, falling back to Storage")
+        return None
+
+    return image_bytes
+
+
 def download_image_from_storage(storage_path: str) -> bytes:
     """
     Download image from Cloud Storage.
@@ -737,7 +1827,9 @@ Example outputs (showing variety):
     }
 
 
-def generate_scores_with_vision_api(image_id: str, request_id: str) -> dict[str, Any]:
+def generate_scores_with_vision_api(
+    image_id: str, request_id: str, image_bytes: bytes | None = None, on_smile_score=None
+) -> dict[str, Any]:
     """
     Generate scores using Vision API for smile detection, Vertex AI for theme evaluation,
     and Average Hash for similarity detection.
@@ -748,6 +1840,11 @@ def generate_scores_with_vision_api(image_id: str, request_id: str) -> dict[str,
     Args:
         image_id: Image document ID in Firestore
         request_id: Request ID for tracing
+        image_bytes: Image handed over inline by the webhook (downloaded from
+            Cloud Storage when None)
+        on_smile_score: Optional callback receiving (line_user_id, vision_result)
+            as soon as Vision finishes, while Vertex AI may still be running.
+            Not called for images whose result was already delivered.
 
     Returns:
         Dictionary with scoring data
@@ -786,19 +1883,25 @@ def generate_scores_with_vision_api(image_id: str, request_id: str) -> dict[str,
         user_data = user_doc.to_dict()
         line_user_id = user_data.get("line_user_id")
 
-    # Download image from Cloud Storage
-    download_start = time.time()
-    image_bytes = download_image_from_storage(storage_path)
-    download_time = time.time() - download_start
+    # Download image from Cloud Storage unless it was handed over inline
+    if image_bytes is not None:
+        logger.info(
+            "Using inline image",
+            extra={**log_context, "size_bytes": len(image_bytes), "event": "image_inline"},
+        )
+    else:
+        download_start = time.time()
+        image_bytes = download_image_from_storage(storage_path)
+        download_time = time.time() - download_start
 
-    logger.info(
-        "Image downloaded from storage",
-        extra={
-            **log_context,
-            "elapsed_time": round(download_time, 2),
-            "event": "image_downloaded",
-        },
-    )
+        logger.info(
+            "Image downloaded from storage",
+            extra={
+                **log_context,
+                "elapsed_time": round(download_time, 2),
+                "event": "image_downloaded",
+            },
+        )
 
     # Execute Vision API, Vertex AI, and Average Hash calculations in parallel
     logger.info(
@@ -815,6 +1918,8 @@ def generate_scores_with_vision_api(image_id: str, request_id: str) -> dict[str,
 
         # Wait for all tasks to complete
         vision_result = vision_future.result()
+        if on_smile_score and not image_data.get("notified_at"):
+            on_smile_score(line_user_id, vision_result)
         theme_result = theme_future.result()
         average_hash = hash_future.result()
 
@@ -891,6 +1996,8 @@ def generate_scores_with_vision_api(image_id: str, request_id: str) -> dict[str,
         "line_user_id": line_user_id,  # Cache LINE user ID to avoid duplicate Firestore read
         "event_id": event_id,  # Cache event_id for composite key construction
         "storage_path": storage_path,  # Cache storage_path for signed URL generation
+        "storage_url_expires_at": image_data.get("storage_url_expires_at"),  # Skip re-signing if still valid
+        "notified_at": image_data.get("notified_at"),  # Result already delivered (re-driven image)
     }
 
     # Add error flags if any occurred
@@ -978,10 +2085,14 @@ def update_firestore(image_id: str, user_id: str, scores: dict[str, Any]):
         logger.warning(f"No event_id in scores for image {image_id}, falling back to user_id as doc key")
         user_ref = db.collection("users").document(user_id)
 
-    # Generate signed URL for the image
+    # Generate signed URL for the image unless the webhook already stored a valid one
     signed_url_data = None
-    storage_path = scores.get("storage_path")
-    if storage_path:
+    storage_path = scores.get("storage_path") if STORE_SIGNED_URLS else None
+    if storage_path and not needs_signed_url(scores.get("storage_url_expires_at")):
+        with _signing_lock:
+            signing_stats["skipped"] += 1
+        logger.info(f"Reusing existing signed URL for image {image_id}")
+    elif storage_path:
         try:
             signed_url, expiration_time = generate_signed_url(STORAGE_BUCKET, storage_path)
             signed_url_data = {
@@ -1025,6 +2136,11 @@ def _update_image_and_user_stats(transaction, image_ref, user_ref, scores: dict,
     # IMPORTANT: All reads must come before any writes in a transaction
     # Read user document first to get current best score
     user_doc = user_ref.get(transaction=transaction)
+    # Rescoring an already completed image must not count it as a new upload,
+    # and only the first transition out of pending drains the backlog gauge
+    image_doc = image_ref.get(transaction=transaction)
+    previous_status = (image_doc.to_dict() or {}).get("status") if image_doc.exists else None
+    already_counted = previous_status == "completed"
 
     # Build image update data
     image_update = {
@@ -1044,6 +2160,9 @@ def _update_image_and_user_stats(transaction, image_ref, user_ref, scores: dict,
         image_update["storage_url"] = signed_url_data["storage_url"]
         image_update["storage_url_expires_at"] = signed_url_data["storage_url_expires_at"]
 
+    if previous_status == "pending" and scores.get("event_id"):
+        _record_backlog_progress(transaction, scores["event_id"])
+
     if not user_doc.exists:
         logger.warning(f"User document not found: {user_ref.id}")
         # Still update the image document even if user not found
@@ -1059,7 +2178,10 @@ def _update_image_and_user_stats(transaction, image_ref, user_ref, scores: dict,
     transaction.update(image_ref, image_update)
 
     # Update user statistics
-    transaction.update(user_ref, {"total_uploads": firestore.Increment(1), "best_score": new_best})
+    user_update = {"best_score": new_best}
+    if not already_counted:
+        user_update["total_uploads"] = firestore.Increment(1)
+    transaction.update(user_ref, user_update)
 
 
 def _send_line_message_with_retry(line_user_id: str, message, max_retries: int = 3):
@@ -1070,12 +2192,15 @@ def _send_line_message_with_retry(line_user_id: str, message, max_retries: int =
         line_user_id: LINE user ID
         message: LINE message object
         max_retries: Maximum number of retry attempts (default: 3)
+
+    Returns:
+        True if the message was sent, False otherwise
     """
     for attempt in range(max_retries):
         try:
             messaging_api.push_message(PushMessageRequest(to=line_user_id, messages=[message]))
             logger.info(f"Successfully sent message to LINE user: {line_user_id}")
-            return
+            return True
 
         except ApiException as e:
             is_last_attempt = attempt == max_retries - 1
@@ -1100,7 +2225,7 @@ def _send_line_message_with_retry(line_user_id: str, message, max_retries: int =
                 f"LINE API error (final, status={e.status}): {e.reason}",
                 exc_info=True,
             )
-            return
+            return False
 
         except Exception as e:
             is_last_attempt = attempt == max_retries - 1
@@ -1118,23 +2243,27 @@ def _send_line_message_with_retry(line_user_id: str, message, max_retries: int =
                 f"Failed to send LINE message after {max_retries} attempts: {str(e)}",
                 exc_info=True,
             )
-            return
+            return False
 
 
-def send_result_to_line(user_id: str, scores: dict[str, Any]):
+def send_result_to_line(user_id: str, scores: dict[str, Any], follow_up: bool = False) -> bool:
     """
     Send scoring result to LINE user.
 
     Args:
         user_id: User ID (Firestore document ID, not LINE user ID)
         scores: Scoring results (includes cached line_user_id)
+        follow_up: Whether the smile score was already pushed (two-phase delivery)
+
+    Returns:
+        True if the message was sent, False otherwise
     """
     # Use cached LINE user ID from scores to avoid duplicate Firestore read
     line_user_id = scores.get("line_user_id")
 
     if not line_user_id:
         logger.error(f"LINE user ID not found in scores for user: {user_id}")
-        return
+        return False
 
     # Build message with face count display
     face_count_display = format_face_count(scores["smiling_faces"], scores["face_count"])
@@ -1155,9 +2284,160 @@ def send_result_to_line(user_id: str, scores: dict[str, Any]):
             f"💬 {scores['comment']}"
         )
 
+    if follow_up:
+        message_text = f"🎨 AI評価が出ました！\n\n{message_text}"
+
     # Send message with retry logic
     message = TextMessage(text=message_text)
-    _send_line_message_with_retry(line_user_id, message)
+    return _send_line_message_with_retry(line_user_id, message)
+
+
+@firestore.transactional
+def _record_image_set_result_transaction(
+    transaction, set_ref, image_id: str | None, result: dict | None
+) -> dict | None:
+    """
+    Add one image outcome to an image set and claim the combined notification.
+
+    Outcomes are keyed by image_id, so a retried or re-driven scoring replaces
+    the earlier outcome of its image instead of counting it twice: a result
+    replaces an earlier result or failure, and a failure is ignored once the
+    image has one. Ingest failures counted by the webhook stay in "failed".
+    The notification is claimed with notifying_at; "notified" is only set
+    once the push succeeded.
+
+    Returns:
+        The set data if every image is accounted for and this call claimed the
+        notification, None otherwise
+    """
+    snapshot = set_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+
+    data = snapshot.to_dict()
+    results = data.get("results", [])
+    failed_image_ids = data.get("failed_image_ids", [])
+    updates = {}
+    if result:
+        data["results"] = [r for r in results if r.get("image_id") != image_id] + [result]
+        updates["results"] = data["results"]
+        if image_id in failed_image_ids:
+            data["failed_image_ids"] = [i for i in failed_image_ids if i != image_id]
+            updates["failed_image_ids"] = data["failed_image_ids"]
+    elif image_id and image_id not in failed_image_ids and all(r.get("image_id") != image_id for r in results):
+        data["failed_image_ids"] = failed_image_ids + [image_id]
+        updates["failed_image_ids"] = data["failed_image_ids"]
+
+    done = (
+        len(data.get("results", []))
+        + len(data.get("failed_image_ids", []))
+        + data.get("skipped", 0)
+        + data.get("rate_limited", 0)
+        + data.get("duplicates", 0)
+        + data.get("failed", 0)
+    )
+    notifying_at = data.get("notifying_at")
+    claimed = (
+        done >= (data.get("total") or 0)
+        and not data.get("notified")
+        and not (notifying_at and datetime.now(UTC) - notifying_at < timedelta(seconds=IMAGE_SET_NOTIFY_CLAIM_SECONDS))
+    )
+    if claimed:
+        updates["notifying_at"] = firestore.SERVER_TIMESTAMP
+
+    if updates:
+        transaction.update(set_ref, updates)
+    return data if claimed else None
+
+
+def record_image_set_result(
+    image_set_id: str,
+    image_id: str | None = None,
+    scores: dict[str, Any] | None = None,
+    index: int | None = None,
+) -> bool:
+    """
+    Record the outcome of one image of a multi-image send.
+
+    When the last image of the set is recorded, one combined result message is
+    pushed instead of a message per image.
+
+    Args:
+        image_set_id: LINE imageSet ID (image_sets document ID)
+        image_id: Image document ID (None to only check completion)
+        scores: Scoring results, or None if scoring failed
+        index: 1-based position of the image within the set
+
+    Returns:
+        False if this call pushed the combined result and the push failed
+        (the claim is released so a retry sends it), True otherwise
+    """
+    result = None
+    if image_id and scores:
+        result = {
+            "image_id": image_id,
+            "index": index,
+            "total_score": scores["total_score"],
+            "is_similar": scores["is_similar"],
+        }
+
+    set_ref = db.collection("image_sets").document(image_set_id)
+    data = _record_image_set_result_transaction(db.transaction(), set_ref, image_id, result)
+    if not data:
+        return True
+
+    sent = send_image_set_result_to_line(data)
+    updates = {"notifying_at": firestore.DELETE_FIELD}
+    if sent:
+        updates["notified"] = True
+    try:
+        set_ref.update(updates)
+    except Exception as e:
+        logger.warning(f"Failed to update notification state of image set {image_set_id}: {str(e)}")
+    if not sent:
+        logger.error(f"Failed to send combined result for image set {image_set_id}")
+    return sent
+
+
+def send_image_set_result_to_line(set_data: dict[str, Any]) -> bool:
+    """
+    Send the combined scoring result of a multi-image send to LINE.
+
+    Args:
+        set_data: image_sets document data (user_id is the LINE user ID)
+
+    Returns:
+        True if the message was sent or there was nothing to send, False otherwise
+    """
+    results = sorted(set_data.get("results", []), key=lambda r: r.get("index") or 0)
+    failed = set_data.get("failed", 0) + len(set_data.get("failed_image_ids", []))
+
+    if not results and not failed:
+        if set_data.get("duplicates"):
+            message_text = f"📸 {set_data['duplicates']}枚ともすでに投稿済みの写真です！"
+            return _send_line_message_with_retry(set_data["user_id"], TextMessage(text=message_text))
+        # Otherwise every image was rejected up front (upload or rate limit), already replied
+        return True
+
+    if not results:
+        message_text = "❌ 画像の処理に失敗しました。\n\nもう一度お試しください。"
+    else:
+        best = max(r["total_score"] for r in results)
+        lines = [f"📸 {len(results)}枚の写真をスコアリングしました！\n", f"🏆 ベスト: {best}点\n"]
+        for position, r in enumerate(results, start=1):
+            penalty = "（類似写真ペナルティ）" if r.get("is_similar") else ""
+            lines.append(f"{r.get('index') or position}枚目: {r['total_score']}点{penalty}")
+        if set_data.get("duplicates"):
+            lines.append(f"\n🔁 {set_data['duplicates']}枚は投稿済みの写真と同じでした")
+        if set_data.get("skipped"):
+            lines.append(f"\n⚠️ {set_data['skipped']}枚は投稿上限のため受け付けられませんでした")
+        if set_data.get("rate_limited"):
+            lines.append(f"\n⏳ {set_data['rate_limited']}枚は送信ペースが速すぎたため受け付けられませんでした")
+        if failed:
+            lines.append(f"\n❌ {failed}枚は処理できませんでした")
+        message_text = "\n".join(lines)
+
+    return _send_line_message_with_retry(set_data["user_id"], TextMessage(text=message_text))
 
 
 def send_error_to_line(user_id: str):
@@ -4,17 +4,27 @@ Handles LINE Bot webhook events for user registration and image uploads.
 Multi-tenant: users join events via JOIN {event_code} command.
 """
 
+import base64
+import hashlib
+import io
 import logging
 import os
 import re
+import tempfile
+import threading
 import time
 import uuid
+from collections import OrderedDict, deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import UTC, datetime, timedelta
+from itertools import groupby
 
 import functions_framework
 import google.auth
 import requests
 from flask import Request, jsonify
+from google.api_core.exceptions import Conflict, NotFound
 from google.auth import impersonated_credentials as imp_creds
 from google.auth.transport.requests import Request as AuthRequest
 from google.cloud import firestore, storage
@@ -42,6 +52,8 @@ from linebot.v3.webhooks import (
     UnsendEvent,
     VideoMessageContent,
 )
+from PIL import Image as PILImage
+from PIL import ImageOps, UnidentifiedImageError
 
 # Initialize logging
 logger = logging.getLogger(__name__)
@@ -101,6 +113,21 @@ messaging_api = MessagingApi(api_client)
 messaging_api_blob = MessagingApiBlob(api_client)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
+# Event handlers by (event type, message content type or None). dispatch_events
+# resolves handlers here rather than in WebhookHandler's private tables.
+_event_handlers: dict[tuple[type, type | None], Callable] = {}
+
+
+def on_event(event_type: type, message: type | None = None):
+    """Register an event handler for dispatch_events (and WebhookHandler.handle)."""
+
+    def decorator(func):
+        _event_handlers[(event_type, message)] = func
+        return handler.add(event_type, message=message)(func)
+
+    return decorator
+
+
 # Pattern for JOIN command (case-insensitive)
 JOIN_PATTERN = re.compile(r"^JOIN\s+(.+)$", re.IGNORECASE)
 
@@ -112,10 +139,173 @@ EVENT_CODE_MAX_LENGTH = 100
 
 # Signed URL configuration (7 days - sufficient for wedding event + post-event viewing)
 SIGNED_URL_EXPIRATION_HOURS = 168
+# Existing URLs with at least this much validity left are reused instead of re-signed
+SIGNED_URL_MIN_REMAINING_HOURS = 24
+SIGNING_MAX_WORKERS = 8
+
+# Persist week-long signed URLs on image documents. When disabled, clients load
+# images through the image_redirect endpoint instead.
+STORE_SIGNED_URLS = os.environ.get("STORE_SIGNED_URLS", "true").lower() == "true"
+
+# On-demand image redirect: short-lived signatures, cached per instance
+IMAGE_URL_TTL_HOURS = int(os.environ.get("IMAGE_URL_TTL_HOURS", "1"))
+IMAGE_URL_CACHE_MAX_AGE_SECONDS = 600
+IMAGE_URL_CACHE_MAX_ENTRIES = 2048
+IMAGE_ID_PATTERN = re.compile(r"^[a-zA-Z0-9\-_]{1,128}$")
+
+# Cached signing credentials and signing metrics (per instance)
+_signing_credentials = None
+_signing_lock = threading.Lock()
+signing_stats = {"signed": 0, "failed": 0, "skipped": 0, "total_seconds": 0.0}
+
+# image_id -> (signed_url, valid_until as time.monotonic())
+_image_url_cache: OrderedDict[str, tuple[str, float]] = OrderedDict()
+_image_url_cache_lock = threading.Lock()
+image_url_cache_stats = {"hits": 0, "misses": 0}
+
+# Webhook processing mode: "sync" runs handlers inside the LINE request,
+# "deferred" persists the raw delivery, acknowledges immediately and lets
+# webhook_worker (Firestore-triggered) run the handlers
+WEBHOOK_PROCESSING_MODE = os.environ.get("WEBHOOK_PROCESSING_MODE", "sync")
+WEBHOOK_DELIVERY_RETENTION_DAYS = 7
+
+# Failed deliveries are retried by Eventarc up to this many attempts; a delivery
+# left in processing longer than the stale threshold (worker timeout plus
+# margin) belongs to a crashed worker and may be claimed again
+WEBHOOK_DELIVERY_MAX_ATTEMPTS = int(os.environ.get("WEBHOOK_DELIVERY_MAX_ATTEMPTS", "5"))
+WEBHOOK_DELIVERY_STALE_SECONDS = 90
+
+# Events of different users in one delivery are processed concurrently
+WEBHOOK_DISPATCH_MAX_WORKERS = int(os.environ.get("WEBHOOK_DISPATCH_MAX_WORKERS", "4"))
+
+# Images of one multi-image send (imageSet) are ingested concurrently
+IMAGE_SET_MAX_WORKERS = 5
+
+# Idempotency: processed webhookEventIds (LINE redelivers on timeouts). A claim
+# left in processing longer than the handler timeout (function timeout plus
+# margin) belongs to a crashed handler and may be taken over
+WEBHOOK_EVENT_TTL_HOURS = 72
+WEBHOOK_EVENT_CLAIM_TIMEOUT_SECONDS = 90
+WEBHOOK_EVENT_CACHE_MAX_ENTRIES = 4096
+_seen_webhook_events: OrderedDict[str, None] = OrderedDict()
+_seen_webhook_events_lock = threading.Lock()
+
+# Cached ID token for invoking the scoring function (tokens are valid for 1 hour)
+SCORING_ID_TOKEN_TTL_SECONDS = 50 * 60
+_scoring_id_token: tuple[str, float] | None = None  # (token, fetched_at as time.monotonic())
+_scoring_id_token_lock = threading.Lock()
+
+# Streaming ingest of LINE content into Cloud Storage
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+LINE_CONTENT_URL = "https://api-data.line.me/v2/bot/message/{message_id}/content"
+CONTENT_READ_CHUNK_BYTES = 64 * 1024
+CONTENT_READ_TIMEOUT_SECONDS = 30
+
+# A digest entry whose image doc does not exist yet belongs to an upload still
+# being ingested until it is older than this (twice the webhook timeout)
+DIGEST_CLAIM_TIMEOUT_SECONDS = 120
+UPLOAD_CHUNK_BYTES = 1024 * 1024  # Resumable upload chunk (multiple of 256 KiB)
+
+# Images up to this size are also kept in memory and sent inline to scoring
+INLINE_IMAGE_MAX_BYTES = int(os.environ.get("INLINE_IMAGE_MAX_BYTES", str(4 * 1024 * 1024)))
+
+# Ingest transcoding: stored masters are JPEG, capped at this long edge (0 disables
+# downscaling). Images above INGEST_MAX_PIXELS are rejected before decoding, and
+# no more than INGEST_MAX_DECODE_PIXELS are ever decoded: oversized JPEGs decode
+# at a reduced DCT scale, other formats above it are rejected. 16 MP is 64 MiB
+# as RGBA plus the RGB copies, which fits the 512 MiB webhook together with the
+# spooled content in memory-backed /tmp.
+INGEST_MAX_LONG_EDGE = int(os.environ.get("INGEST_MAX_LONG_EDGE", "2048"))
+INGEST_JPEG_QUALITY = int(os.environ.get("INGEST_JPEG_QUALITY", "85"))
+INGEST_MAX_PIXELS = int(os.environ.get("INGEST_MAX_PIXELS", str(50_000_000)))
+INGEST_MAX_DECODE_PIXELS = int(os.environ.get("INGEST_MAX_DECODE_PIXELS", str(16_000_000)))
+PILImage.MAX_IMAGE_PIXELS = INGEST_MAX_PIXELS
 
 # Draft event upload limit per user
 DRAFT_UPLOAD_LIMIT = 5
 
+# A guest at the draft limit is counted again from images when no upload was
+# reserved for this long (nothing in flight). Deletions outside the webhook
+# (ranking page soft delete, admin hard delete) never decrement
+# users.active_uploads; clients may not write the counter
+DRAFT_RECOUNT_IDLE_SECONDS = 120
+
+# Join statuses of a guest's active registration, in lookup precedence
+ACTIVE_JOIN_STATUSES = ["pending_name", "registered"]
+
+# Scoring backlog gauge (scoring_backlog/{event_id}): the webhook increments
+# "pending" per stored image, scoring decrements it once when the image leaves
+# pending (unsend does when a pending image is deleted) and counts completions
+# in per-minute buckets. Loading replies mention
+# the wait above the threshold.
+BACKLOG_THROUGHPUT_WINDOW_MINUTES = 5
+BACKLOG_GAUGE_CACHE_SECONDS = 5
+BACKLOG_NOTICE_THRESHOLD_SECONDS = int(os.environ.get("BACKLOG_NOTICE_THRESHOLD_SECONDS", "60"))
+BACKLOG_DEFAULT_SECONDS_PER_IMAGE = 10
+# event_id -> (gauge, fetched_at as time.monotonic())
+_backlog_gauges: dict[str, tuple[dict, float]] = {}
+_backlog_gauges_lock = threading.Lock()
+
+# Per-user upload rate limits by event status: (burst, sustained) uploads allowed
+# within UPLOAD_BURST_WINDOW_SECONDS / UPLOAD_SUSTAINED_WINDOW_SECONDS (sliding)
+UPLOAD_BURST_WINDOW_SECONDS = 10
+UPLOAD_SUSTAINED_WINDOW_SECONDS = 60
+UPLOAD_RATE_LIMITS = {
+    "active": (
+        int(os.environ.get("UPLOAD_BURST_LIMIT", "20")),
+        int(os.environ.get("UPLOAD_SUSTAINED_LIMIT", "40")),
+    ),
+    "draft": (
+        int(os.environ.get("DRAFT_UPLOAD_BURST_LIMIT", "5")),
+        int(os.environ.get("DRAFT_UPLOAD_SUSTAINED_LIMIT", "10")),
+    ),
+}
+
+# Recent upload times per "{event_id}_{user_id}" (per instance, LRU); the
+# Firestore upload_rates collection is the shared, authoritative window
+UPLOAD_TIMES_MAX_ENTRIES = 4096
+_upload_times: OrderedDict[str, deque] = OrderedDict()
+_upload_times_lock = threading.Lock()
+upload_rate_stats = {"allowed": 0, "limited": 0, "limited_locally": 0}
+
+# Registered guests per instance: line_user_id -> (registration, valid_until as
+# time.monotonic()). Kept short since other instances may change the
+# registration (JOIN elsewhere, deactivation); this instance updates or drops
+# entries itself on JOIN, name registration and deactivation.
+REGISTRATION_CACHE_TTL_SECONDS = int(os.environ.get("REGISTRATION_CACHE_TTL_SECONDS", "15"))
+REGISTRATION_CACHE_MAX_ENTRIES = 4096
+_registration_cache: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+_registration_cache_lock = threading.Lock()
+registration_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+# Guests can join events in these states
+JOINABLE_EVENT_STATUSES = ["active", "draft"]
+
+# Joinable events per instance: event_code -> (event, valid_until as
+# time.monotonic()). Codes never move to another event, but the status can
+# change elsewhere (admin UI, archive script), so entries expire quickly.
+EVENT_CODE_CACHE_TTL_SECONDS = int(os.environ.get("EVENT_CODE_CACHE_TTL_SECONDS", "30"))
+EVENT_CODE_CACHE_MAX_ENTRIES = 1024
+_event_code_cache: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+_event_code_cache_lock = threading.Lock()
+event_code_cache_stats = {"hits": 0, "misses": 0, "fallbacks": 0}
+
+# Event metadata per instance: event_id -> (event, valid_until as
+# time.monotonic()), read by every upload. A status change elsewhere (admin
+# UI, archive script) is seen once the entry expires. With
+# EVENT_LISTENER_ENABLED, a Firestore listener on each cached event pushes
+# changes instead, so entries may live longer; listeners need CPU between
+# requests (always-allocated CPU), hence off by default.
+EVENT_CACHE_TTL_SECONDS = int(os.environ.get("EVENT_CACHE_TTL_SECONDS", "15"))
+EVENT_LISTENER_ENABLED = os.environ.get("EVENT_LISTENER_ENABLED", "false").lower() == "true"
+EVENT_LISTENER_TTL_SECONDS = int(os.environ.get("EVENT_LISTENER_TTL_SECONDS", "300"))
+EVENT_CACHE_MAX_ENTRIES = 256
+EVENT_LISTENER_MAX_EVENTS = 16
+_event_cache: OrderedDict[str, tuple[dict, float]] = OrderedDict()
+_event_watches: dict[str, object] = {}
+_event_cache_lock = threading.Lock()
+event_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0, "pushes": 0}
+
 
 def validate_user_name(name: str) -> tuple[bool, str | None]:
     """
@@ -163,6 +353,38 @@ def validate_event_code(code: str) -> tuple[bool, str | None]:
     return True, None
 
 
+def _get_signing_credentials():
+    """
+    Return (credentials, service_account_email) for IAM-based URL signing.
+
+    google.auth.default() is resolved once per instance; the cached credentials
+    are refreshed only when their access token has expired.
+    """
+    global _signing_credentials
+
+    with _signing_lock:
+        if _signing_credentials is None:
+            _signing_credentials, _project = google.auth.default()
+        if not _signing_credentials.valid:
+            _signing_credentials.refresh(AuthRequest())
+        credentials = _signing_credentials
+
+    # Compute Engine credentials only expose the real email after refresh
+    service_account_email = getattr(credentials, "service_account_email", None)
+    if not service_account_email or service_account_email == "default":
+        # Fallback for local development or other credential types
+        service_account_email = f"webhook-function-sa@{GCP_PROJECT_ID}.iam.gserviceaccount.com"
+
+    return credentials, service_account_email
+
+
+def needs_signed_url(expires_at: datetime | None) -> bool:
+    """Return True if a stored signed URL is missing or expires within SIGNED_URL_MIN_REMAINING_HOURS."""
+    if not expires_at:
+        return True
+    return expires_at - datetime.now(UTC) < timedelta(hours=SIGNED_URL_MIN_REMAINING_HOURS)
+
+
 def generate_signed_url(
     bucket_name: str, storage_path: str, expiration_hours: int = SIGNED_URL_EXPIRATION_HOURS
 ) -> tuple[str, datetime]:
@@ -180,36 +402,86 @@ def generate_signed_url(
     Returns:
         Tuple of (signed_url, expiration_time)
     """
+    start_time = time.time()
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(storage_path)
 
     expiration = timedelta(hours=expiration_hours)
     expiration_time = datetime.now(UTC) + expiration
 
-    # Get credentials and refresh if needed
-    credentials, project = google.auth.default()
-    if not credentials.valid:
-        credentials.refresh(google.auth.transport.requests.Request())
+    credentials, service_account_email = _get_signing_credentials()
 
-    # Get service account email for IAM signing
-    if hasattr(credentials, "service_account_email"):
-        service_account_email = credentials.service_account_email
-    else:
-        # Fallback for local development or other credential types
-        service_account_email = f"webhook-function-sa@{GCP_PROJECT_ID}.iam.gserviceaccount.com"
+    try:
+        url = blob.generate_signed_url(
+            version="v4",
+            expiration=expiration,
+            method="GET",
+            service_account_email=service_account_email,
+            access_token=credentials.token,
+        )
+    except Exception:
+        with _signing_lock:
+            signing_stats["failed"] += 1
+        raise
 
-    url = blob.generate_signed_url(
-        version="v4",
-        expiration=expiration,
-        method="GET",
-        service_account_email=service_account_email,
-        access_token=credentials.token,
-    )
+    elapsed_time = time.time() - start_time
+    with _signing_lock:
+        signing_stats["signed"] += 1
+        signing_stats["total_seconds"] += elapsed_time
 
-    logger.info(f"Generated signed URL for {storage_path}, expires at {expiration_time.isoformat()}")
+    logger.info(
+        f"Generated signed URL for {storage_path}, expires at {expiration_time.isoformat()}",
+        extra={"elapsed_time": round(elapsed_time, 3), "event": "signed_url_generated"},
+    )
     return url, expiration_time
 
 
+def generate_signed_urls(
+    bucket_name: str, storage_paths: list[str], expiration_hours: int = SIGNED_URL_EXPIRATION_HOURS
+) -> dict[str, tuple[str, datetime]]:
+    """
+    Generate signed URLs for many objects concurrently.
+
+    Each signature is a separate IAM signBlob call, so paths are signed in a
+    bounded thread pool sharing the cached credentials. Failures are logged and
+    left out of the result so callers can retry them later.
+
+    Args:
+        bucket_name: Name of the Cloud Storage bucket
+        storage_paths: Paths to the objects in the bucket
+        expiration_hours: URL validity period in hours (default: 168)
+
+    Returns:
+        Dict of storage_path -> (signed_url, expiration_time)
+    """
+    if not storage_paths:
+        return {}
+
+    start_time = time.time()
+    results: dict[str, tuple[str, datetime]] = {}
+
+    with ThreadPoolExecutor(max_workers=min(SIGNING_MAX_WORKERS, len(storage_paths))) as executor:
+        futures = {
+            executor.submit(generate_signed_url, bucket_name, path, expiration_hours): path for path in storage_paths
+        }
+        for future, path in futures.items():
+            try:
+                results[path] = future.result()
+            except Exception as e:
+                logger.warning(f"Failed to generate signed URL for {path}: {str(e)}")
+
+    logger.info(
+        "Signed URL batch completed",
+        extra={
+            "requested": len(storage_paths),
+            "signed": len(results),
+            "elapsed_time": round(time.time() - start_time, 2),
+            "event": "signed_url_batch_completed",
+        },
+    )
+    return results
+
+
 @functions_framework.http
 def webhook(request: Request):
     """
@@ -241,12 +513,25 @@ def webhook(request: Request):
 
     # Handle webhook body
     try:
-        handler.handle(body, signature)
+        if WEBHOOK_PROCESSING_MODE == "deferred" and _defer_delivery(body, signature, request_id):
+            logger.info(
+                "Webhook delivery deferred",
+                extra={"request_id": request_id, "event": "webhook_deferred"},
+            )
+        else:
+            stats = dispatch_events(body, signature)
+            if stats["failed"]:
+                # Failed events were released; a 5xx makes LINE redeliver them
+                logger.error(
+                    "Webhook events failed",
+                    extra={"request_id": request_id, **stats, "event": "webhook_events_failed"},
+                )
+                return jsonify({"error": f"{stats['failed']} of {stats['events']} events failed"}), 500
 
-        logger.info(
-            "Webhook processed successfully",
-            extra={"request_id": request_id, "event": "webhook_processed"},
-        )
+            logger.info(
+                "Webhook processed successfully",
+                extra={"request_id": request_id, "event": "webhook_processed"},
+            )
 
     except InvalidSignatureError:
         logger.error(
@@ -271,6 +556,665 @@ def webhook(request: Request):
     return jsonify({"status": "ok", "request_id": request_id}), 200
 
 
+def _get_event_handler(event):
+    """
+    Look up the function registered with @on_event for an event.
+
+    A handler registered for the event's message content type wins over one
+    registered for the event type alone, as in WebhookHandler.handle.
+    """
+    message = getattr(event, "message", None)
+    fallback = None
+    for (event_type, message_type), func in _event_handlers.items():
+        if not isinstance(event, event_type):
+            continue
+        if message_type is None:
+            fallback = fallback or func
+        elif isinstance(message, message_type):
+            return func
+    return fallback
+
+
+def _image_set_id(event) -> str | None:
+    """Return the imageSet ID of an image event sent as part of a multi-image send."""
+    message = getattr(event, "message", None)
+    if isinstance(message, ImageMessageContent) and message.image_set:
+        return message.image_set.id
+    return None
+
+
+class WebhookEventInProgressError(Exception):
+    """Raised when another request is still handling a webhook event."""
+
+
+def _claim_webhook_event(event) -> bool:
+    """
+    Record a webhookEventId before its handler runs.
+
+    Checks an in-process LRU of completed events first, then creates
+    webhook_events/{id} in Firestore (create-if-absent) with status
+    "processing" so redeliveries are caught across instances. If Firestore is
+    unavailable the event is processed (fail open).
+
+    Returns:
+        True if the event should be processed, False if it was already handled
+
+    Raises:
+        WebhookEventInProgressError: If another handler claimed the event less
+            than WEBHOOK_EVENT_CLAIM_TIMEOUT_SECONDS ago
+    """
+    webhook_event_id = getattr(event, "webhook_event_id", None)
+    if not webhook_event_id:
+        return True
+
+    with _seen_webhook_events_lock:
+        if webhook_event_id in _seen_webhook_events:
+            _seen_webhook_events.move_to_end(webhook_event_id)
+            return False
+
+    message = getattr(event, "message", None)
+    event_ref = db.collection("webhook_events").document(webhook_event_id)
+    claim = {
+        "event_type": type(event).__name__,
+        "message_id": getattr(message, "id", None),
+        "status": "processing",
+        "claimed_at": firestore.SERVER_TIMESTAMP,
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "expire_at": datetime.now(UTC) + timedelta(hours=WEBHOOK_EVENT_TTL_HOURS),
+    }
+    try:
+        event_ref.create(claim)
+        return True
+    except Conflict:
+        pass
+    except Exception as e:
+        logger.warning(f"Idempotency check failed for {webhook_event_id}, processing anyway: {str(e)}")
+        return True
+
+    return _take_over_webhook_event_transaction(db.transaction(), event_ref, claim)
+
+
+@firestore.transactional
+def _take_over_webhook_event_transaction(transaction, event_ref, claim: dict) -> bool:
+    """
+    Take over the claim of a webhook event whose handler never finished.
+
+    Claims without a status predate claim tracking and count as handled.
+
+    Returns:
+        True if the claim was taken over, False if the event was already handled
+
+    Raises:
+        WebhookEventInProgressError: If the claim is younger than
+            WEBHOOK_EVENT_CLAIM_TIMEOUT_SECONDS
+    """
+    snapshot = event_ref.get(transaction=transaction)
+    if snapshot.exists:
+        data = snapshot.to_dict()
+        if data.get("status") != "processing":
+            return False
+        claimed_at = data.get("claimed_at")
+        if claimed_at and datetime.now(UTC) - claimed_at < timedelta(seconds=WEBHOOK_EVENT_CLAIM_TIMEOUT_SECONDS):
+            raise WebhookEventInProgressError(f"Webhook event {event_ref.id} is being processed")
+
+    transaction.set(event_ref, claim)
+    return True
+
+
+def _complete_webhook_event(event):
+    """Mark a claimed webhookEventId as handled."""
+    webhook_event_id = getattr(event, "webhook_event_id", None)
+    if not webhook_event_id:
+        return
+
+    with _seen_webhook_events_lock:
+        _seen_webhook_events[webhook_event_id] = None
+        while len(_seen_webhook_events) > WEBHOOK_EVENT_CACHE_MAX_ENTRIES:
+            _seen_webhook_events.popitem(last=False)
+    try:
+        db.collection("webhook_events").document(webhook_event_id).update(
+            {"status": "done", "completed_at": firestore.SERVER_TIMESTAMP}
+        )
+    except Exception as e:
+        logger.warning(f"Failed to complete webhook event {webhook_event_id}: {str(e)}")
+
+
+def _release_webhook_event(event):
+    """Forget a claimed webhookEventId so a redelivery of a failed event is processed again."""
+    webhook_event_id = getattr(event, "webhook_event_id", None)
+    if not webhook_event_id:
+        return
+
+    with _seen_webhook_events_lock:
+        _seen_webhook_events.pop(webhook_event_id, None)
+    try:
+        db.collection("webhook_events").document(webhook_event_id).delete()
+    except Exception as e:
+        logger.warning(f"Failed to release webhook event {webhook_event_id}: {str(e)}")
+
+
+def _dispatch_event(event) -> int:
+    """
+    Run the handler for a single event.
+
+    Redelivered events that were already handled are skipped. A failing event
+    is logged and does not affect other events.
+
+    Returns:
+        1 if the handler raised or another handler still holds the event,
+        0 otherwise
+    """
+    func = _get_event_handler(event)
+    if func is None:
+        logger.info(f"No handler for {type(event).__name__}")
+        return 0
+
+    delivery_context = getattr(event, "delivery_context", None)
+    log_extra = {
+        "webhook_event_id": getattr(event, "webhook_event_id", None),
+        "event_type": type(event).__name__,
+        "is_redelivery": getattr(delivery_context, "is_redelivery", None),
+    }
+    try:
+        claimed = _claim_webhook_event(event)
+    except Exception as e:
+        # In progress elsewhere or unresolved; the delivery is retried later
+        logger.warning(
+            "Webhook event claim unresolved",
+            extra={**log_extra, "error": str(e), "event": "webhook_event_claim_unresolved"},
+        )
+        return 1
+    if not claimed:
+        logger.info(
+            "Duplicate webhook event skipped",
+            extra={**log_extra, "event": "webhook_event_duplicate"},
+        )
+        return 0
+
+    start_time = time.time()
+    try:
+        func(event)
+    except Exception as e:
+        _release_webhook_event(event)
+        logger.error(
+            "Webhook event processing failed",
+            extra={
+                **log_extra,
+                "error": str(e),
+                "error_type": type(e).__name__,
+                "event": "webhook_event_failed",
+            },
+            exc_info=True,
+        )
+        return 1
+
+    _complete_webhook_event(event)
+    logger.info(
+        "Webhook event processed",
+        extra={
+            **log_extra,
+            "processing_time": round(time.time() - start_time, 2),
+            "event": "webhook_event_processed",
+        },
+    )
+    return 0
+
+
+def _dispatch_user_events(events: list) -> int:
+    """
+    Run handlers for one user's events in delivery order.
+
+    Consecutive images of the same imageSet have no ordering between them and
+    are ingested concurrently.
+
+    Returns:
+        Number of events whose handler raised
+    """
+    failed = 0
+    for image_set_id, run in groupby(events, key=_image_set_id):
+        run = list(run)
+        if image_set_id and len(run) > 1:
+            with ThreadPoolExecutor(max_workers=min(IMAGE_SET_MAX_WORKERS, len(run))) as executor:
+                failed += sum(executor.map(_dispatch_event, run))
+        else:
+            failed += sum(_dispatch_event(event) for event in run)
+    return failed
+
+
+def dispatch_events(body: str, signature: str) -> dict:
+    """
+    Verify a webhook delivery and run its event handlers.
+
+    Events are grouped by user. Each user's events run sequentially so JOIN and
+    name registration keep their order, while different users are processed
+    concurrently on a bounded pool.
+
+    Args:
+        body: Raw webhook request body
+        signature: X-Line-Signature header value
+
+    Returns:
+        Dispatch stats: {"events", "users", "failed"}
+
+    Raises:
+        InvalidSignatureError: If the signature does not match the body
+    """
+    payload = handler.parser.parse(body, signature, as_payload=True)
+
+    groups: dict[str, list] = {}
+    for index, event in enumerate(payload.events):
+        user_id = getattr(getattr(event, "source", None), "user_id", None)
+        groups.setdefault(user_id or f"_event_{index}", []).append(event)
+
+    start_time = time.time()
+    if len(groups) <= 1:
+        failed = sum(_dispatch_user_events(events) for events in groups.values())
+    else:
+        with ThreadPoolExecutor(max_workers=min(WEBHOOK_DISPATCH_MAX_WORKERS, len(groups))) as executor:
+            failed = sum(executor.map(_dispatch_user_events, groups.values()))
+
+    stats = {"events": len(payload.events), "users": len(groups), "failed": failed}
+    logger.info(
+        "Webhook events dispatched",
+        extra={
+            **stats,
+            "elapsed_time": round(time.time() - start_time, 2),
+            "event": "webhook_dispatch_completed",
+        },
+    )
+    return stats
+
+
+def _defer_delivery(body: str, signature: str, request_id: str) -> bool:
+    """
+    Verify a webhook delivery and persist it for webhook_worker.
+
+    Args:
+        body: Raw webhook request body
+        signature: X-Line-Signature header value
+        request_id: Request ID, used as the delivery document ID
+
+    Returns:
+        True if the delivery needs no further work in this request, False if it
+        could not be persisted and must be handled synchronously
+
+    Raises:
+        InvalidSignatureError: If the signature does not match the body
+    """
+    payload = handler.parser.parse(body, signature, as_payload=True)
+    if not payload.events:
+        # LINE "Verify" requests and empty deliveries carry nothing to process
+        return True
+
+    try:
+        db.collection("webhook_deliveries").document(request_id).set(
+            {
+                "body": body,
+                "signature": signature,
+                "event_count": len(payload.events),
+                "status": "pending",
+                "attempts": 0,
+                "received_at": firestore.SERVER_TIMESTAMP,
+                "expire_at": datetime.now(UTC) + timedelta(days=WEBHOOK_DELIVERY_RETENTION_DAYS),
+            }
+        )
+    except Exception as e:
+        logger.warning(
+            f"Failed to persist webhook delivery, processing synchronously: {str(e)}",
+            extra={"request_id": request_id, "event": "webhook_defer_failed"},
+        )
+        return False
+
+    return True
+
+
+class DeliveryInProgressError(Exception):
+    """Raised when another worker is still processing a webhook delivery."""
+
+
+class WebhookEventsFailedError(Exception):
+    """Raised when one or more events of a webhook delivery failed."""
+
+
+@firestore.transactional
+def _claim_delivery(transaction, delivery_ref) -> dict | None:
+    """
+    Move a delivery to processing so only one worker runs it at a time.
+
+    Pending and failed deliveries can be claimed, as can deliveries a crashed
+    worker left in processing for longer than WEBHOOK_DELIVERY_STALE_SECONDS.
+    Events that were already handled are skipped on a re-run by the
+    per-event idempotency claims in dispatch_events.
+
+    Returns:
+        Delivery data if claimed, None if missing, done or out of attempts
+
+    Raises:
+        DeliveryInProgressError: If another worker is processing the delivery
+    """
+    snapshot = delivery_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return None
+
+    data = snapshot.to_dict()
+    status = data.get("status")
+    if status == "processing":
+        started_at = data.get("started_at")
+        if started_at and datetime.now(UTC) - started_at < timedelta(seconds=WEBHOOK_DELIVERY_STALE_SECONDS):
+            raise DeliveryInProgressError(f"Delivery {delivery_ref.id} is being processed")
+    elif status not in ("pending", "failed"):
+        return None
+    if data.get("attempts", 0) >= WEBHOOK_DELIVERY_MAX_ATTEMPTS:
+        return None
+
+    transaction.update(
+        delivery_ref,
+        {
+            "status": "processing",
+            "attempts": data.get("attempts", 0) + 1,
+            "started_at": firestore.SERVER_TIMESTAMP,
+        },
+    )
+    return data
+
+
+def process_webhook_delivery(delivery_id: str) -> bool:
+    """
+    Run the LINE event handlers for a persisted webhook delivery.
+
+    Args:
+        delivery_id: webhook_deliveries document ID
+
+    Returns:
+        True if the delivery was processed, False if skipped
+
+    Raises:
+        Exception: If processing failed or another worker holds the delivery,
+            so the Eventarc trigger retries it
+    """
+    delivery_ref = db.collection("webhook_deliveries").document(delivery_id)
+    data = _claim_delivery(db.transaction(), delivery_ref)
+    if data is None:
+        logger.info(
+            f"Webhook delivery {delivery_id} already done, missing or out of attempts",
+            extra={"request_id": delivery_id, "event": "webhook_delivery_skipped"},
+        )
+        return False
+
+    start_time = time.time()
+    try:
+        stats = dispatch_events(data["body"], data.get("signature", ""))
+        if stats["failed"]:
+            # Failed events were released by _dispatch_event; events that
+            # succeeded are skipped as duplicates when the delivery is retried
+            raise WebhookEventsFailedError(f"{stats['failed']} of {stats['events']} events failed")
+    except Exception as e:
+        delivery_ref.update(
+            {
+                "status": "failed",
+                "error": str(e),
+                "finished_at": firestore.SERVER_TIMESTAMP,
+            }
+        )
+        logger.error(
+            "Webhook delivery processing failed",
+            extra={
+                "request_id": delivery_id,
+                "error": str(e),
+                "error_type": type(e).__name__,
+                "attempts": data.get("attempts", 0) + 1,
+                "event": "webhook_delivery_failed",
+            },
+            exc_info=True,
+        )
+        raise
+
+    delivery_ref.update(
+        {
+            "status": "done",
+            "finished_at": firestore.SERVER_TIMESTAMP,
+        }
+    )
+
+    received_at = data.get("received_at")
+    logger.info(
+        "Webhook delivery processed",
+        extra={
+            "request_id": delivery_id,
+            "event_count": data.get("event_count"),
+            "queue_delay": round(start_time - received_at.timestamp(), 2) if received_at else None,
+            "processing_time": round(time.time() - start_time, 2),
+            "event": "webhook_delivery_processed",
+        },
+    )
+    return True
+
+
+@functions_framework.cloud_event
+def webhook_worker(cloud_event):
+    """
+    Eventarc entrypoint for deliveries persisted by webhook() in deferred mode.
+
+    Triggered on creation of webhook_deliveries/{delivery_id}; the subject is
+    "documents/webhook_deliveries/{delivery_id}". Errors propagate so the
+    trigger's retry policy re-drives failed and stuck deliveries.
+    """
+    delivery_id = cloud_event["subject"].rsplit("/", 1)[-1]
+    process_webhook_delivery(delivery_id)
+
+
+def _get_cached_image_url(image_id: str) -> tuple[str | None, int]:
+    """
+    Return a cached signed URL and the seconds it may still be cached downstream.
+
+    An entry is only reused while it stays valid for longer than the
+    Cache-Control max-age we hand out, so a CDN-cached redirect never points
+    at an expired signature.
+    """
+    with _image_url_cache_lock:
+        entry = _image_url_cache.get(image_id)
+        if entry:
+            url, valid_until = entry
+            remaining = int(valid_until - time.monotonic())
+            if remaining > IMAGE_URL_CACHE_MAX_AGE_SECONDS:
+                _image_url_cache.move_to_end(image_id)
+                image_url_cache_stats["hits"] += 1
+                return url, min(IMAGE_URL_CACHE_MAX_AGE_SECONDS, remaining - IMAGE_URL_CACHE_MAX_AGE_SECONDS)
+            del _image_url_cache[image_id]
+        image_url_cache_stats["misses"] += 1
+    return None, 0
+
+
+def _cache_image_url(image_id: str, url: str):
+    valid_until = time.monotonic() + IMAGE_URL_TTL_HOURS * 3600
+    with _image_url_cache_lock:
+        _image_url_cache[image_id] = (url, valid_until)
+        _image_url_cache.move_to_end(image_id)
+        while len(_image_url_cache) > IMAGE_URL_CACHE_MAX_ENTRIES:
+            _image_url_cache.popitem(last=False)
+
+
+def _get_visible_storage_path(image_id: str) -> str | None:
+    """
+    Return the storage path of an image if it may be shown publicly.
+
+    Images are visible while they are not soft-deleted, still within data
+    retention, and belong to an existing event that is not deleted (same
+    rules as the ranking UI). The image document is read on every call; the
+    event comes from the event metadata cache.
+    """
+    image_doc = db.collection("images").document(image_id).get()
+    if not image_doc.exists:
+        return None
+
+    data = image_doc.to_dict()
+    expire_at = data.get("expire_at")
+    if data.get("deleted_at") or (expire_at and expire_at <= datetime.now(UTC)):
+        return None
+
+    event_id = data.get("event_id")
+    event = _get_event(event_id) if event_id else None
+    if not event or event["status"] == "deleted":
+        return None
+
+    return data.get("storage_path")
+
+
+@functions_framework.http
+def image_redirect(request: Request):
+    """
+    Public HTTP endpoint that redirects to a short-lived signed URL for an image.
+
+    GET /{image_id}
+
+    Visibility is checked on every request so a soft delete takes effect
+    immediately; only the signatures are cached in-process. The redirect
+    itself is cacheable by browsers and CDNs for up to
+    IMAGE_URL_CACHE_MAX_AGE_SECONDS.
+    """
+    cors_headers = {"Access-Control-Allow-Origin": "*"}
+
+    if request.method == "OPTIONS":
+        return ("", 204, {**cors_headers, "Access-Control-Allow-Methods": "GET", "Access-Control-Max-Age": "3600"})
+
+    if request.method != "GET":
+        return (jsonify({"error": "Method not allowed"}), 405, cors_headers)
+
+    image_id = request.path.rstrip("/").rsplit("/", 1)[-1] or request.args.get("id", "")
+    if not IMAGE_ID_PATTERN.match(image_id):
+        return (jsonify({"error": "Invalid image id"}), 400, cors_headers)
+
+    try:
+        storage_path = _get_visible_storage_path(image_id)
+        if not storage_path:
+            with _image_url_cache_lock:
+                _image_url_cache.pop(image_id, None)
+            return (jsonify({"error": "Image not found"}), 404, {**cors_headers, "Cache-Control": "no-store"})
+
+        url, max_age = _get_cached_image_url(image_id)
+        if not url:
+            url, _expiration_time = generate_signed_url(STORAGE_BUCKET, storage_path, IMAGE_URL_TTL_HOURS)
+            _cache_image_url(image_id, url)
+            max_age = IMAGE_URL_CACHE_MAX_AGE_SECONDS
+    except Exception as e:
+        logger.error(f"Failed to resolve image {image_id}: {str(e)}")
+        return (jsonify({"error": "Failed to load image"}), 500, {**cors_headers, "Cache-Control": "no-store"})
+
+    headers = {
+        **cors_headers,
+        "Location": url,
+        "Cache-Control": f"public, max-age={max_age}",
+    }
+    return ("", 302, headers)
+
+
+def _read_backlog_gauge(event_id: str, data: dict) -> dict:
+    """Derive pending count, throughput and estimated wait from a gauge document."""
+    now = datetime.now(UTC)
+    window_buckets = {
+        (now - timedelta(minutes=m)).strftime("%Y%m%d%H%M") for m in range(BACKLOG_THROUGHPUT_WINDOW_MINUTES)
+    }
+    completed = sum(n for bucket, n in (data.get("completed_minutes") or {}).items() if bucket in window_buckets)
+    throughput_per_minute = completed / BACKLOG_THROUGHPUT_WINDOW_MINUTES
+    pending = max(0, int(data.get("pending") or 0))
+
+    if throughput_per_minute:
+        estimated_wait_seconds = round(pending / throughput_per_minute * 60)
+    else:
+        estimated_wait_seconds = pending * BACKLOG_DEFAULT_SECONDS_PER_IMAGE
+
+    return {
+        "event_id": event_id,
+        "pending": pending,
+        "throughput_per_minute": round(throughput_per_minute, 2),
+        "estimated_wait_seconds": estimated_wait_seconds,
+    }
+
+
+def get_backlog_gauge(event_id: str, use_cache: bool = True) -> dict:
+    """
+    Get the scoring backlog gauge of an event.
+
+    The gauge is a single document maintained by counters, so reading it
+    costs one document read (shared per instance for BACKLOG_GAUGE_CACHE_SECONDS).
+
+    Args:
+        event_id: Event ID
+        use_cache: Whether a recently fetched gauge may be returned
+
+    Returns:
+        {"event_id", "pending", "throughput_per_minute", "estimated_wait_seconds"}
+    """
+    if use_cache:
+        with _backlog_gauges_lock:
+            cached = _backlog_gauges.get(event_id)
+        if cached and time.monotonic() - cached[1] < BACKLOG_GAUGE_CACHE_SECONDS:
+            return cached[0]
+
+    snapshot = db.collection("scoring_backlog").document(event_id).get()
+    gauge = _read_backlog_gauge(event_id, snapshot.to_dict() if snapshot.exists else {})
+
+    with _backlog_gauges_lock:
+        _backlog_gauges[event_id] = (gauge, time.monotonic())
+    return gauge
+
+
+def _build_loading_message(event_id: str, image_set) -> TextMessage:
+    """Build the loading reply, with an estimated wait when scoring is behind."""
+    received = f"📸 {image_set.total}枚の画像を受け取りました！" if image_set else "📸 画像を受け取りました！"
+
+    try:
+        gauge = get_backlog_gauge(event_id)
+    except Exception as e:
+        logger.warning(f"Failed to read backlog gauge for event {event_id}: {str(e)}")
+        gauge = None
+
+    if gauge and gauge["estimated_wait_seconds"] >= BACKLOG_NOTICE_THRESHOLD_SECONDS:
+        minutes = max(1, round(gauge["estimated_wait_seconds"] / 60))
+        logger.info(
+            "Backlog notice sent",
+            extra={**gauge, "event": "backlog_notice_sent"},
+        )
+        return TextMessage(
+            text=f"{received}\n\n"
+            f"ただいま混み合っています（{gauge['pending']}枚が順番待ち）。\n"
+            f"結果まで約{minutes}分かかります ⏳\n\n"
+            "同じ写真を送り直す必要はありません 🙏"
+        )
+
+    if image_set:
+        return TextMessage(text=f"{received}\n\nAIが笑顔を分析中...\nまとめて結果をお送りします ⏳")
+    return TextMessage(text=f"{received}\n\nAIが笑顔を分析中...\nしばらくお待ちください ⏳")
+
+
+@functions_framework.http
+def backlog_status(request: Request):
+    """
+    Admin HTTP endpoint exposing the scoring backlog gauge.
+
+    GET ?event_id=... returns the gauge of one event; without event_id, the
+    gauges of all events with pending images. Access is restricted by Cloud
+    Run IAM (no public invoker).
+    """
+    if request.method != "GET":
+        return jsonify({"error": "Method not allowed"}), 405
+
+    event_id = request.args.get("event_id", "")
+    try:
+        if event_id:
+            if len(event_id) > 128 or "/" in event_id:
+                return jsonify({"error": "Invalid event_id"}), 400
+            return jsonify(get_backlog_gauge(event_id, use_cache=False)), 200
+
+        query = db.collection("scoring_backlog").where(filter=firestore.FieldFilter("pending", ">", 0))
+        gauges = [_read_backlog_gauge(doc.id, doc.to_dict()) for doc in query.stream()]
+    except Exception as e:
+        logger.error(f"Failed to read backlog gauges: {str(e)}")
+        return jsonify({"error": "Failed to read backlog"}), 500
+
+    return jsonify({"events": sorted(gauges, key=lambda g: g["pending"], reverse=True)}), 200
+
+
 def _find_user_by_status(line_user_id: str, join_status: str):
     """
     Find the most recent user document matching line_user_id and join_status.
@@ -292,14 +1236,179 @@ def _find_user_by_status(line_user_id: str, join_status: str):
     return None, None
 
 
+def _cached_registration(line_user_id: str) -> dict | None:
+    """Return the cached registration of a guest, if still fresh."""
+    with _registration_cache_lock:
+        entry = _registration_cache.get(line_user_id)
+        if entry:
+            registration, valid_until = entry
+            if valid_until > time.monotonic():
+                _registration_cache.move_to_end(line_user_id)
+                registration_cache_stats["hits"] += 1
+                return registration
+            del _registration_cache[line_user_id]
+        registration_cache_stats["misses"] += 1
+    return None
+
+
+def _make_registration(doc_id: str, data: dict) -> dict:
+    """
+    Build a registration from a user document or a line_users pointer.
+
+    Returns:
+        The registration: doc_id, event_id, join_status, name and has_uploads
+    """
+    return {
+        "doc_id": doc_id,
+        "event_id": data.get("event_id"),
+        "join_status": data.get("join_status"),
+        "name": data.get("name"),
+        "has_uploads": bool(data.get("has_uploads") or data.get("total_uploads")),
+    }
+
+
+def _cache_registration(line_user_id: str, registration: dict) -> dict:
+    """Cache the registration of a registered guest."""
+    valid_until = time.monotonic() + REGISTRATION_CACHE_TTL_SECONDS
+    with _registration_cache_lock:
+        _registration_cache[line_user_id] = (registration, valid_until)
+        _registration_cache.move_to_end(line_user_id)
+        while len(_registration_cache) > REGISTRATION_CACHE_MAX_ENTRIES:
+            _registration_cache.popitem(last=False)
+    return registration
+
+
+def _invalidate_registration(line_user_id: str):
+    """Drop the cached registration of a guest whose join status changes."""
+    with _registration_cache_lock:
+        if _registration_cache.pop(line_user_id, None):
+            registration_cache_stats["invalidations"] += 1
+
+
+def _find_registration(line_user_id: str, use_cache: bool = True, include_pending: bool = True) -> dict | None:
+    """
+    Find the active registration (pending_name or registered) of a guest.
+
+    One point read of the line_users pointer; guests without a pointer (not
+    backfilled yet) fall back to querying users. Only "registered" guests
+    are cached: a pending registration or a guest without one is looked up
+    again on every message, so a JOIN on another instance is seen right away.
+
+    Args:
+        line_user_id: LINE user ID
+        use_cache: Whether to consult the cache before reading Firestore
+        include_pending: Whether the users fallback also looks for a
+            pending_name registration (the pointer always reports it)
+
+    Returns:
+        Registration dict (see _make_registration), or None if not joined
+    """
+    if use_cache:
+        registration = _cached_registration(line_user_id)
+        if registration:
+            return registration
+
+    registration = None
+    pointer = _line_user_ref(line_user_id).get()
+    if pointer.exists:
+        data = pointer.to_dict()
+        if data.get("join_status") in ACTIVE_JOIN_STATUSES:
+            registration = _make_registration(data.get("user_doc_id"), data)
+    else:
+        for join_status in ACTIVE_JOIN_STATUSES if include_pending else ["registered"]:
+            user_doc, _user_ref = _find_user_by_status(line_user_id, join_status)
+            if user_doc:
+                registration = _make_registration(user_doc.id, {**user_doc.to_dict(), "join_status": join_status})
+                break
+
+    if registration and registration["join_status"] == "registered":
+        _cache_registration(line_user_id, registration)
+    return registration
+
+
+def _mark_first_upload(line_user_id: str, registration: dict):
+    """
+    Record on the line_users pointer that the guest has uploaded (best effort).
+
+    Written once per guest, so later uploads are scheduled as repeats without
+    reading the user document.
+    """
+    registration["has_uploads"] = True
+    try:
+        _line_user_ref(line_user_id).update({"has_uploads": True})
+    except NotFound:
+        pass  # Not backfilled yet; users.total_uploads is counted by scoring
+    except Exception as e:
+        logger.warning(f"Failed to mark first upload of {line_user_id}: {str(e)}")
+
+
+def _line_user_ref(line_user_id: str):
+    """Return the line_users/{line_user_id} pointer to a guest's active registration."""
+    return db.collection("line_users").document(line_user_id)
+
+
+def _set_line_user_pointer(
+    transaction, pointer_ref, current: dict | None, user_ref, event_id: str, join_status: str, name, has_uploads
+):
+    """
+    Point line_users/{line_user_id} at a registration (inside a transaction).
+
+    The write is skipped when the pointer already says the same thing.
+    """
+    pointer = {
+        "user_doc_id": user_ref.id,
+        "event_id": event_id,
+        "join_status": join_status,
+        "name": name,
+        "has_uploads": bool(has_uploads),
+    }
+    if current and all(current.get(key) == value for key, value in pointer.items()):
+        return
+    transaction.set(pointer_ref, {**pointer, "updated_at": firestore.SERVER_TIMESTAMP})
+
+
+def _read_join_state(transaction, user_ref, line_user_id: str):
+    """
+    Read what a JOIN transaction needs, before any of its writes.
+
+    Returns:
+        Tuple of (pointer_ref, pointer data or None, user snapshot, reference
+        of the active registration in another event or None)
+    """
+    pointer_ref = _line_user_ref(line_user_id)
+    pointer_snapshot = pointer_ref.get(transaction=transaction)
+    pointer = pointer_snapshot.to_dict() if pointer_snapshot.exists else None
+
+    previous_ref = None
+    if (
+        pointer
+        and pointer.get("join_status") in ACTIVE_JOIN_STATUSES
+        and pointer.get("user_doc_id")
+        and pointer["user_doc_id"] != user_ref.id
+    ):
+        previous_ref = db.collection("users").document(pointer["user_doc_id"])
+        previous = previous_ref.get(transaction=transaction)
+        if not previous.exists or (previous.to_dict() or {}).get("join_status") not in ACTIVE_JOIN_STATUSES:
+            previous_ref = None
+
+    return pointer_ref, pointer, user_ref.get(transaction=transaction), previous_ref
+
+
 def _deactivate_other_registrations(line_user_id: str, new_event_id: str):
     """
     Deactivate user registrations in other events when joining a new one.
     Sets join_status to "left" for any active registrations in different events.
+
+    Guests with a line_users pointer are deactivated by the JOIN transaction
+    itself (one targeted update); only guests without one are scanned here.
     """
+    _invalidate_registration(line_user_id)
+    if _line_user_ref(line_user_id).get().exists:
+        return
+
     users_ref = db.collection("users")
     q = users_ref.where(filter=firestore.FieldFilter("line_user_id", "==", line_user_id)).where(
-        filter=firestore.FieldFilter("join_status", "in", ["registered", "pending_name"])
+        filter=firestore.FieldFilter("join_status", "in", ACTIVE_JOIN_STATUSES)
     )
     for doc in q.stream():
         if doc.to_dict().get("event_id") != new_event_id:
@@ -311,50 +1420,229 @@ def _deactivate_other_registrations(line_user_id: str, new_event_id: str):
 def _join_event_transaction(transaction, user_ref, user_id: str, event_id: str, event_name: str) -> TextMessage:
     """
     Transactional check-and-set for a user document during JOIN.
+
+    Also points line_users/{user_id} at this registration and deactivates the
+    registration in another event it pointed to before.
     Returns a TextMessage to be sent outside the transaction.
     """
-    doc = user_ref.get(transaction=transaction)
+    pointer_ref, pointer, doc, previous_ref = _read_join_state(transaction, user_ref, user_id)
 
     if doc.exists:
         data = doc.to_dict()
         status = data.get("join_status")
+        name = data.get("name")
+        has_uploads = data.get("total_uploads")
         if status == "pending_name":
-            return TextMessage(
+            message = TextMessage(
                 text=f"「{event_name}」に参加登録中です。\n\nお名前をテキストで送信してください。\n例: 山田太郎"
             )
-        if status == "left":
-            name = data.get("name")
-            if name:
-                transaction.update(user_ref, {"join_status": "registered"})
-                logger.info(f"User {user_id} reactivated in event {event_id} (registered)")
-                return TextMessage(
-                    text=f"{name}さん、おかえりなさい！「{event_name}」に再参加しました。\n\n笑顔の写真をアップロードしよう！"
-                )
-            transaction.update(user_ref, {"join_status": "pending_name"})
+        elif status == "left" and name:
+            status = "registered"
+            transaction.update(user_ref, {"join_status": status})
+            logger.info(f"User {user_id} reactivated in event {event_id} (registered)")
+            message = TextMessage(
+                text=f"{name}さん、おかえりなさい！「{event_name}」に再参加しました。\n\n笑顔の写真をアップロードしよう！"
+            )
+        elif status == "left":
+            status = "pending_name"
+            transaction.update(user_ref, {"join_status": status})
             logger.info(f"User {user_id} reactivated in event {event_id} (pending name)")
-            return TextMessage(
+            message = TextMessage(
                 text=f"「{event_name}」に再参加しました！\n\nお名前をテキストで送信してください。\n例: 山田太郎"
             )
-        # "registered" or any other status
-        name = data.get("name", "ゲスト")
-        return TextMessage(text=f"{name}さん、「{event_name}」に既に参加済みです！\n\n笑顔の写真をアップロードしよう！")
+        else:
+            # "registered" or any other status
+            message = TextMessage(
+                text=f"{name or 'ゲスト'}さん、「{event_name}」に既に参加済みです！\n\n笑顔の写真をアップロードしよう！"
+            )
+    else:
+        # New user
+        status, name, has_uploads = "pending_name", None, False
+        transaction.set(
+            user_ref,
+            {
+                "line_user_id": user_id,
+                "event_id": event_id,
+                "join_status": status,
+                "created_at": firestore.SERVER_TIMESTAMP,
+                "total_uploads": 0,
+                "active_uploads": 0,
+                "best_score": 0,
+            },
+        )
+        logger.info(f"User {user_id} joined event {event_id} (pending name)")
+        message = TextMessage(
+            text=f"「{event_name}」への参加を受け付けました！\n\nお名前をテキストで送信してください。\n例: 山田太郎"
+        )
 
-    # New user
-    transaction.set(
-        user_ref,
-        {
-            "line_user_id": user_id,
-            "event_id": event_id,
-            "join_status": "pending_name",
-            "created_at": firestore.SERVER_TIMESTAMP,
-            "total_uploads": 0,
-            "best_score": 0,
-        },
-    )
-    logger.info(f"User {user_id} joined event {event_id} (pending name)")
-    return TextMessage(
-        text=f"「{event_name}」への参加を受け付けました！\n\nお名前をテキストで送信してください。\n例: 山田太郎"
-    )
+    if previous_ref:
+        transaction.update(previous_ref, {"join_status": "left"})
+        logger.info(f"Deactivated registration {previous_ref.id} for user {user_id}")
+    _set_line_user_pointer(transaction, pointer_ref, pointer, user_ref, event_id, status, name, has_uploads)
+    return message
+
+
+def _find_event_by_code(event_code: str) -> dict | None:
+    """
+    Resolve a JOIN code to a joinable (active or draft) event.
+
+    One point read of the event_codes/{code} index, cached per instance for
+    EVENT_CODE_CACHE_TTL_SECONDS so a table of guests scanning the same QR
+    code costs one read. Events without an index document (not backfilled
+    yet) fall back to querying events.
+
+    Args:
+        event_code: Event code from the JOIN command or LIFF form
+
+    Returns:
+        Dict with event_id, event_name and status, or None if no joinable
+        event has the code
+    """
+    with _event_code_cache_lock:
+        entry = _event_code_cache.get(event_code)
+        if entry:
+            event, valid_until = entry
+            if valid_until > time.monotonic():
+                _event_code_cache.move_to_end(event_code)
+                event_code_cache_stats["hits"] += 1
+                return event
+            del _event_code_cache[event_code]
+        event_code_cache_stats["misses"] += 1
+
+    index_doc = db.collection("event_codes").document(event_code).get()
+    if index_doc.exists:
+        data = index_doc.to_dict()
+        event_id = data.get("event_id")
+        if event_id:
+            _invalidate_event(event_id)  # the index may carry a newer status
+        if not event_id or data.get("status") not in JOINABLE_EVENT_STATUSES:
+            return None
+    else:
+        event_code_cache_stats["fallbacks"] += 1
+        q = (
+            db.collection("events")
+            .where(filter=firestore.FieldFilter("event_code", "==", event_code))
+            .where(filter=firestore.FieldFilter("status", "in", JOINABLE_EVENT_STATUSES))
+            .limit(1)
+        )
+        event_docs = list(q.stream())
+        if not event_docs:
+            return None
+        data = event_docs[0].to_dict()
+        event_id = event_docs[0].id
+
+    event = {
+        "event_id": event_id,
+        "event_name": data.get("event_name", "イベント"),
+        "status": data.get("status"),
+    }
+    valid_until = time.monotonic() + EVENT_CODE_CACHE_TTL_SECONDS
+    with _event_code_cache_lock:
+        _event_code_cache[event_code] = (event, valid_until)
+        _event_code_cache.move_to_end(event_code)
+        while len(_event_code_cache) > EVENT_CODE_CACHE_MAX_ENTRIES:
+            _event_code_cache.popitem(last=False)
+    return event
+
+
+def _make_event(data: dict) -> dict:
+    """Build the cached metadata of an event from its document."""
+    return {
+        "status": data.get("status"),
+        "event_name": data.get("event_name", "イベント"),
+        "event_code": data.get("event_code"),
+        "result_delivery": (data.get("settings") or {}).get("result_delivery"),
+    }
+
+
+def _cache_event(event_id: str, event: dict, ttl_seconds: int):
+    """Cache the metadata of an event for ttl_seconds."""
+    valid_until = time.monotonic() + ttl_seconds
+    with _event_cache_lock:
+        _event_cache[event_id] = (event, valid_until)
+        _event_cache.move_to_end(event_id)
+        while len(_event_cache) > EVENT_CACHE_MAX_ENTRIES:
+            _event_cache.popitem(last=False)
+
+
+def _invalidate_event(event_id: str):
+    """Drop the cached metadata of an event that may have changed or been deleted."""
+    with _event_cache_lock:
+        if _event_cache.pop(event_id, None):
+            event_cache_stats["invalidations"] += 1
+
+
+def _on_event_snapshot(event_id: str, snapshots: list):
+    """Listener callback: refresh or drop a cached event as Firestore pushes changes."""
+    event_cache_stats["pushes"] += 1
+    snapshot = next((s for s in snapshots if s.exists), None)
+    if snapshot is None:
+        _invalidate_event(event_id)
+        return
+
+    event = _make_event(snapshot.to_dict())
+    _cache_event(event_id, event, EVENT_LISTENER_TTL_SECONDS)
+    if event["status"] not in JOINABLE_EVENT_STATUSES and event["event_code"]:
+        with _event_code_cache_lock:
+            _event_code_cache.pop(event["event_code"], None)
+
+
+def _watch_event(event_id: str):
+    """Start a listener on an event document (EVENT_LISTENER_ENABLED, best effort)."""
+    with _event_cache_lock:
+        if event_id in _event_watches or len(_event_watches) >= EVENT_LISTENER_MAX_EVENTS:
+            return
+        _event_watches[event_id] = None  # Reserved while the listener starts
+
+    try:
+        watch = (
+            db.collection("events")
+            .document(event_id)
+            .on_snapshot(lambda snapshots, _changes, _read_time: _on_event_snapshot(event_id, snapshots))
+        )
+    except Exception as e:
+        logger.warning(f"Failed to watch event {event_id}: {str(e)}")
+        with _event_cache_lock:
+            _event_watches.pop(event_id, None)
+        return
+
+    with _event_cache_lock:
+        _event_watches[event_id] = watch
+
+
+def _get_event(event_id: str) -> dict | None:
+    """
+    Return the cached metadata of an event (status, name, code, result delivery).
+
+    Reads the event document when the entry is missing or expired. Missing
+    events are not cached.
+
+    Args:
+        event_id: Event ID
+
+    Returns:
+        Event metadata dict (see _make_event), or None if the event does not exist
+    """
+    with _event_cache_lock:
+        entry = _event_cache.get(event_id)
+        if entry:
+            event, valid_until = entry
+            if valid_until > time.monotonic():
+                _event_cache.move_to_end(event_id)
+                event_cache_stats["hits"] += 1
+                return event
+            del _event_cache[event_id]
+        event_cache_stats["misses"] += 1
+
+    event_doc = db.collection("events").document(event_id).get()
+    if not event_doc.exists:
+        return None
+
+    event = _make_event(event_doc.to_dict())
+    _cache_event(event_id, event, EVENT_CACHE_TTL_SECONDS)
+    if EVENT_LISTENER_ENABLED:
+        _watch_event(event_id)
+    return event
 
 
 def handle_join_event(event_code: str, user_id: str, reply_token: str):
@@ -382,16 +1670,10 @@ def handle_join_event(event_code: str, user_id: str, reply_token: str):
 
     logger.info(f"JOIN request from {user_id} with code: {event_code}")
 
-    # 1. Look up event by event_code (outside transaction — events don't change during JOIN)
-    events_ref = db.collection("events")
-    q = (
-        events_ref.where(filter=firestore.FieldFilter("event_code", "==", event_code))
-        .where(filter=firestore.FieldFilter("status", "in", ["active", "draft"]))
-        .limit(1)
-    )
-    event_docs = list(q.stream())
-
-    if not event_docs:
+    # 1. Look up event by event_code (outside transaction — events don't change during JOIN)
+    event = _find_event_by_code(event_code)
+
+    if not event:
         messaging_api.reply_message(
             ReplyMessageRequest(
                 reply_token=reply_token,
@@ -402,11 +1684,9 @@ def handle_join_event(event_code: str, user_id: str, reply_token: str):
         )
         return
 
-    event_doc = event_docs[0]
-    event_data = event_doc.to_dict()
-    event_id = event_doc.id
-    event_name = event_data.get("event_name", "イベント")
-    event_status = event_data.get("status")
+    event_id = event["event_id"]
+    event_name = event["event_name"]
+    event_status = event["status"]
 
     # 2. Deactivate registrations in other events (outside transaction — idempotent)
     _deactivate_other_registrations(user_id, event_id)
@@ -416,6 +1696,7 @@ def handle_join_event(event_code: str, user_id: str, reply_token: str):
     user_ref = db.collection("users").document(composite_key)
     transaction = db.transaction()
     message = _join_event_transaction(transaction, user_ref, user_id, event_id, event_name)
+    _invalidate_registration(user_id)
 
     # Append draft trial notice
     if event_status == "draft":
@@ -425,7 +1706,7 @@ def handle_join_event(event_code: str, user_id: str, reply_token: str):
     messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
 
 
-@handler.add(MessageEvent, message=TextMessageContent)
+@on_event(MessageEvent, message=TextMessageContent)
 def handle_text_message(event: MessageEvent):
     """
     Handle text message event.
@@ -451,15 +1732,15 @@ def handle_text_message(event: MessageEvent):
         handle_join_event(match.group(1), user_id, reply_token)
         return
 
+    registration = _find_registration(user_id)
+
     # Case 2: Check for pending_name status (needs to register name)
-    pending_doc, pending_ref = _find_user_by_status(user_id, "pending_name")
-    if pending_doc:
-        _register_name(text, user_id, pending_doc, pending_ref, reply_token)
+    if registration and registration["join_status"] == "pending_name":
+        _register_name(text, user_id, registration, reply_token)
         return
 
     # Case 3: Check for registered status (active participant)
-    registered_doc, _registered_ref = _find_user_by_status(user_id, "registered")
-    if registered_doc:
+    if registration:
         handle_command(text, reply_token)
         return
 
@@ -472,15 +1753,40 @@ def handle_text_message(event: MessageEvent):
     messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
 
 
-def _register_name(name: str, user_id: str, user_doc, user_ref, reply_token: str):
+@firestore.transactional
+def _register_name_transaction(transaction, user_ref, line_user_id: str, name: str) -> dict:
+    """
+    Register the name on a user document and its line_users pointer.
+
+    Returns:
+        The registration (see _make_registration)
+
+    Raises:
+        ValueError: If the user document does not exist
+    """
+    pointer_ref = _line_user_ref(line_user_id)
+    pointer_snapshot = pointer_ref.get(transaction=transaction)
+    pointer = pointer_snapshot.to_dict() if pointer_snapshot.exists else None
+    doc = user_ref.get(transaction=transaction)
+    if not doc.exists:
+        raise ValueError(f"User document not found: {user_ref.id}")
+
+    data = {**doc.to_dict(), "name": name, "join_status": "registered"}
+    transaction.update(user_ref, {"name": name, "join_status": "registered"})
+    _set_line_user_pointer(
+        transaction, pointer_ref, pointer, user_ref, data.get("event_id"), "registered", name, data.get("total_uploads")
+    )
+    return _make_registration(user_ref.id, data)
+
+
+def _register_name(name: str, user_id: str, registration: dict, reply_token: str):
     """
     Register user name for a pending_name user document.
 
     Args:
         name: User's name from text message
         user_id: LINE user ID
-        user_doc: User document snapshot
-        user_ref: User document reference
+        registration: The guest's pending registration (see _make_registration)
         reply_token: LINE reply token
     """
     # Validate user name
@@ -497,12 +1803,8 @@ def _register_name(name: str, user_id: str, user_doc, user_ref, reply_token: str
     name = name.strip()
 
     try:
-        user_ref.update(
-            {
-                "name": name,
-                "join_status": "registered",
-            }
-        )
+        user_ref = db.collection("users").document(registration["doc_id"])
+        _cache_registration(user_id, _register_name_transaction(db.transaction(), user_ref, user_id, name))
 
         logger.info(f"User registered: {user_id} - {name}")
 
@@ -565,7 +1867,513 @@ def _count_user_images(user_id: str, event_id: str) -> int:
     return count
 
 
-@handler.add(MessageEvent, message=ImageMessageContent)
+@firestore.transactional
+def _reserve_draft_upload_transaction(transaction, user_ref, user_id: str, event_id: str) -> tuple[bool, int | None]:
+    """
+    Compare-and-increment users.active_uploads against DRAFT_UPLOAD_LIMIT.
+
+    Parallel uploads serialize on the user document, so the limit holds
+    without counting images. Guests without the counter (joined before it
+    existed) are counted from images once; so is a guest at the limit after
+    DRAFT_RECOUNT_IDLE_SECONDS without a reservation.
+
+    Returns:
+        Tuple of (reserved, active uploads including this one if reserved),
+        or (False, None) if the user document is missing
+    """
+    snapshot = user_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False, None
+
+    data = snapshot.to_dict()
+    stored = data.get("active_uploads")
+    count = stored
+    if count is None:
+        count = _count_user_images(user_id, event_id)
+    elif count >= DRAFT_UPLOAD_LIMIT:
+        reserved_at = data.get("active_uploads_reserved_at")
+        if not reserved_at or reserved_at < datetime.now(UTC) - timedelta(seconds=DRAFT_RECOUNT_IDLE_SECONDS):
+            count = _count_user_images(user_id, event_id)
+
+    if count >= DRAFT_UPLOAD_LIMIT:
+        if count != stored:
+            transaction.update(user_ref, {"active_uploads": count})
+        return False, count
+
+    transaction.update(user_ref, {"active_uploads": count + 1, "active_uploads_reserved_at": datetime.now(UTC)})
+    return True, count + 1
+
+
+@firestore.transactional
+def _release_upload_transaction(transaction, user_ref):
+    """Decrement users.active_uploads, never below zero or onto a missing counter."""
+    snapshot = user_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return
+    count = snapshot.to_dict().get("active_uploads")
+    if count:
+        transaction.update(user_ref, {"active_uploads": count - 1})
+
+
+def _release_upload(user_ref):
+    """Give back an upload counted in users.active_uploads (best effort)."""
+    try:
+        _release_upload_transaction(db.transaction(), user_ref)
+    except Exception as e:
+        logger.warning(f"Failed to release upload of {user_ref.id}: {str(e)}")
+
+
+def _timed_step(step_times: dict, step: str, func, *args, **kwargs):
+    """Run one ingest step and record its duration in step_times."""
+    start_time = time.time()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        step_times[step] = round(time.time() - start_time, 3)
+
+
+class ImageTooLargeError(Exception):
+    """Raised when LINE message content exceeds MAX_IMAGE_BYTES."""
+
+
+def _flatten_to_rgb(img):
+    """Convert an image to RGB, compositing transparency onto white."""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        background = PILImage.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel("A"))
+        return background
+    return img.convert("RGB")
+
+
+def transcode_image(source) -> tuple:
+    """
+    Normalize uploaded content into the stored JPEG master.
+
+    JPEGs within INGEST_MAX_LONG_EDGE are kept byte-for-byte. Other formats
+    (PNG screenshots, WebP, GIF...) are converted to JPEG, and oversized
+    images are downscaled to INGEST_MAX_LONG_EDGE at INGEST_JPEG_QUALITY.
+    Content Pillow cannot read, and content the conversion would not make
+    smaller, is stored unchanged.
+
+    Args:
+        source: Seekable binary file holding the original content
+
+    Returns:
+        (file object positioned at the start, info dict with format,
+        original_width, original_height and transcoded)
+
+    Raises:
+        ImageTooLargeError: If the pixel count exceeds INGEST_MAX_PIXELS, or
+            the decode would exceed INGEST_MAX_DECODE_PIXELS
+    """
+    info = {"format": None, "original_width": None, "original_height": None, "transcoded": False}
+    try:
+        # Only the header is read here; pixels are decoded lazily
+        img = PILImage.open(source)
+    except PILImage.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+    except (UnidentifiedImageError, OSError) as e:
+        logger.warning(f"Unrecognized image content, storing as-is: {str(e)}")
+        source.seek(0)
+        return source, info
+
+    width, height = img.size
+    info.update({"format": img.format, "original_width": width, "original_height": height})
+    if width * height > INGEST_MAX_PIXELS:
+        raise ImageTooLargeError(f"{width}x{height} exceeds {INGEST_MAX_PIXELS} pixels")
+
+    oversized = INGEST_MAX_LONG_EDGE > 0 and max(width, height) > INGEST_MAX_LONG_EDGE
+    if img.format == "JPEG" and not oversized:
+        source.seek(0)
+        return source, info
+
+    if oversized:
+        # JPEG only: decode at the smallest DCT scale still >= the target
+        img.draft("RGB", (INGEST_MAX_LONG_EDGE, INGEST_MAX_LONG_EDGE))
+    if img.width * img.height > INGEST_MAX_DECODE_PIXELS:
+        # Formats without reduced-scale decoding would be decoded in full
+        raise ImageTooLargeError(f"Decoding {img.width}x{img.height} exceeds {INGEST_MAX_DECODE_PIXELS} pixels")
+
+    try:
+        img = _flatten_to_rgb(ImageOps.exif_transpose(img))
+        if oversized:
+            img.thumbnail((INGEST_MAX_LONG_EDGE, INGEST_MAX_LONG_EDGE), PILImage.Resampling.LANCZOS)
+
+        output = io.BytesIO()
+        img.save(output, format="JPEG", quality=INGEST_JPEG_QUALITY, optimize=True)
+    except OSError as e:
+        logger.warning(f"Failed to transcode image, storing as-is: {str(e)}")
+        source.seek(0)
+        return source, info
+
+    if output.tell() >= source.seek(0, io.SEEK_END):
+        source.seek(0)
+        return source, info
+
+    output.seek(0)
+    info["transcoded"] = True
+    return output, info
+
+
+def stream_message_content_to_storage(message_id: str, storage_path: str, should_commit=None) -> dict:
+    """
+    Stream LINE message content into Cloud Storage as a normalized JPEG.
+
+    The content is read from LINE in small chunks into a spooled buffer (in
+    memory up to INLINE_IMAGE_MAX_BYTES) while it is hashed. should_commit is
+    asked with the digest before any decoding, so duplicates are never
+    transcoded; committed content is transcoded by transcode_image and
+    written through a resumable upload. The size limit is checked against
+    Content-Length before reading and again while streaming, so oversized
+    content is never buffered or uploaded.
+
+    Args:
+        message_id: LINE message ID
+        storage_path: Destination object path in STORAGE_BUCKET
+        should_commit: Optional callback receiving the SHA-256 hex digest of
+            the original content; returning False skips the upload
+
+    Returns:
+        {"size_bytes": int, "sha256": str, "content": bytes | None,
+        "committed": bool, "original": dict}; size_bytes is the stored size,
+        sha256 the digest of the original content, content is kept only for
+        stored images up to INLINE_IMAGE_MAX_BYTES, and original describes
+        the content as received (format and dimensions are only known for
+        committed content)
+
+    Raises:
+        ImageTooLargeError: If the content exceeds MAX_IMAGE_BYTES or INGEST_MAX_PIXELS
+        ApiException: If LINE returns an error
+    """
+    start_time = time.time()
+    # get_message_content_with_http_info(_preload_content=False) still reads the
+    # whole body into ApiResponse.raw_data, so go through the SDK's REST client
+    # to get the unread urllib3 response (non-2xx still raises ApiException).
+    raw = messaging_api_blob.api_client.request(
+        "GET",
+        LINE_CONTENT_URL.format(message_id=message_id),
+        headers={"Authorization": f"Bearer {LINE_CHANNEL_ACCESS_TOKEN}"},
+        _preload_content=False,
+        _request_timeout=CONTENT_READ_TIMEOUT_SECONDS,
+    )
+
+    with tempfile.SpooledTemporaryFile(max_size=INLINE_IMAGE_MAX_BYTES) as spool:
+        try:
+            content_length = int(raw.headers.get("Content-Length") or 0)
+            if content_length > MAX_IMAGE_BYTES:
+                raise ImageTooLargeError(f"Content-Length {content_length} exceeds {MAX_IMAGE_BYTES}")
+
+            digest = hashlib.sha256()
+            original_bytes = 0
+            for chunk in raw.stream(CONTENT_READ_CHUNK_BYTES):
+                original_bytes += len(chunk)
+                if original_bytes > MAX_IMAGE_BYTES:
+                    raise ImageTooLargeError(f"Content exceeds {MAX_IMAGE_BYTES} bytes")
+                digest.update(chunk)
+                spool.write(chunk)
+        finally:
+            raw.release_conn()
+
+        original = {"format": None, "width": None, "height": None, "size_bytes": original_bytes}
+        transcoded = False
+        committed = should_commit is None or should_commit(digest.hexdigest())
+        size_bytes = 0
+        inline_chunks = []
+        if committed:
+            spool.seek(0)
+            stored, transcode_info = transcode_image(spool)
+            transcoded = transcode_info["transcoded"]
+            original.update(
+                format=transcode_info["format"],
+                width=transcode_info["original_width"],
+                height=transcode_info["original_height"],
+            )
+            # Content kept as-is (e.g. a PNG the conversion would have grown) keeps its own type
+            content_type = "image/jpeg" if transcoded else PILImage.MIME.get(original["format"], "image/jpeg")
+            blob = storage_client.bucket(STORAGE_BUCKET).blob(storage_path)
+            writer = blob.open("wb", chunk_size=UPLOAD_CHUNK_BYTES, content_type=content_type)
+            while chunk := stored.read(UPLOAD_CHUNK_BYTES):
+                size_bytes += len(chunk)
+                writer.write(chunk)
+                if inline_chunks is not None and size_bytes <= INLINE_IMAGE_MAX_BYTES:
+                    inline_chunks.append(chunk)
+                else:
+                    inline_chunks = None
+            writer.close()
+
+    logger.info(
+        "Image streamed to Storage",
+        extra={
+            "message_id": message_id,
+            "storage_path": storage_path,
+            "original_format": original["format"],
+            "original_size_bytes": original_bytes,
+            "size_bytes": size_bytes,
+            "transcoded": transcoded,
+            "committed": committed,
+            "elapsed_time": round(time.time() - start_time, 2),
+            "event": "image_streamed",
+        },
+    )
+    return {
+        "size_bytes": size_bytes,
+        "sha256": digest.hexdigest(),
+        "content": b"".join(inline_chunks) if committed and inline_chunks is not None else None,
+        "committed": committed,
+        "original": original,
+    }
+
+
+def _claim_image_digest(event_id: str, sha256: str, image_id: str, user_id: str) -> dict | None:
+    """
+    Register image content in the per-event digest index.
+
+    Args:
+        event_id: Event ID
+        sha256: SHA-256 hex digest of the image content
+        image_id: ID the new image will be stored under
+        user_id: LINE user ID of the sender
+
+    Returns:
+        Data of the already posted image if the same content exists in the
+        event ({"image_id", "status": "pending"} while that upload is still
+        being ingested), None if the digest was claimed for image_id (or the
+        index is unavailable)
+    """
+    digest_ref = db.collection("image_digests").document(f"{event_id}_{sha256}")
+    entry = {
+        "event_id": event_id,
+        "sha256": sha256,
+        "image_id": image_id,
+        "user_id": user_id,
+        "created_at": firestore.SERVER_TIMESTAMP,
+        "expire_at": datetime.now(UTC) + timedelta(days=DATA_RETENTION_DAYS),
+    }
+
+    try:
+        digest_ref.create(entry)
+        return None
+    except Conflict:
+        pass
+    except Exception as e:
+        logger.warning(f"Digest index unavailable, skipping duplicate check: {str(e)}")
+        return None
+
+    try:
+        return _take_over_image_digest_transaction(db.transaction(), digest_ref, entry)
+    except Exception as e:
+        logger.warning(f"Failed to resolve digest index entry: {str(e)}")
+    return None
+
+
+@firestore.transactional
+def _take_over_image_digest_transaction(transaction, digest_ref, entry: dict) -> dict | None:
+    """
+    Take over a stale digest entry, or report the image it points at.
+
+    An entry is stale when its image was soft-deleted, or when the image doc
+    never appeared within DIGEST_CLAIM_TIMEOUT_SECONDS (the ingest failed).
+    A younger entry without an image doc is a concurrent upload of the same
+    content, so it is reported as a duplicate instead of being overwritten.
+    """
+    current = digest_ref.get(transaction=transaction).to_dict() or {}
+    existing_image_id = current.get("image_id")
+    existing_doc = (
+        db.collection("images").document(existing_image_id).get(transaction=transaction) if existing_image_id else None
+    )
+    if existing_doc and existing_doc.exists:
+        existing = existing_doc.to_dict()
+        if not existing.get("deleted_at"):
+            return existing
+    else:
+        created_at = current.get("created_at")
+        if created_at and datetime.now(UTC) - created_at < timedelta(seconds=DIGEST_CLAIM_TIMEOUT_SECONDS):
+            return {"image_id": existing_image_id, "status": "pending"}
+
+    transaction.set(digest_ref, entry)
+    return None
+
+
+def _release_image_digest(event_id: str, sha256: str, image_id: str):
+    """Remove a digest index entry if it still points at image_id."""
+    digest_ref = db.collection("image_digests").document(f"{event_id}_{sha256}")
+    try:
+        snapshot = digest_ref.get()
+        if snapshot.exists and snapshot.to_dict().get("image_id") == image_id:
+            digest_ref.delete()
+    except Exception as e:
+        logger.warning(f"Failed to release digest index entry for image {image_id}: {str(e)}")
+
+
+def _duplicate_image_message(existing: dict) -> TextMessage:
+    """Build the reply for a photo that was already posted to the event."""
+    total_score = existing.get("total_score")
+    if existing.get("status") == "completed" and total_score is not None:
+        return TextMessage(text=f"📸 この写真はすでに投稿されています！\n\nスコア: {total_score}点")
+    return TextMessage(text="📸 この写真はすでに受け付けています。\n\nスコアリング結果をお待ちください ⏳")
+
+
+def _register_image_set(image_set, user_id: str, event_id: str) -> bool:
+    """
+    Create the image_sets document for a multi-image send if it does not exist.
+
+    The first event of a set to get here owns the reply for the whole set, so
+    guests see one loading message instead of one per photo.
+
+    Returns:
+        True if this call created the document
+    """
+    try:
+        db.collection("image_sets").document(image_set.id).create(
+            {
+                "user_id": user_id,
+                "event_id": event_id,
+                "total": image_set.total,
+                "results": [],
+                "skipped": 0,
+                "rate_limited": 0,
+                "duplicates": 0,
+                "failed": 0,
+                "notified": False,
+                "created_at": firestore.SERVER_TIMESTAMP,
+                "expire_at": datetime.now(UTC) + timedelta(days=WEBHOOK_DELIVERY_RETENTION_DAYS),
+            }
+        )
+        return True
+    except Conflict:
+        return False
+
+
+def _rate_limit_retry_after(times, now: float, burst: int, sustained: int) -> float | None:
+    """
+    Check a sliding-window upload log against the burst and sustained limits.
+
+    Args:
+        times: Upload timestamps (epoch seconds) within the sustained window, oldest first
+        now: Current time (epoch seconds)
+        burst: Uploads allowed within UPLOAD_BURST_WINDOW_SECONDS
+        sustained: Uploads allowed within UPLOAD_SUSTAINED_WINDOW_SECONDS
+
+    Returns:
+        None if another upload is allowed, otherwise seconds until a slot frees up
+    """
+    recent = [t for t in times if t > now - UPLOAD_BURST_WINDOW_SECONDS]
+    if len(recent) >= burst:
+        return recent[-burst] + UPLOAD_BURST_WINDOW_SECONDS - now
+    if len(times) >= sustained:
+        return times[-sustained] + UPLOAD_SUSTAINED_WINDOW_SECONDS - now
+    return None
+
+
+@firestore.transactional
+def _acquire_upload_slot_transaction(transaction, rate_ref, now: float, burst: int, sustained: int):
+    """Record an upload in the shared window unless it is over the limit."""
+    snapshot = rate_ref.get(transaction=transaction)
+    times = snapshot.to_dict().get("times", []) if snapshot.exists else []
+    times = [t for t in times if t > now - UPLOAD_SUSTAINED_WINDOW_SECONDS]
+
+    retry_after = _rate_limit_retry_after(times, now, burst, sustained)
+    if retry_after is None:
+        times.append(now)
+        transaction.set(
+            rate_ref,
+            {
+                "times": times,
+                "expire_at": datetime.now(UTC) + timedelta(seconds=UPLOAD_SUSTAINED_WINDOW_SECONDS * 2),
+            },
+        )
+    return retry_after, times
+
+
+def _acquire_upload_slot(user_id: str, event_id: str, event_status: str) -> float | None:
+    """
+    Apply the per-user upload rate limit before any storage or scoring work.
+
+    The per-instance window rejects obvious floods without a Firestore round
+    trip; otherwise a transaction on upload_rates/{event_id}_{user_id} decides,
+    so the limit holds across instances. Firestore errors fail open.
+
+    Args:
+        user_id: LINE user ID
+        event_id: Event ID
+        event_status: Event status selecting the limits (draft/active)
+
+    Returns:
+        None if the upload may proceed, otherwise seconds until the user can retry
+    """
+    burst, sustained = UPLOAD_RATE_LIMITS.get(event_status, UPLOAD_RATE_LIMITS["active"])
+    key = f"{event_id}_{user_id}"
+    now = time.time()
+
+    with _upload_times_lock:
+        local_times = _upload_times.setdefault(key, deque())
+        while local_times and local_times[0] <= now - UPLOAD_SUSTAINED_WINDOW_SECONDS:
+            local_times.popleft()
+        retry_after = _rate_limit_retry_after(list(local_times), now, burst, sustained)
+        if retry_after is not None:
+            upload_rate_stats["limited"] += 1
+            upload_rate_stats["limited_locally"] += 1
+            return retry_after
+
+    try:
+        rate_ref = db.collection("upload_rates").document(key)
+        retry_after, shared_times = _acquire_upload_slot_transaction(db.transaction(), rate_ref, now, burst, sustained)
+    except Exception as e:
+        logger.warning(f"Shared upload rate limit unavailable, using local window: {str(e)}")
+        retry_after, shared_times = None, [*local_times, now]
+
+    with _upload_times_lock:
+        # Adopt the shared window so later checks on this instance see other instances' uploads
+        _upload_times[key] = deque(shared_times)
+        _upload_times.move_to_end(key)
+        while len(_upload_times) > UPLOAD_TIMES_MAX_ENTRIES:
+            _upload_times.popitem(last=False)
+        upload_rate_stats["limited" if retry_after is not None else "allowed"] += 1
+    return retry_after
+
+
+@firestore.transactional
+def _count_image_set_item_transaction(transaction, set_ref, field: str) -> bool:
+    """Increment a skipped/rate_limited/duplicates/failed counter and report whether every image is accounted for."""
+    snapshot = set_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+
+    data = snapshot.to_dict()
+    data[field] = data.get(field, 0) + 1
+    transaction.update(set_ref, {field: data[field]})
+
+    done = (
+        len(data.get("results", []))
+        + len(data.get("failed_image_ids", []))
+        + data.get("skipped", 0)
+        + data.get("rate_limited", 0)
+        + data.get("duplicates", 0)
+        + data.get("failed", 0)
+    )
+    return done >= (data.get("total") or 0) and not data.get("notified")
+
+
+def _count_image_set_item(image_set_id: str, user_id: str, field: str):
+    """
+    Record an image of a set that will not be scored.
+
+    If it was the last outstanding image, ask the scoring function to send the
+    combined result for the set.
+    """
+    try:
+        set_ref = db.collection("image_sets").document(image_set_id)
+        complete = _count_image_set_item_transaction(db.transaction(), set_ref, field)
+    except Exception as e:
+        logger.error(f"Failed to update image set {image_set_id}: {str(e)}")
+        return
+
+    if complete and SCORING_FUNCTION_URL:
+        trigger_scoring_function("", user_id, image_set_id=image_set_id)
+
+
+@on_event(MessageEvent, message=ImageMessageContent)
 def handle_image_message(event: MessageEvent):
     """
     Handle image message event.
@@ -578,78 +2386,170 @@ def handle_image_message(event: MessageEvent):
     user_id = event.source.user_id
     message_id = event.message.id
     reply_token = event.reply_token
+    image_set = event.message.image_set
 
     logger.info(f"Image message from {user_id}: {message_id}")
 
     # Find user's active (registered) event
-    user_doc, _user_ref = _find_user_by_status(user_id, "registered")
+    registration = _find_registration(user_id, include_pending=False)
 
-    if not user_doc:
+    if not registration or registration["join_status"] != "registered":
         message = TextMessage(
             text="イベントに参加してからお写真を送ってください。\n\n「JOIN 参加コード」でイベントに参加できます。"
         )
         messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
         return
 
-    user_data = user_doc.to_dict()
-    event_id = user_data.get("event_id")
-    user_name = user_data.get("name", "ゲスト")
+    event_id = registration["event_id"]
+    user_name = registration["name"] or "ゲスト"
+    # Scoring schedules a guest's first photo ahead of repeat uploads
+    upload_class = "repeat" if registration["has_uploads"] else "first"
 
     if not event_id:
-        logger.error(f"User {user_id} has no event_id in document {user_doc.id}")
+        logger.error(f"User {user_id} has no event_id in document {registration['doc_id']}")
         message = TextMessage(text="エラーが発生しました。もう一度イベントに参加してください。")
         messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
         return
 
+    # Multi-image send: only the first image of the set replies
+    owns_reply = image_set is None or _register_image_set(image_set, user_id, event_id)
+
     # Reject image if event is no longer active
-    event_doc = db.collection("events").document(event_id).get()
-    if not event_doc.exists:
+    event_info = _get_event(event_id)
+    if not event_info:
         logger.error(f"Event not found: {event_id}")
-        message = TextMessage(text="イベントが見つかりません。\nもう一度参加してください。")
-        messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
+        if owns_reply:
+            message = TextMessage(text="イベントが見つかりません。\nもう一度参加してください。")
+            messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
         return
 
-    event_status = event_doc.to_dict().get("status")
+    event_status = event_info["status"]
+    result_delivery = event_info["result_delivery"]
+    user_ref = db.collection("users").document(registration["doc_id"])
+    draft_slot_reserved = False
     if event_status == "draft":
-        current_count = _count_user_images(user_id, event_id)
-        if current_count >= DRAFT_UPLOAD_LIMIT:
+        draft_slot_reserved, current_count = _reserve_draft_upload_transaction(
+            db.transaction(), user_ref, user_id, event_id
+        )
+        if current_count is None:
+            logger.error(f"User document not found: {registration['doc_id']}")
+            if owns_reply:
+                message = TextMessage(text="エラーが発生しました。もう一度イベントに参加してください。")
+                messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
+            return
+        if not draft_slot_reserved:
             logger.info(
                 f"Draft upload limit reached: user {user_id} event {event_id} ({current_count}/{DRAFT_UPLOAD_LIMIT})"
             )
-            message = TextMessage(
-                text=f"📸 お試し版では{DRAFT_UPLOAD_LIMIT}枚まで投稿できます。\n\n"
-                f"現在 {current_count}/{DRAFT_UPLOAD_LIMIT} 枚です。\n"
-                "画像を削除すると、再度投稿できます。"
-            )
-            messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
+            if image_set:
+                _count_image_set_item(image_set.id, user_id, "skipped")
+            if owns_reply:
+                message = TextMessage(
+                    text=f"📸 お試し版では{DRAFT_UPLOAD_LIMIT}枚まで投稿できます。\n\n"
+                    f"現在 {current_count}/{DRAFT_UPLOAD_LIMIT} 枚です。\n"
+                    "画像を削除すると、再度投稿できます。"
+                )
+                messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
             return
     elif event_status != "active":
         logger.info(f"Image rejected: event {event_id} status is {event_status}")
-        message = TextMessage(text="このイベントは終了しました。\n\n写真の投稿は受け付けていません。")
-        messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
+        if owns_reply:
+            message = TextMessage(text="このイベントは終了しました。\n\n写真の投稿は受け付けていません。")
+            messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
+        return
+
+    # Shed load from a single fast sender before any storage or scoring work
+    retry_after = _acquire_upload_slot(user_id, event_id, event_status)
+    if retry_after is not None:
+        logger.info(
+            "Upload rate limited",
+            extra={
+                "user_id": user_id,
+                "event_id": event_id,
+                "event_status": event_status,
+                "retry_after": round(retry_after, 1),
+                "event": "upload_rate_limited",
+            },
+        )
+        if draft_slot_reserved:
+            _release_upload(user_ref)
+        if image_set:
+            _count_image_set_item(image_set.id, user_id, "rate_limited")
+        if owns_reply:
+            message = TextMessage(
+                text="📸 写真の送信ペースが速すぎます！\n\n"
+                f"約{max(1, round(retry_after))}秒後に、もう一度送ってください 🙏"
+            )
+            messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[message]))
         return
 
-    # Send loading message
-    loading_message = TextMessage(text="📸 画像を受け取りました！\n\nAIが笑顔を分析中...\nしばらくお待ちください ⏳")
-    messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[loading_message]))
+    # Send loading message (once per multi-image send)
+    if owns_reply:
+        loading_message = _build_loading_message(event_id, image_set)
+        messaging_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=[loading_message]))
 
+    image_committed = False
     try:
-        # Download image from LINE
-        image_bytes = bytes(messaging_api_blob.get_message_content(message_id))
-
         # Generate unique image ID and path
         image_id = str(uuid.uuid4())
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         storage_path = f"{event_id}/original/{user_id}/{timestamp}_{image_id}.jpg"
 
-        # Upload to Cloud Storage
-        bucket = storage_client.bucket(STORAGE_BUCKET)
-        blob = bucket.blob(storage_path)
-        blob.upload_from_string(image_bytes, content_type="image/jpeg")
+        # Ingest graph: signing and the scoring ID token only need the object
+        # path, so they run while the image streams into Cloud Storage
+        step_times = {}
+        ingest_start = time.time()
+        duplicate_of = {}
+        claimed_digests = []
+
+        def claim_digest(sha256: str) -> bool:
+            # Exact duplicates within the event are not stored or scored again
+            existing = _timed_step(step_times, "digest", _claim_image_digest, event_id, sha256, image_id, user_id)
+            if existing:
+                duplicate_of.update(existing)
+                return False
+            claimed_digests.append(sha256)
+            return True
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            sign_future = None
+            if STORE_SIGNED_URLS:
+                sign_future = executor.submit(
+                    _timed_step, step_times, "sign", generate_signed_url, STORAGE_BUCKET, storage_path
+                )
+            if SCORING_FUNCTION_URL:
+                executor.submit(_timed_step, step_times, "id_token", _get_scoring_id_token)
+
+            try:
+                content_info = _timed_step(
+                    step_times, "upload", stream_message_content_to_storage, message_id, storage_path, claim_digest
+                )
+            except Exception:
+                # e.g. rejected while transcoding after the digest was claimed
+                for sha256 in claimed_digests:
+                    _release_image_digest(event_id, sha256, image_id)
+                raise
+
+        if not content_info["committed"]:
+            logger.info(
+                "Duplicate image skipped",
+                extra={
+                    "message_id": message_id,
+                    "event_id": event_id,
+                    "sha256": content_info["sha256"],
+                    "event": "duplicate_image_skipped",
+                },
+            )
+            if image_set:
+                _count_image_set_item(image_set.id, user_id, "duplicates")
+            else:
+                messaging_api.push_message(
+                    PushMessageRequest(to=user_id, messages=[_duplicate_image_message(duplicate_of)])
+                )
+            return
 
         logger.info(f"Image uploaded to Storage: {storage_path}")
 
-        # Generate signed URL for immediate display
         image_doc_data = {
             "user_id": user_id,
             "user_name": user_name,
@@ -658,36 +2558,122 @@ def handle_image_message(event: MessageEvent):
             "upload_timestamp": firestore.SERVER_TIMESTAMP,
             "status": "pending",
             "line_message_id": message_id,
+            "size_bytes": content_info["size_bytes"],
+            "sha256": content_info["sha256"],
+            "original_format": content_info["original"]["format"],
+            "original_width": content_info["original"]["width"],
+            "original_height": content_info["original"]["height"],
+            "bytes_saved": content_info["original"]["size_bytes"] - content_info["size_bytes"],
             "expire_at": datetime.now(UTC) + timedelta(days=DATA_RETENTION_DAYS),
         }
+        # Kept so re-driven and bulk scorings schedule and deliver like the original
+        image_doc_data["upload_class"] = upload_class
+        if result_delivery:
+            image_doc_data["result_delivery"] = result_delivery
+        if image_set:
+            image_doc_data["image_set_id"] = image_set.id
+            image_doc_data["image_set_index"] = image_set.index
+
+        if sign_future:
+            try:
+                signed_url, expiration_time = sign_future.result()
+                image_doc_data["storage_url"] = signed_url
+                image_doc_data["storage_url_expires_at"] = expiration_time
+                logger.info(f"Signed URL generated for image {image_id}")
+            except Exception as e:
+                logger.warning(f"Failed to generate signed URL for image {image_id}: {str(e)}")
+                # Continue without signed URL - scoring function will generate it later
 
-        try:
-            signed_url, expiration_time = generate_signed_url(STORAGE_BUCKET, storage_path)
-            image_doc_data["storage_url"] = signed_url
-            image_doc_data["storage_url_expires_at"] = expiration_time
-            logger.info(f"Signed URL generated for image {image_id}")
-        except Exception as e:
-            logger.warning(f"Failed to generate signed URL for image {image_id}: {str(e)}")
-            # Continue without signed URL - scoring function will generate it later
-
-        # Create image doc and increment event counter atomically
+        # Create image doc and increment event and user counters atomically
         image_ref = db.collection("images").document(image_id)
         event_ref = db.collection("events").document(event_id)
         batch = db.batch()
         batch.set(image_ref, image_doc_data)
         batch.update(event_ref, {"image_count": firestore.Increment(1)})
-        batch.commit()
+        if not draft_slot_reserved:
+            # Draft uploads were counted when the slot was reserved
+            batch.update(user_ref, {"active_uploads": firestore.Increment(1)})
+        batch.set(
+            db.collection("scoring_backlog").document(event_id),
+            {"pending": firestore.Increment(1), "updated_at": firestore.SERVER_TIMESTAMP},
+            merge=True,
+        )
+        try:
+            _timed_step(step_times, "firestore", batch.commit)
+        except Exception:
+            _release_image_digest(event_id, content_info["sha256"], image_id)
+            _invalidate_event(event_id)  # e.g. the event was deleted since it was cached
+            raise
+        image_committed = True
 
         logger.info(f"Firestore document created: {image_id}")
 
+        if upload_class == "first":
+            _mark_first_upload(user_id, registration)
+
         # Trigger scoring function (asynchronously)
         if SCORING_FUNCTION_URL:
-            trigger_scoring_function(image_id, user_id)
+            if image_set:
+                _timed_step(
+                    step_times,
+                    "trigger",
+                    trigger_scoring_function,
+                    image_id,
+                    user_id,
+                    image_set_id=image_set.id,
+                    image_set_index=image_set.index,
+                    image_bytes=content_info["content"],
+                    event_id=event_id,
+                    upload_class=upload_class,
+                )
+            else:
+                _timed_step(
+                    step_times,
+                    "trigger",
+                    trigger_scoring_function,
+                    image_id,
+                    user_id,
+                    image_bytes=content_info["content"],
+                    event_id=event_id,
+                    upload_class=upload_class,
+                    result_delivery=result_delivery,
+                )
         else:
             logger.warning("SCORING_FUNCTION_URL not set, skipping scoring trigger")
 
+        logger.info(
+            "Image ingest completed",
+            extra={
+                "image_id": image_id,
+                "step_times": step_times,
+                "elapsed_time": round(time.time() - ingest_start, 2),
+                "event": "image_ingest_completed",
+            },
+        )
+
+    except ImageTooLargeError as e:
+        logger.warning(f"Image {message_id} rejected: {str(e)}")
+        if image_set:
+            _count_image_set_item(image_set.id, user_id, "failed")
+            return
+        messaging_api.push_message(
+            PushMessageRequest(
+                to=user_id,
+                messages=[
+                    TextMessage(
+                        text=f"画像サイズが大きすぎます（上限 {MAX_IMAGE_BYTES // (1024 * 1024)}MB）。\n\n"
+                        "小さいサイズで送り直してください。"
+                    )
+                ],
+            )
+        )
+
     except ApiException as e:
         logger.error(f"LINE API error: {e.status} {e.reason}")
+        if image_set:
+            # Reported in the combined result for the set
+            _count_image_set_item(image_set.id, user_id, "failed")
+            return
         messaging_api.push_message(
             PushMessageRequest(
                 to=user_id,
@@ -697,6 +2683,9 @@ def handle_image_message(event: MessageEvent):
 
     except Exception as e:
         logger.error(f"Failed to process image: {str(e)}")
+        if image_set:
+            _count_image_set_item(image_set.id, user_id, "failed")
+            return
         messaging_api.push_message(
             PushMessageRequest(
                 to=user_id,
@@ -704,42 +2693,103 @@ def handle_image_message(event: MessageEvent):
             )
         )
 
+    finally:
+        # A reserved draft slot that produced no image (duplicate, failure) is given back
+        if draft_slot_reserved and not image_committed:
+            _release_upload(user_ref)
+
 
-def trigger_scoring_function(image_id: str, user_id: str):
+def _get_scoring_id_token(force_refresh: bool = False) -> str:
+    """
+    Return an ID token for the scoring function, reusing it for up to 50 minutes.
+
+    Args:
+        force_refresh: Fetch a new token even if a cached one is available
+
+    Returns:
+        ID token with SCORING_FUNCTION_URL as audience
+    """
+    global _scoring_id_token
+
+    with _scoring_id_token_lock:
+        if (
+            not force_refresh
+            and _scoring_id_token
+            and time.monotonic() - _scoring_id_token[1] < SCORING_ID_TOKEN_TTL_SECONDS
+        ):
+            return _scoring_id_token[0]
+
+        auth_req = AuthRequest()
+        if os.environ.get("K_SERVICE"):
+            # Cloud Functions: use metadata server
+            id_token_value = id_token.fetch_id_token(auth_req, SCORING_FUNCTION_URL)
+        else:
+            # Local: impersonate the webhook service account
+            source_creds, _ = google.auth.default()
+            impersonated = imp_creds.Credentials(
+                source_credentials=source_creds,
+                target_principal=f"webhook-function-sa@{GCP_PROJECT_ID}.iam.gserviceaccount.com",
+                target_scopes=["https://www.googleapis.com/auth/cloud-platform"],
+            )
+            id_token_creds = imp_creds.IDTokenCredentials(
+                target_credentials=impersonated,
+                target_audience=SCORING_FUNCTION_URL,
+            )
+            id_token_creds.refresh(auth_req)
+            id_token_value = id_token_creds.token
+
+        _scoring_id_token = (id_token_value, time.monotonic())
+        return id_token_value
+
+
+def trigger_scoring_function(
+    image_id: str,
+    user_id: str,
+    image_set_id: str | None = None,
+    image_set_index: int | None = None,
+    image_bytes: bytes | None = None,
+    event_id: str | None = None,
+    upload_class: str | None = None,
+    result_delivery: str | None = None,
+):
     """
     Trigger scoring function via HTTP with authentication.
     Implements retry logic for authentication failures.
 
     Args:
-        image_id: Image document ID
+        image_id: Image document ID (empty to only finalize an image set)
         user_id: User ID
+        image_set_id: imageSet ID when the image is part of a multi-image send
+        image_set_index: 1-based position of the image within the set
+        image_bytes: Image content to hand over inline (scoring downloads it
+            from Cloud Storage when omitted)
+        event_id: Event ID, used by scoring for fair scheduling across events
+        upload_class: "first" for a guest's first upload, "repeat" otherwise
+        result_delivery: Event's result delivery mode ("two_phase" pushes the
+            smile score before the AI comment)
     """
     max_retries = 3
     retry_delay = 1.0  # seconds
 
+    payload = {"image_id": image_id, "user_id": user_id}
+    if image_set_id:
+        payload["image_set_id"] = image_set_id
+        payload["image_set_index"] = image_set_index
+    if event_id:
+        payload["event_id"] = event_id
+    if upload_class:
+        payload["upload_class"] = upload_class
+    if result_delivery:
+        payload["result_delivery"] = result_delivery
+    if image_bytes is not None:
+        payload["image_base64"] = base64.b64encode(image_bytes).decode("ascii")
+        payload["image_sha256"] = hashlib.sha256(image_bytes).hexdigest()
+
     for attempt in range(max_retries):
         try:
-            payload = {"image_id": image_id, "user_id": user_id}
-
             # Get ID token for authenticating to the scoring function
-            auth_req = AuthRequest()
-            if os.environ.get("K_SERVICE"):
-                # Cloud Functions: use metadata server
-                id_token_value = id_token.fetch_id_token(auth_req, SCORING_FUNCTION_URL)
-            else:
-                # Local: impersonate the webhook service account
-                source_creds, _ = google.auth.default()
-                impersonated = imp_creds.Credentials(
-                    source_credentials=source_creds,
-                    target_principal=f"webhook-function-sa@{GCP_PROJECT_ID}.iam.gserviceaccount.com",
-                    target_scopes=["https://www.googleapis.com/auth/cloud-platform"],
-                )
-                id_token_creds = imp_creds.IDTokenCredentials(
-                    target_credentials=impersonated,
-                    target_audience=SCORING_FUNCTION_URL,
-                )
-                id_token_creds.refresh(auth_req)
-                id_token_value = id_token_creds.token
+            # (fetch a fresh one when retrying, in case the cached token was rejected)
+            id_token_value = _get_scoring_id_token(force_refresh=attempt > 0)
 
             headers = {
                 "Authorization": f"Bearer {id_token_value}",
@@ -795,7 +2845,33 @@ def trigger_scoring_function(image_id: str, user_id: str):
             return  # Give up after max retries or non-retryable error
 
 
-@handler.add(UnsendEvent)
+@firestore.transactional
+def _delete_image_transaction(transaction, image_ref) -> bool:
+    """
+    Delete an image document, draining the backlog gauge if it was still pending.
+
+    Scoring drains the gauge when it moves an image out of pending; an image
+    deleted before that never gets scored, so it is taken off the gauge here.
+
+    Returns:
+        True if the document was deleted, False if it no longer existed
+    """
+    snapshot = image_ref.get(transaction=transaction)
+    if not snapshot.exists:
+        return False
+
+    data = snapshot.to_dict() or {}
+    transaction.delete(image_ref)
+    if data.get("status") == "pending" and data.get("event_id"):
+        transaction.set(
+            db.collection("scoring_backlog").document(data["event_id"]),
+            {"pending": firestore.Increment(-1), "updated_at": firestore.SERVER_TIMESTAMP},
+            merge=True,
+        )
+    return True
+
+
+@on_event(UnsendEvent)
 def handle_unsend(event):
     """
     Handle message unsend event.
@@ -834,9 +2910,19 @@ def handle_unsend(event):
                 logger.warning(f"Failed to delete from Storage: {str(e)}")
 
         # Delete from Firestore
-        image_doc.reference.delete()
+        if not _delete_image_transaction(db.transaction(), image_doc.reference):
+            logger.info(f"Image document already deleted: {image_doc.id}")
+            return
         logger.info(f"Deleted image document: {image_doc.id}")
 
+        # Soft-deleted images were already taken off the guest's upload count
+        if image_data.get("event_id") and not image_data.get("deleted_at"):
+            _release_upload(db.collection("users").document(f"{user_id}_{image_data['event_id']}"))
+
+        # Allow the same photo to be posted again
+        if image_data.get("sha256") and image_data.get("event_id"):
+            _release_image_digest(image_data["event_id"], image_data["sha256"], image_doc.id)
+
     except Exception as e:
         logger.error(f"Failed to handle unsend event: {str(e)}")
 
@@ -845,7 +2931,7 @@ def handle_unsend(event):
 UNSUPPORTED_CONTENT_MESSAGE = "画像を投稿しよう！"
 
 
-@handler.add(MessageEvent, message=VideoMessageContent)
+@on_event(MessageEvent, message=VideoMessageContent)
 def handle_video_message(event: MessageEvent):
     """Handle video message - inform user that only images are supported."""
     messaging_api.reply_message(
@@ -856,7 +2942,7 @@ def handle_video_message(event: MessageEvent):
     )
 
 
-@handler.add(MessageEvent, message=StickerMessageContent)
+@on_event(MessageEvent, message=StickerMessageContent)
 def handle_sticker_message(event: MessageEvent):
     """Handle sticker message - inform user that only images are supported."""
     messaging_api.reply_message(
@@ -867,7 +2953,7 @@ def handle_sticker_message(event: MessageEvent):
     )
 
 
-@handler.add(MessageEvent, message=AudioMessageContent)
+@on_event(MessageEvent, message=AudioMessageContent)
 def handle_audio_message(event: MessageEvent):
     """Handle audio message - inform user that only images are supported."""
     messaging_api.reply_message(
@@ -878,7 +2964,7 @@ def handle_audio_message(event: MessageEvent):
     )
 
 
-@handler.add(MessageEvent, message=LocationMessageContent)
+@on_event(MessageEvent, message=LocationMessageContent)
 def handle_location_message(event: MessageEvent):
     """Handle location message - inform user that only images are supported."""
     messaging_api.reply_message(
@@ -889,7 +2975,7 @@ def handle_location_message(event: MessageEvent):
     )
 
 
-@handler.add(MessageEvent, message=FileMessageContent)
+@on_event(MessageEvent, message=FileMessageContent)
 def handle_file_message(event: MessageEvent):
     """Handle file message - inform user that only images are supported."""
     messaging_api.reply_message(
@@ -1016,22 +3102,14 @@ def liff_join(request: Request):
         logger.info(f"LIFF JOIN request from {user_id} ({display_name}) with code: {event_code}")
 
         # Look up event by event_code
-        events_ref = db.collection("events")
-        q = (
-            events_ref.where(filter=firestore.FieldFilter("event_code", "==", event_code))
-            .where(filter=firestore.FieldFilter("status", "in", ["active", "draft"]))
-            .limit(1)
-        )
-        event_docs = list(q.stream())
+        event = _find_event_by_code(event_code)
 
-        if not event_docs:
+        if not event:
             return (jsonify({"error": "参加コードが見つかりません"}), 404, cors_headers)
 
-        event_doc = event_docs[0]
-        event_data = event_doc.to_dict()
-        event_id = event_doc.id
-        event_name = event_data.get("event_name", "イベント")
-        event_status = event_data.get("status")
+        event_id = event["event_id"]
+        event_name = event["event_name"]
+        event_status = event["status"]
 
         # Deactivate registrations in other events
         _deactivate_other_registrations(user_id, event_id)
@@ -1042,12 +3120,13 @@ def liff_join(request: Request):
 
         @firestore.transactional
         def join_with_name(transaction, user_ref):
-            doc = user_ref.get(transaction=transaction)
+            pointer_ref, pointer, doc, previous_ref = _read_join_state(transaction, user_ref, user_id)
 
             if doc.exists:
                 data = doc.to_dict()
                 status = data.get("join_status")
                 existing_name = data.get("name")
+                has_uploads = data.get("total_uploads")
 
                 if status == "left":
                     # Reactivate with existing name or new display name
@@ -1058,10 +3137,12 @@ def liff_join(request: Request):
                             "name": existing_name or display_name,
                         },
                     )
-                    return {"status": "reactivated", "name": existing_name or display_name}
+                    result = {"status": "reactivated", "name": existing_name or display_name}
+                    join_status, pointer_name = "registered", existing_name or display_name
                 else:
                     # Already registered
-                    return {"status": "already_joined", "name": existing_name or display_name}
+                    result = {"status": "already_joined", "name": existing_name or display_name}
+                    join_status, pointer_name = status, existing_name
             else:
                 # New user - register with LINE display name
                 transaction.set(
@@ -1073,13 +3154,24 @@ def liff_join(request: Request):
                         "join_status": "registered",
                         "created_at": firestore.SERVER_TIMESTAMP,
                         "total_uploads": 0,
+                        "active_uploads": 0,
                         "best_score": 0,
                     },
                 )
-                return {"status": "joined", "name": display_name}
+                result = {"status": "joined", "name": display_name}
+                join_status, pointer_name, has_uploads = "registered", display_name, False
+
+            if previous_ref:
+                transaction.update(previous_ref, {"join_status": "left"})
+                logger.info(f"Deactivated registration {previous_ref.id} for user {user_id}")
+            _set_line_user_pointer(
+                transaction, pointer_ref, pointer, user_ref, event_id, join_status, pointer_name, has_uploads
+            )
+            return result
 
         transaction = db.transaction()
         result = join_with_name(transaction, user_ref)
+        _invalidate_registration(user_id)
 
         logger.info(f"LIFF JOIN result for {user_id}: {result['status']}")
 
@@ -14,6 +14,8 @@ resource "google_project_service" "required_apis" {
     "cloudfunctions.googleapis.com",
     "cloudbuild.googleapis.com",
     "monitoring.googleapis.com",
+    "cloudscheduler.googleapis.com",
+    "eventarc.googleapis.com",
     # Uncomment as modules are implemented:
     # "run.googleapis.com",
     # "logging.googleapis.com",
@@ -100,6 +102,66 @@ resource "google_firestore_field" "images_ttl" {
   depends_on = [module.firestore]
 }
 
+# Firestore TTL Policy - Auto-delete processed webhook deliveries
+resource "google_firestore_field" "webhook_deliveries_ttl" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "webhook_deliveries"
+  field      = "expire_at"
+
+  ttl_config {}
+
+  depends_on = [module.firestore]
+}
+
+# Firestore TTL Policy - Auto-delete webhook idempotency records
+resource "google_firestore_field" "webhook_events_ttl" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "webhook_events"
+  field      = "expire_at"
+
+  ttl_config {}
+
+  depends_on = [module.firestore]
+}
+
+# Firestore TTL Policy - Auto-delete per-event image digest index entries
+resource "google_firestore_field" "image_digests_ttl" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "image_digests"
+  field      = "expire_at"
+
+  ttl_config {}
+
+  depends_on = [module.firestore]
+}
+
+# Firestore TTL Policy - Auto-delete per-user upload rate windows
+resource "google_firestore_field" "upload_rates_ttl" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "upload_rates"
+  field      = "expire_at"
+
+  ttl_config {}
+
+  depends_on = [module.firestore]
+}
+
+# Firestore TTL Policy - Auto-delete multi-image send (imageSet) tracking docs
+resource "google_firestore_field" "image_sets_ttl" {
+  project    = var.project_id
+  database   = "(default)"
+  collection = "image_sets"
+  field      = "expire_at"
+
+  ttl_config {}
+
+  depends_on = [module.firestore]
+}
+
 # IAM Module - Service accounts and permissions for Cloud Functions
 module "iam" {
   source = "./modules/iam"
@@ -81,6 +81,8 @@ resource "google_cloudfunctions2_function" "webhook" {
       SCORING_FUNCTION_URL = "https://${var.region}-${var.project_id}.cloudfunctions.net/scoring"
       CURRENT_EVENT_ID     = var.current_event_id
       DATA_RETENTION_DAYS  = tostring(var.data_retention_days)
+
+      WEBHOOK_PROCESSING_MODE = "deferred"
     }
 
     secret_environment_variables {
@@ -105,6 +107,92 @@ resource "google_cloudfunctions2_function" "webhook" {
   }
 }
 
+# Webhook Worker Cloud Function (Gen2)
+# Runs LINE event handlers for deliveries persisted by the webhook in deferred mode
+resource "google_cloudfunctions2_function" "webhook_worker" {
+  name        = "webhook-worker"
+  location    = var.region
+  description = "Deferred LINE webhook event processor"
+  project     = var.project_id
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "webhook_worker"
+
+    source {
+      storage_source {
+        bucket = var.storage_bucket_name
+        object = google_storage_bucket_object.webhook_source.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count    = 100
+    min_instance_count    = 0
+    available_memory      = "512M"
+    timeout_seconds       = 60
+    service_account_email = var.webhook_service_account_email
+
+    environment_variables = {
+      GCP_PROJECT_ID       = var.project_id
+      STORAGE_BUCKET       = var.storage_bucket_name
+      SCORING_FUNCTION_URL = "https://${var.region}-${var.project_id}.cloudfunctions.net/scoring"
+      CURRENT_EVENT_ID     = var.current_event_id
+      DATA_RETENTION_DAYS  = tostring(var.data_retention_days)
+    }
+
+    secret_environment_variables {
+      key        = "LINE_CHANNEL_SECRET"
+      project_id = var.project_id
+      secret     = var.line_channel_secret_name
+      version    = "latest"
+    }
+
+    secret_environment_variables {
+      key        = "LINE_CHANNEL_ACCESS_TOKEN"
+      project_id = var.project_id
+      secret     = var.line_channel_access_token_name
+      version    = "latest"
+    }
+  }
+
+  # Failed or stuck deliveries are re-driven; the worker claims each delivery
+  # through its status and caps attempts (WEBHOOK_DELIVERY_MAX_ATTEMPTS)
+  event_trigger {
+    trigger_region        = var.region
+    event_type            = "google.cloud.firestore.document.v1.created"
+    retry_policy          = "RETRY_POLICY_RETRY"
+    service_account_email = var.webhook_service_account_email
+
+    event_filters {
+      attribute = "database"
+      value     = "(default)"
+    }
+
+    event_filters {
+      attribute = "document"
+      value     = "webhook_deliveries/{delivery_id}"
+      operator  = "match-path-pattern"
+    }
+  }
+
+  labels = {
+    environment = "production"
+    managed_by  = "terraform"
+    function    = "webhook-worker"
+  }
+}
+
+# Allow Eventarc (as webhook SA) to invoke the worker
+resource "google_cloud_run_service_iam_member" "webhook_worker_run_invoker" {
+  project  = var.project_id
+  location = var.region
+  service  = google_cloudfunctions2_function.webhook_worker.name
+  role     = "roles/run.invoker"
+  member   = "serviceAccount:${var.webhook_service_account_email}"
+}
+
 # Scoring Cloud Function (Gen2)
 resource "google_cloudfunctions2_function" "scoring" {
   name        = "scoring"
@@ -125,16 +213,25 @@ resource "google_cloudfunctions2_function" "scoring" {
   }
 
   service_config {
-    max_instance_count    = 100
-    min_instance_count    = 0
-    available_memory      = "1Gi"
-    timeout_seconds       = 300
-    service_account_email = var.scoring_service_account_email
+    max_instance_count = 100
+    min_instance_count = 0
+    # Concurrent requests queue on the instance's fair scheduler
+    # (SCORING_MAX_CONCURRENCY run at once)
+    max_instance_request_concurrency = 16
+    available_cpu                    = "1"
+    available_memory                 = "1Gi"
+    timeout_seconds                  = 300
+    service_account_email            = var.scoring_service_account_email
 
     environment_variables = {
-      GCP_PROJECT_ID   = var.project_id
-      STORAGE_BUCKET   = var.storage_bucket_name
-      CURRENT_EVENT_ID = var.current_event_id
+      GCP_PROJECT_ID          = var.project_id
+      STORAGE_BUCKET          = var.storage_bucket_name
+      CURRENT_EVENT_ID        = var.current_event_id
+      SCORING_MAX_CONCURRENCY = "4"
+      # Images of a set are scored concurrently on the same instance; batch
+      # their face detections into one Vision request (at most
+      # SCORING_MAX_CONCURRENCY are in flight at once)
+      VISION_BATCH_MAX_SIZE = "4"
     }
 
     secret_environment_variables {
@@ -188,6 +285,164 @@ resource "google_cloud_run_service_iam_member" "scoring_run_invoker" {
   member   = "serviceAccount:${var.webhook_service_account_email}"
 }
 
+# Signed URL Refresh Cloud Function (Gen2)
+# Re-signs image URLs before they expire (signed URLs last 7 days, data is kept longer)
+resource "google_cloudfunctions2_function" "url_refresh" {
+  name        = "url-refresh"
+  location    = var.region
+  description = "Scheduled signed URL refresh for stored images"
+  project     = var.project_id
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "url_refresh"
+
+    source {
+      storage_source {
+        bucket = var.storage_bucket_name
+        object = google_storage_bucket_object.scoring_source.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count    = 1
+    min_instance_count    = 0
+    available_memory      = "512M"
+    timeout_seconds       = 540
+    service_account_email = var.scoring_service_account_email
+
+    environment_variables = {
+      GCP_PROJECT_ID = var.project_id
+      STORAGE_BUCKET = var.storage_bucket_name
+    }
+
+    secret_environment_variables {
+      key        = "LINE_CHANNEL_ACCESS_TOKEN"
+      project_id = var.project_id
+      secret     = var.line_channel_access_token_name
+      version    = "latest"
+    }
+  }
+
+  labels = {
+    environment = "production"
+    managed_by  = "terraform"
+    function    = "url-refresh"
+  }
+}
+
+# Allow the scheduler (running as the scoring service account) to invoke url-refresh
+resource "google_cloud_run_service_iam_member" "url_refresh_run_invoker" {
+  project  = var.project_id
+  location = var.region
+  service  = google_cloudfunctions2_function.url_refresh.name
+  role     = "roles/run.invoker"
+  member   = "serviceAccount:${var.scoring_service_account_email}"
+}
+
+resource "google_cloud_scheduler_job" "url_refresh" {
+  name        = "url-refresh"
+  description = "Re-sign image URLs expiring within the next 48 hours"
+  project     = var.project_id
+  region      = var.region
+  schedule    = "0 */6 * * *"
+  time_zone   = "Asia/Tokyo"
+
+  http_target {
+    http_method = "POST"
+    uri         = google_cloudfunctions2_function.url_refresh.service_config[0].uri
+    body        = base64encode(jsonencode({ window_hours = 48 }))
+    headers = {
+      "Content-Type" = "application/json"
+    }
+
+    oidc_token {
+      service_account_email = var.scoring_service_account_email
+      audience              = google_cloudfunctions2_function.url_refresh.service_config[0].uri
+    }
+  }
+}
+
+# Pending Image Reconciler Cloud Function (Gen2)
+# Re-drives images stuck in "pending" (lost trigger, timeout, crash) and poisons repeat failures
+resource "google_cloudfunctions2_function" "reconcile" {
+  name        = "reconcile"
+  location    = var.region
+  description = "Scheduled re-drive of stuck pending image scorings"
+  project     = var.project_id
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "reconcile_pending"
+
+    source {
+      storage_source {
+        bucket = var.storage_bucket_name
+        object = google_storage_bucket_object.scoring_source.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count    = 1
+    min_instance_count    = 0
+    available_memory      = "1Gi"
+    timeout_seconds       = 540
+    service_account_email = var.scoring_service_account_email
+
+    environment_variables = {
+      GCP_PROJECT_ID = var.project_id
+      STORAGE_BUCKET = var.storage_bucket_name
+    }
+
+    secret_environment_variables {
+      key        = "LINE_CHANNEL_ACCESS_TOKEN"
+      project_id = var.project_id
+      secret     = var.line_channel_access_token_name
+      version    = "latest"
+    }
+  }
+
+  labels = {
+    environment = "production"
+    managed_by  = "terraform"
+    function    = "reconcile"
+  }
+}
+
+# Allow the scheduler (running as the scoring service account) to invoke reconcile
+resource "google_cloud_run_service_iam_member" "reconcile_run_invoker" {
+  project  = var.project_id
+  location = var.region
+  service  = google_cloudfunctions2_function.reconcile.name
+  role     = "roles/run.invoker"
+  member   = "serviceAccount:${var.scoring_service_account_email}"
+}
+
+resource "google_cloud_scheduler_job" "reconcile" {
+  name        = "reconcile-pending-images"
+  description = "Re-drive images pending for more than 10 minutes"
+  project     = var.project_id
+  region      = var.region
+  schedule    = "*/5 * * * *"
+  time_zone   = "Asia/Tokyo"
+
+  http_target {
+    http_method = "POST"
+    uri         = google_cloudfunctions2_function.reconcile.service_config[0].uri
+    body        = base64encode(jsonencode({ stale_minutes = 10 }))
+    headers = {
+      "Content-Type" = "application/json"
+    }
+
+    oidc_token {
+      service_account_email = var.scoring_service_account_email
+      audience              = google_cloudfunctions2_function.reconcile.service_config[0].uri
+    }
+  }
+}
+
 # Notification Cloud Function (Gen2)
 resource "google_cloudfunctions2_function" "notification" {
   name        = "notification"
@@ -329,6 +584,132 @@ resource "google_cloud_run_service_iam_member" "liff_join_run_invoker" {
   member   = "allUsers"
 }
 
+# Image Redirect Cloud Function (Gen2)
+# Redirects to short-lived signed URLs for gallery and ranking images
+resource "google_cloudfunctions2_function" "image" {
+  name        = "image"
+  location    = var.region
+  description = "On-demand image redirect with short-lived signed URLs"
+  project     = var.project_id
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "image_redirect"
+
+    source {
+      storage_source {
+        bucket = var.storage_bucket_name
+        object = google_storage_bucket_object.webhook_source.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count               = 20
+    min_instance_count               = 0
+    max_instance_request_concurrency = 20
+    available_cpu                    = "1"
+    available_memory                 = "512M"
+    timeout_seconds                  = 30
+    service_account_email            = var.webhook_service_account_email
+
+    environment_variables = {
+      GCP_PROJECT_ID = var.project_id
+      STORAGE_BUCKET = var.storage_bucket_name
+    }
+
+    secret_environment_variables {
+      key        = "LINE_CHANNEL_SECRET"
+      project_id = var.project_id
+      secret     = var.line_channel_secret_name
+      version    = "latest"
+    }
+
+    secret_environment_variables {
+      key        = "LINE_CHANNEL_ACCESS_TOKEN"
+      project_id = var.project_id
+      secret     = var.line_channel_access_token_name
+      version    = "latest"
+    }
+  }
+
+  labels = {
+    environment = "production"
+    managed_by  = "terraform"
+    function    = "image"
+  }
+}
+
+# Scoring backlog gauge for admins (no public invoker; call with an identity token)
+resource "google_cloudfunctions2_function" "backlog" {
+  name        = "backlog"
+  location    = var.region
+  description = "Admin endpoint exposing the scoring backlog gauge"
+  project     = var.project_id
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "backlog_status"
+
+    source {
+      storage_source {
+        bucket = var.storage_bucket_name
+        object = google_storage_bucket_object.webhook_source.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count    = 2
+    min_instance_count    = 0
+    available_memory      = "256M"
+    timeout_seconds       = 30
+    service_account_email = var.webhook_service_account_email
+
+    environment_variables = {
+      GCP_PROJECT_ID = var.project_id
+    }
+
+    secret_environment_variables {
+      key        = "LINE_CHANNEL_SECRET"
+      project_id = var.project_id
+      secret     = var.line_channel_secret_name
+      version    = "latest"
+    }
+
+    secret_environment_variables {
+      key        = "LINE_CHANNEL_ACCESS_TOKEN"
+      project_id = var.project_id
+      secret     = var.line_channel_access_token_name
+      version    = "latest"
+    }
+  }
+
+  labels = {
+    environment = "production"
+    managed_by  = "terraform"
+    function    = "backlog"
+  }
+}
+
+# Make image function publicly accessible (visibility is checked per image)
+resource "google_cloudfunctions2_function_iam_member" "image_invoker" {
+  project        = var.project_id
+  location       = var.region
+  cloud_function = google_cloudfunctions2_function.image.name
+  role           = "roles/cloudfunctions.invoker"
+  member         = "allUsers"
+}
+
+# Make underlying Cloud Run service publicly accessible
+resource "google_cloud_run_service_iam_member" "image_run_invoker" {
+  project  = var.project_id
+  location = var.region
+  service  = google_cloudfunctions2_function.image.name
+  role     = "roles/run.invoker"
+  member   = "allUsers"
+}
+
 # Application Notify Cloud Function (Gen2)
 # Sends LINE and email notifications to admin when a new application is submitted
 
@@ -47,3 +47,23 @@ output "application_notify_function_name" {
   description = "Name of the application notify Cloud Function"
   value       = google_cloudfunctions2_function.application_notify.name
 }
+
+output "url_refresh_function_name" {
+  description = "Name of the signed URL refresh Cloud Function"
+  value       = google_cloudfunctions2_function.url_refresh.name
+}
+
+output "image_function_url" {
+  description = "URL of the image redirect Cloud Function"
+  value       = google_cloudfunctions2_function.image.service_config[0].uri
+}
+
+output "backlog_function_url" {
+  description = "URL of the scoring backlog admin endpoint"
+  value       = google_cloudfunctions2_function.backlog.service_config[0].uri
+}
+
+output "reconcile_function_name" {
+  description = "Name of the pending image reconciler Cloud Function"
+  value       = google_cloudfunctions2_function.reconcile.name
+}
@@ -53,6 +53,13 @@ resource "google_service_account_iam_member" "webhook_token_creator" {
   member             = "serviceAccount:${google_service_account.webhook_function.email}"
 }
 
+# Eventarc event receiver for the Firestore-triggered webhook worker
+resource "google_project_iam_member" "webhook_eventarc_receiver" {
+  project = var.project_id
+  role    = "roles/eventarc.eventReceiver"
+  member  = "serviceAccount:${google_service_account.webhook_function.email}"
+}
+
 # IAM Bindings for Scoring Function
 
 # Firestore access for score storage
@@ -10,7 +10,16 @@ import {
   assertSucceeds,
   initializeTestEnvironment,
 } from "@firebase/rules-unit-testing";
-import { doc, getDoc, setDoc, updateDoc, deleteDoc, collection, getDocs } from "firebase/firestore";
+import {
+  doc,
+  getDoc,
+  setDoc,
+  updateDoc,
+  deleteDoc,
+  collection,
+  getDocs,
+  writeBatch,
+} from "firebase/firestore";
 import { readFileSync } from "fs";
 import { resolve, dirname } from "path";
 import { fileURLToPath } from "url";
@@ -73,15 +82,32 @@ beforeEach(async () => {
       created_at: new Date(),
     });
 
+    // Create the JOIN code index for the event
+    await setDoc(doc(db, "event_codes", "test-code-123"), {
+      event_id: EVENT_ID,
+      event_name: "Test Wedding",
+      status: "active",
+      account_id: OWNER_UID,
+    });
+
     // Create user (LINE user) for the event
     await setDoc(doc(db, "users", `lineuser123_${EVENT_ID}`), {
       line_user_id: "lineuser123",
       event_id: EVENT_ID,
       name: "Test Guest",
       join_status: "registered",
+      active_uploads: 3,
       created_at: new Date(),
     });
 
+    // Create the guest's pointer to their active registration
+    await setDoc(doc(db, "line_users", "lineuser123"), {
+      user_doc_id: `lineuser123_${EVENT_ID}`,
+      event_id: EVENT_ID,
+      join_status: "registered",
+      name: "Test Guest",
+    });
+
     // Create image for the event
     await setDoc(doc(db, "images", "image-123"), {
       event_id: EVENT_ID,
@@ -220,6 +246,70 @@ describe("Events Collection", () => {
   });
 });
 
+describe("Event Codes Collection (JOIN code index)", () => {
+  const indexFor = (eventId, status, accountId = OWNER_UID) => ({
+    event_id: eventId,
+    event_name: "New Wedding",
+    status,
+    account_id: accountId,
+  });
+
+  test("non-admin cannot read the index", async () => {
+    const anonDb = testEnv.unauthenticatedContext().firestore();
+    await assertFails(getDoc(doc(anonDb, "event_codes", "test-code-123")));
+
+    const ownerDb = testEnv.authenticatedContext(OWNER_UID).firestore();
+    await assertFails(getDoc(doc(ownerDb, "event_codes", "test-code-123")));
+  });
+
+  test("owner can create an event together with its index", async () => {
+    const db = testEnv.authenticatedContext(OWNER_UID).firestore();
+    const batch = writeBatch(db);
+    batch.set(doc(db, "events", "new-event"), {
+      account_id: OWNER_UID,
+      event_name: "New Wedding",
+      event_code: "new-code-456",
+      status: "draft",
+    });
+    batch.set(doc(db, "event_codes", "new-code-456"), indexFor("new-event", "draft"));
+    await assertSucceeds(batch.commit());
+  });
+
+  test("index must match the event's code and status", async () => {
+    const db = testEnv.authenticatedContext(OWNER_UID).firestore();
+    await assertFails(
+      setDoc(doc(db, "event_codes", "other-code"), indexFor(EVENT_ID, "active"))
+    );
+    await assertFails(
+      setDoc(doc(db, "event_codes", "test-code-123"), indexFor(EVENT_ID, "draft"))
+    );
+  });
+
+  test("owner can change the status of the event and its index together", async () => {
+    const db = testEnv.authenticatedContext(OWNER_UID).firestore();
+    const batch = writeBatch(db);
+    batch.update(doc(db, "events", EVENT_ID), { status: "archived" });
+    batch.set(doc(db, "event_codes", "test-code-123"), indexFor(EVENT_ID, "archived"));
+    await assertSucceeds(batch.commit());
+  });
+
+  test("non-owner cannot write or delete the index of another event", async () => {
+    const db = testEnv.authenticatedContext(OTHER_UID).firestore();
+    await assertFails(
+      setDoc(doc(db, "event_codes", "test-code-123"), indexFor(EVENT_ID, "active", OTHER_UID))
+    );
+    await assertFails(deleteDoc(doc(db, "event_codes", "test-code-123")));
+  });
+
+  test("owner can delete an event together with its index", async () => {
+    const db = testEnv.authenticatedContext(OWNER_UID).firestore();
+    const batch = writeBatch(db);
+    batch.delete(doc(db, "event_codes", "test-code-123"));
+    batch.delete(doc(db, "events", EVENT_ID));
+    await assertSucceeds(batch.commit());
+  });
+});
+
 describe("Users Collection (LINE Users)", () => {
   test("anyone can read users (for ranking display)", async () => {
     const db = testEnv.unauthenticatedContext().firestore();
@@ -264,6 +354,13 @@ describe("Users Collection (LINE Users)", () => {
     );
   });
 
+  test("unauthenticated user cannot change active_uploads", async () => {
+    const db = testEnv.unauthenticatedContext().firestore();
+    await assertFails(
+      updateDoc(doc(db, "users", `lineuser123_${EVENT_ID}`), { active_uploads: 0 })
+    );
+  });
+
   test("only admin can delete users", async () => {
     const ownerDb = testEnv.authenticatedContext(OWNER_UID).firestore();
     await assertFails(deleteDoc(doc(ownerDb, "users", `lineuser123_${EVENT_ID}`)));
@@ -273,6 +370,25 @@ describe("Users Collection (LINE Users)", () => {
   });
 });
 
+describe("Line Users Collection (registration pointers)", () => {
+  test("non-admin cannot read pointers", async () => {
+    const anonDb = testEnv.unauthenticatedContext().firestore();
+    await assertFails(getDoc(doc(anonDb, "line_users", "lineuser123")));
+
+    const ownerDb = testEnv.authenticatedContext(OWNER_UID).firestore();
+    await assertFails(getDoc(doc(ownerDb, "line_users", "lineuser123")));
+  });
+
+  test("admin can read and delete pointers but not write them", async () => {
+    const db = testEnv.authenticatedContext(ADMIN_UID).firestore();
+    await assertSucceeds(getDoc(doc(db, "line_users", "lineuser123")));
+    await assertFails(
+      updateDoc(doc(db, "line_users", "lineuser123"), { join_status: "left" })
+    );
+    await assertSucceeds(deleteDoc(doc(db, "line_users", "lineuser123")));
+  });
+});
+
 describe("Images Collection", () => {
   test("anyone can read images (for ranking display)", async () => {
     const db = testEnv.unauthenticatedContext().firestore();
@@ -2,24 +2,52 @@
 Unit tests for scoring functions (src/functions/scoring/main.py).
 """
 
+import base64
+import hashlib
+import json
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime, timedelta
 from pathlib import Path
-from unittest.mock import Mock, patch
+from unittest.mock import ANY, MagicMock, Mock, patch
 
-from google.cloud import vision
+import pytest
+from flask import Flask
+from flask import request as flask_request
+from google.cloud import firestore, vision
 
 # Add src directory to path
 src_path = Path(__file__).parent.parent.parent / "src" / "functions" / "scoring"
 sys.path.insert(0, str(src_path.parent))
 
 from scoring.main import (  # noqa: E402
+    FaceDetectionBatcher,
+    FairScoringScheduler,
+    ResultAlreadyDeliveredError,
+    _backlog_pruned_buckets,
+    _send_provisional_result,
+    _update_image_and_user_stats,
     calculate_average_hash,
     calculate_smile_score,
+    decode_inline_image,
     evaluate_theme,
     format_face_count,
     generate_scores_with_vision_api,
+    generate_signed_url,
+    generate_signed_urls,
     get_face_size_multiplier,
     is_similar_image,
+    needs_signed_url,
+    process_scoring,
+    prune_backlog_buckets,
+    reconcile_pending_images,
+    record_image_set_result,
+    refresh_expiring_signed_urls,
+    score_images_bulk,
+    scoring,
+    update_firestore,
 )
 
 
@@ -152,6 +180,139 @@ class TestCalculateSmileScore:
         assert result["error"] == "vision_api_failed"
 
 
+class TestFaceDetectionBatcher:
+    """Tests for Vision API micro-batching."""
+
+    def test_concurrent_requests_share_one_batch(self):
+        """Requests arriving within the linger window are sent in one batch call."""
+        mock_client = Mock()
+
+        def batch_annotate(requests):
+            response = Mock()
+            response.responses = [Mock(face_annotations=[], name=f"r{i}") for i in range(len(requests))]
+            return response
+
+        mock_client.batch_annotate_images.side_effect = batch_annotate
+        batcher = FaceDetectionBatcher(mock_client, max_batch_size=4, linger_ms=200)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(batcher.detect_faces, [b"a", b"b", b"c", b"d"]))
+
+        assert len(results) == 4
+        assert mock_client.batch_annotate_images.call_count == 1
+        assert batcher.stats == {"batches": 1, "images": 4, "failed_batches": 0}
+
+    def test_per_image_error_is_isolated(self):
+        """An error on one image is returned only to that image's caller."""
+        mock_client = Mock()
+
+        def batch_annotate(requests):
+            responses = []
+            for request in requests:
+                image_response = Mock()
+                image_response.error.message = "Bad image data" if request.image.content == b"bad" else ""
+                responses.append(image_response)
+            return Mock(responses=responses)
+
+        mock_client.batch_annotate_images.side_effect = batch_annotate
+        batcher = FaceDetectionBatcher(mock_client, max_batch_size=2, linger_ms=200)
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            ok_future = executor.submit(batcher.detect_faces, b"ok")
+            bad_future = executor.submit(batcher.detect_faces, b"bad")
+
+        assert ok_future.result().error.message == ""
+        assert bad_future.result().error.message == "Bad image data"
+        assert mock_client.batch_annotate_images.call_count == 1
+
+    def test_batch_failure_propagates_to_all_callers(self):
+        """A failed batch request raises in every waiting caller so each can retry."""
+        mock_client = Mock()
+        mock_client.batch_annotate_images.side_effect = Exception("429 Resource exhausted")
+        batcher = FaceDetectionBatcher(mock_client, max_batch_size=2, linger_ms=50)
+
+        with pytest.raises(Exception, match="429"):
+            batcher.detect_faces(b"a")
+        assert batcher.stats["failed_batches"] == 1
+
+    @patch("scoring.main.VISION_BATCH_MAX_SIZE", 8)
+    @patch("scoring.main.face_detection_batcher")
+    @patch("scoring.main.PILImage")
+    @patch("scoring.main.vision_client")
+    def test_calculate_smile_score_uses_batcher_when_enabled(self, mock_vision_client, mock_pil, mock_batcher):
+        mock_img = Mock()
+        mock_img.size = (1000, 1000)
+        mock_pil.open.return_value = mock_img
+
+        mock_response = Mock()
+        mock_response.face_annotations = []
+        mock_response.error.message = ""
+        mock_batcher.detect_faces.return_value = mock_response
+
+        result = calculate_smile_score(b"fake_image_bytes")
+
+        assert result["face_count"] == 0
+        mock_batcher.detect_faces.assert_called_once_with(b"fake_image_bytes")
+        mock_vision_client.face_detection.assert_not_called()
+
+
+class TestFairScoringScheduler:
+    """Tests for weighted fair scheduling of concurrent scorings."""
+
+    def _run_queued(self, scheduler, requests):
+        """Queue requests behind a held slot, release it and return the admission order."""
+        order = []
+
+        def run(label, event_id, user_id, upload_class):
+            with scheduler.slot(event_id, user_id, upload_class):
+                order.append(label)
+
+        with scheduler.slot("evt_0", "holder", "repeat"):
+            threads = []
+            for request in requests:
+                thread = threading.Thread(target=run, args=request)
+                thread.start()
+                threads.append(thread)
+                # Wait until queued so finish tags are assigned in submission order
+                while len(scheduler._waiting) < len(threads):
+                    time.sleep(0.001)
+
+        for thread in threads:
+            thread.join(timeout=5)
+        return order
+
+    def test_first_upload_jumps_ahead_of_backlog(self):
+        scheduler = FairScoringScheduler(1, {"first": 4.0, "repeat": 1.0})
+
+        order = self._run_queued(
+            scheduler,
+            [(f"heavy_{i}", "evt_1", "heavy", "repeat") for i in range(3)] + [("newcomer", "evt_1", "guest", "first")],
+        )
+
+        assert order[0] == "newcomer"
+        assert order[1:] == ["heavy_0", "heavy_1", "heavy_2"]
+
+    def test_users_are_interleaved(self):
+        scheduler = FairScoringScheduler(1, {"first": 4.0, "repeat": 1.0})
+
+        order = self._run_queued(
+            scheduler,
+            [("a1", "evt_1", "a", "repeat"), ("a2", "evt_1", "a", "repeat"), ("b1", "evt_1", "b", "repeat")],
+        )
+
+        assert order == ["a1", "b1", "a2"]
+
+    def test_records_wait_and_service_per_class(self):
+        scheduler = FairScoringScheduler(2, {"first": 4.0, "repeat": 1.0})
+
+        with scheduler.slot("evt_1", "u1", "first") as queue_wait:
+            assert queue_wait < 1
+
+        assert scheduler.stats["first"]["requests"] == 1
+        assert scheduler.stats["repeat"]["requests"] == 0
+        assert scheduler._running == 0
+
+
 class TestGetFaceSizeMultiplier:
     """Tests for get_face_size_multiplier function.
 
@@ -569,3 +730,867 @@ class TestGenerateScoresWithVisionAPI:
         # Assert
         assert result["smile_score"] == 300.0  # Fallback score
         assert "error" in result or "has_errors" in result
+
+    @patch("scoring.main.download_image_from_storage")
+    @patch("scoring.main.get_existing_hashes_for_user", return_value=[])
+    @patch("scoring.main.calculate_average_hash", return_value="abc123")
+    @patch("scoring.main.evaluate_theme", return_value={"score": 80, "comment": "Great!"})
+    @patch("scoring.main.calculate_smile_score")
+    @patch("scoring.main.db")
+    def test_generate_scores_with_inline_image_skips_download(
+        self,
+        mock_db,
+        mock_calc_smile,
+        mock_eval_theme,
+        mock_calc_hash,
+        mock_get_hashes,
+        mock_download,
+    ):
+        """Inline image bytes are scored without downloading from Storage."""
+        mock_calc_smile.return_value = {"smile_score": 100.0, "face_count": 1, "smiling_faces": 1}
+        mock_image_doc = Mock()
+        mock_image_doc.exists = True
+        mock_image_doc.to_dict.return_value = {
+            "storage_path": "test/path.jpg",
+            "user_id": "test_user_001",
+            "event_id": "test_event_001",
+        }
+        mock_db.collection.return_value.document.return_value.get.return_value = mock_image_doc
+
+        generate_scores_with_vision_api("img_001", "req_001", image_bytes=b"inline")
+
+        mock_download.assert_not_called()
+        mock_calc_smile.assert_called_once_with(b"inline")
+
+
+class TestSignedUrls:
+    """Tests for signed URL generation and reuse."""
+
+    def test_needs_signed_url_when_missing(self):
+        assert needs_signed_url(None) is True
+
+    def test_needs_signed_url_when_expiring_soon(self):
+        assert needs_signed_url(datetime.now(UTC) + timedelta(hours=2)) is True
+
+    def test_no_signed_url_needed_when_valid(self):
+        assert needs_signed_url(datetime.now(UTC) + timedelta(days=6)) is False
+
+    @patch("scoring.main._signing_credentials", None)
+    @patch("scoring.main.storage_client")
+    @patch("scoring.main.google.auth.default")
+    def test_credentials_resolved_once(self, mock_auth_default, mock_storage):
+        """google.auth.default() is not called again for every signature."""
+        mock_credentials = Mock(valid=True, token="token", service_account_email="sa@example.com")
+        mock_auth_default.return_value = (mock_credentials, "project")
+        mock_storage.bucket.return_value.blob.return_value.generate_signed_url.return_value = "https://signed"
+
+        generate_signed_url("bucket", "a.jpg")
+        generate_signed_url("bucket", "b.jpg")
+
+        mock_auth_default.assert_called_once()
+        mock_credentials.refresh.assert_not_called()
+
+    @patch("scoring.main.generate_signed_url")
+    def test_generate_signed_urls_skips_failures(self, mock_sign):
+        expires = datetime.now(UTC)
+
+        def sign(bucket_name, path, expiration_hours):
+            if path == "bad.jpg":
+                raise Exception("signBlob denied")
+            return f"https://signed/{path}", expires
+
+        mock_sign.side_effect = sign
+
+        result = generate_signed_urls("bucket", ["a.jpg", "bad.jpg", "b.jpg"])
+
+        assert set(result) == {"a.jpg", "b.jpg"}
+        assert result["a.jpg"] == ("https://signed/a.jpg", expires)
+
+    @patch("scoring.main._update_image_and_user_stats")
+    @patch("scoring.main.generate_signed_url")
+    @patch("scoring.main.db")
+    def test_update_firestore_reuses_valid_url(self, mock_db, mock_sign, mock_update_tx):
+        """Scoring does not re-sign a URL the webhook already stored."""
+        scores = {
+            "smile_score": 100.0,
+            "ai_score": 80,
+            "total_score": 80.0,
+            "comment": "Nice",
+            "average_hash": "abc",
+            "is_similar": False,
+            "face_count": 1,
+            "event_id": "event_001",
+            "storage_path": "event_001/original/u/x.jpg",
+            "storage_url_expires_at": datetime.now(UTC) + timedelta(days=7),
+        }
+        update_firestore("img_001", "user_001", scores)
+
+        mock_sign.assert_not_called()
+        # signed_url_data passed to the transaction is None (existing URL kept)
+        assert mock_update_tx.call_args[0][4] is None
+
+
+def _make_image_snapshot(doc_id, data):
+    doc = Mock()
+    doc.id = doc_id
+    doc.to_dict.return_value = data
+    doc.reference = Mock(name=f"ref_{doc_id}")
+    return doc
+
+
+class TestRefreshExpiringSignedUrls:
+    """Tests for the bulk signed URL refresh job."""
+
+    def _setup_query(self, mock_db, docs):
+        query = mock_db.collection.return_value.where.return_value.order_by.return_value.limit.return_value
+        query.stream.return_value = iter(docs)
+        return query
+
+    @patch("scoring.main.generate_signed_urls")
+    @patch("scoring.main.db")
+    def test_refreshes_and_skips_expired_or_deleted(self, mock_db, mock_sign_many):
+        now = datetime.now(UTC)
+        docs = [
+            _make_image_snapshot("img_1", {"storage_path": "a.jpg", "expire_at": now + timedelta(days=20)}),
+            _make_image_snapshot("img_2", {"storage_path": "b.jpg", "deleted_at": now}),
+            _make_image_snapshot("img_3", {"storage_path": "c.jpg", "expire_at": now - timedelta(days=1)}),
+        ]
+        self._setup_query(mock_db, docs)
+        mock_sign_many.return_value = {"a.jpg": ("https://signed/a", now + timedelta(days=7))}
+        writer = mock_db.bulk_writer.return_value
+
+        stats = refresh_expiring_signed_urls(window_hours=48, page_size=10)
+
+        assert stats == {"scanned": 3, "refreshed": 1, "skipped": 2, "failed": 0}
+        mock_sign_many.assert_called_once_with("wedding-smile-images-test", ["a.jpg"])
+        writer.update.assert_called_once()
+        assert writer.update.call_args[0][0] is docs[0].reference
+        writer.close.assert_called_once()
+
+    @patch("scoring.main.generate_signed_urls")
+    @patch("scoring.main.db")
+    def test_dry_run_does_not_sign_or_write(self, mock_db, mock_sign_many):
+        docs = [_make_image_snapshot("img_1", {"storage_path": "a.jpg"})]
+        self._setup_query(mock_db, docs)
+        progress = Mock()
+
+        stats = refresh_expiring_signed_urls(dry_run=True, page_size=10, on_progress=progress)
+
+        assert stats["refreshed"] == 1
+        mock_sign_many.assert_not_called()
+        mock_db.bulk_writer.assert_not_called()
+        progress.assert_called_once_with(1)
+
+    @patch("scoring.main.generate_signed_urls")
+    @patch("scoring.main.db")
+    def test_signing_failures_are_counted(self, mock_db, mock_sign_many):
+        docs = [
+            _make_image_snapshot("img_1", {"storage_path": "a.jpg"}),
+            _make_image_snapshot("img_2", {"storage_path": "b.jpg"}),
+        ]
+        self._setup_query(mock_db, docs)
+        mock_sign_many.return_value = {"a.jpg": ("https://signed/a", datetime.now(UTC))}
+
+        stats = refresh_expiring_signed_urls(page_size=10)
+
+        assert stats["refreshed"] == 1
+        assert stats["failed"] == 1
+
+
+class TestReconcilePendingImages:
+    """Tests for the pending-image reconciler."""
+
+    def _setup_query(self, mock_db, docs):
+        query = mock_db.collection.return_value.where.return_value.where.return_value.order_by.return_value
+        query.limit.return_value.stream.return_value = iter(docs)
+        return query
+
+    @patch("scoring.main.process_scoring")
+    @patch("scoring.main.db")
+    def test_redrives_stuck_images(self, mock_db, mock_process):
+        docs = [
+            _make_image_snapshot("img_1", {"user_id": "u1", "event_id": "evt_1"}),
+            _make_image_snapshot("img_2", {"user_id": "u2", "deleted_at": datetime.now(UTC)}),
+        ]
+        self._setup_query(mock_db, docs)
+
+        stats = reconcile_pending_images(page_size=10)
+
+        assert stats == {
+            "scanned": 2,
+            "redriven": 1,
+            "succeeded": 1,
+            "failed": 0,
+            "poisoned": 0,
+            "discarded": 1,
+            "skipped": 0,
+        }
+        assert mock_process.call_args[0][:2] == ("img_1", "u1")
+        assert mock_process.call_args.kwargs["event_id"] == "evt_1"
+        docs[0].reference.update.assert_called_once()
+
+    @patch("scoring.main.process_scoring")
+    @patch("scoring.main.db")
+    def test_redrive_keeps_image_set_position(self, mock_db, mock_process):
+        data = {"user_id": "u1", "event_id": "evt_1", "image_set_id": "set_1", "image_set_index": 3}
+        self._setup_query(mock_db, [_make_image_snapshot("img_1", data)])
+
+        reconcile_pending_images(page_size=10)
+
+        assert mock_process.call_args.kwargs["image_set_id"] == "set_1"
+        assert mock_process.call_args.kwargs["image_set_index"] == 3
+
+    @patch("scoring.main.process_scoring")
+    @patch("scoring.main.db")
+    def test_redrive_keeps_upload_class_and_delivery_mode(self, mock_db, mock_process):
+        data = {"user_id": "u1", "event_id": "evt_1", "upload_class": "first", "result_delivery": "two_phase"}
+        self._setup_query(mock_db, [_make_image_snapshot("img_1", data)])
+
+        reconcile_pending_images(page_size=10)
+
+        assert mock_process.call_args.kwargs["upload_class"] == "first"
+        assert mock_process.call_args.kwargs["two_phase"] is True
+
+    @patch("scoring.main.process_scoring", side_effect=Exception("vision unavailable"))
+    @patch("scoring.main.db")
+    def test_failed_redrive_records_error(self, mock_db, mock_process):
+        docs = [_make_image_snapshot("img_1", {"user_id": "u1"})]
+        self._setup_query(mock_db, docs)
+
+        stats = reconcile_pending_images(page_size=10)
+
+        assert stats["failed"] == 1
+        assert docs[0].reference.update.call_args[0][0] == {"last_error": "vision unavailable"}
+
+    @patch("scoring.main.send_error_to_line")
+    @patch("scoring.main.prune_backlog_buckets")
+    @patch("scoring.main.process_scoring")
+    @patch("scoring.main.db")
+    def test_poisons_after_max_attempts(self, mock_db, mock_process, mock_progress, mock_send_error):
+        docs = [_make_image_snapshot("img_1", {"user_id": "u1", "event_id": "evt_1", "reconcile_attempts": 3})]
+        docs[0].reference.get.return_value.exists = True
+        docs[0].reference.get.return_value.to_dict.return_value = {"status": "pending"}
+        self._setup_query(mock_db, docs)
+
+        stats = reconcile_pending_images(max_attempts=3, page_size=10)
+
+        assert stats["poisoned"] == 1
+        mock_process.assert_not_called()
+        transaction = mock_db.transaction.return_value
+        assert transaction.update.call_args[0] == (
+            docs[0].reference,
+            {"status": "poisoned", "poisoned_at": ANY},
+        )
+        gauge_update = transaction.set.call_args[0][1]
+        assert gauge_update["pending"] == firestore.Increment(-1)
+        mock_progress.assert_called_once_with("evt_1")
+        mock_send_error.assert_called_once_with("u1")
+
+    @patch("scoring.main.send_error_to_line")
+    @patch("scoring.main.prune_backlog_buckets")
+    @patch("scoring.main.process_scoring")
+    @patch("scoring.main.db")
+    def test_image_scored_meanwhile_is_not_poisoned(self, mock_db, mock_process, mock_progress, mock_send_error):
+        docs = [_make_image_snapshot("img_1", {"user_id": "u1", "event_id": "evt_1", "reconcile_attempts": 3})]
+        docs[0].reference.get.return_value.exists = True
+        docs[0].reference.get.return_value.to_dict.return_value = {"status": "completed"}
+        self._setup_query(mock_db, docs)
+
+        reconcile_pending_images(max_attempts=3, page_size=10)
+
+        mock_db.transaction.return_value.update.assert_not_called()
+        mock_db.transaction.return_value.set.assert_not_called()
+        mock_send_error.assert_not_called()
+
+    @patch("scoring.main.process_scoring")
+    @patch("scoring.main.db")
+    def test_soft_deleted_image_drains_backlog_without_completion(self, mock_db, mock_process):
+        docs = [_make_image_snapshot("img_1", {"user_id": "u1", "event_id": "evt_1", "deleted_at": datetime.now(UTC)})]
+        docs[0].reference.get.return_value.exists = True
+        docs[0].reference.get.return_value.to_dict.return_value = {"status": "pending"}
+        self._setup_query(mock_db, docs)
+
+        stats = reconcile_pending_images(page_size=10)
+
+        assert stats["discarded"] == 1
+        mock_process.assert_not_called()
+        transaction = mock_db.transaction.return_value
+        assert transaction.update.call_args[0] == (
+            docs[0].reference,
+            {"status": "discarded", "discarded_at": ANY},
+        )
+        gauge_update = transaction.set.call_args[0][1]
+        assert gauge_update["pending"] == firestore.Increment(-1)
+        assert "completed_minutes" not in gauge_update
+
+    @patch("scoring.main.process_scoring")
+    @patch("scoring.main.db")
+    def test_dry_run_only_counts(self, mock_db, mock_process):
+        docs = [
+            _make_image_snapshot("img_1", {"user_id": "u1"}),
+            _make_image_snapshot("img_2", {"user_id": "u2", "reconcile_attempts": 5}),
+        ]
+        self._setup_query(mock_db, docs)
+
+        stats = reconcile_pending_images(dry_run=True, page_size=10)
+
+        assert stats["redriven"] == 1
+        assert stats["poisoned"] == 1
+        mock_process.assert_not_called()
+        docs[1].reference.update.assert_not_called()
+
+
+class TestBulkScoring:
+    """Tests for the bulk mode of the scoring endpoint."""
+
+    def _snapshot(self, doc_id, data, exists=True):
+        snapshot = _make_image_snapshot(doc_id, data)
+        snapshot.exists = exists
+        return snapshot
+
+    @patch("scoring.main.process_scoring")
+    @patch("scoring.main.db")
+    def test_streams_results_with_partial_failure(self, mock_db, mock_process):
+        mock_db.get_all.return_value = [
+            self._snapshot("img_ok", {"user_id": "u1", "event_id": "evt_1"}),
+            self._snapshot("img_bad", {"user_id": "u2"}),
+            self._snapshot("img_gone", {}, exists=False),
+            self._snapshot("img_deleted", {"user_id": "u3", "deleted_at": datetime.now(UTC)}),
+        ]
+
+        def process(image_id, user_id, request_id, **kwargs):
+            if image_id == "img_bad":
+                raise Exception("vision unavailable")
+            return {"scores": {"total_score": 80.0}}
+
+        mock_process.side_effect = process
+
+        items = list(score_images_bulk(["img_ok", "img_bad", "img_gone", "img_deleted", "img_ok"], "req", False))
+
+        by_id = {item["image_id"]: item for item in items if "image_id" in item}
+        assert by_id["img_ok"]["status"] == "success"
+        assert by_id["img_ok"]["total_score"] == 80.0
+        assert by_id["img_bad"] == {"image_id": "img_bad", "status": "error", "error": "vision unavailable"}
+        assert by_id["img_gone"]["status"] == "not_found"
+        assert by_id["img_deleted"]["status"] == "skipped"
+        assert items[-1]["summary"] == {
+            "total": 4,
+            "succeeded": 1,
+            "failed": 1,
+            "not_found": 1,
+            "skipped": 1,
+            "deferred": 0,
+        }
+        assert items[-1]["remaining_image_ids"] == []
+        assert mock_process.call_count == 2
+        assert all(c.kwargs["notify"] is False for c in mock_process.call_args_list)
+
+    @patch("scoring.main.process_scoring")
+    @patch("scoring.main.db")
+    def test_rescored_set_member_keeps_its_position(self, mock_db, mock_process):
+        mock_db.get_all.return_value = [
+            self._snapshot("img_1", {"user_id": "u1", "image_set_id": "set_1", "image_set_index": 2}),
+        ]
+        mock_process.return_value = {"scores": {"total_score": 80.0}}
+
+        list(score_images_bulk(["img_1"], "req", True))
+
+        assert mock_process.call_args.kwargs["image_set_id"] == "set_1"
+        assert mock_process.call_args.kwargs["image_set_index"] == 2
+
+    @patch("scoring.main.process_scoring")
+    @patch("scoring.main.db")
+    def test_rescore_of_delivered_image_skips_provisional_push(self, mock_db, mock_process):
+        mock_db.get_all.return_value = [
+            self._snapshot("img_new", {"user_id": "u1", "upload_class": "first", "result_delivery": "two_phase"}),
+            self._snapshot(
+                "img_done",
+                {"user_id": "u2", "result_delivery": "two_phase", "notified_at": datetime.now(UTC)},
+            ),
+        ]
+        mock_process.return_value = {"scores": {"total_score": 80.0}}
+
+        list(score_images_bulk(["img_new", "img_done"], "req", True))
+
+        kwargs = {c[0][0]: c.kwargs for c in mock_process.call_args_list}
+        assert kwargs["img_new"]["upload_class"] == "first"
+        assert kwargs["img_new"]["two_phase"] is True
+        assert kwargs["img_done"]["upload_class"] == "repeat"
+        assert kwargs["img_done"]["two_phase"] is False
+
+    @patch("scoring.main.BULK_SCORING_TIME_BUDGET_SECONDS", -1)
+    @patch("scoring.main.process_scoring")
+    @patch("scoring.main.db")
+    def test_items_past_time_budget_are_deferred(self, mock_db, mock_process):
+        mock_db.get_all.return_value = [
+            self._snapshot("img_1", {"user_id": "u1"}),
+            self._snapshot("img_2", {"user_id": "u2"}),
+        ]
+
+        items = list(score_images_bulk(["img_2", "img_1"], "req", False))
+
+        mock_process.assert_not_called()
+        assert items[-1]["summary"]["deferred"] == 2
+        assert items[-1]["remaining_image_ids"] == ["img_2", "img_1"]
+
+    @patch("scoring.main.generate_scores_with_vision_api")
+    @patch("scoring.main.db")
+    def test_rescoring_completed_image_leaves_backlog_gauge_alone(self, mock_db, mock_generate):
+        mock_db.get_all.return_value = [self._snapshot("img_1", {"user_id": "u1", "event_id": "evt_1"})]
+        image_doc = mock_db.collection.return_value.document.return_value.get.return_value
+        image_doc.exists = True
+        image_doc.to_dict.return_value = {"status": "completed", "best_score": 50}
+        mock_generate.return_value = {
+            "smile_score": 1,
+            "ai_score": 1,
+            "total_score": 70,
+            "comment": "",
+            "average_hash": "0",
+            "is_similar": False,
+            "face_count": 1,
+            "event_id": "evt_1",
+        }
+
+        items = list(score_images_bulk(["img_1"], "req", False))
+
+        assert items[0]["status"] == "success"
+        mock_db.transaction.return_value.update.assert_called()
+        mock_db.transaction.return_value.set.assert_not_called()
+
+    @patch("scoring.main.score_images_bulk")
+    def test_endpoint_returns_ndjson(self, mock_bulk):
+        mock_bulk.return_value = iter([{"image_id": "img_1", "status": "success"}, {"summary": {"total": 1}}])
+
+        with Flask(__name__).test_request_context("/", method="POST", json={"image_ids": ["img_1"], "notify": False}):
+            response = scoring(flask_request)
+            lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+        assert response.mimetype == "application/x-ndjson"
+        assert lines[0]["status"] == "success"
+        assert mock_bulk.call_args[0][0] == ["img_1"]
+        assert mock_bulk.call_args[0][2] is False
+
+    @pytest.mark.parametrize("image_ids", [[], "img_1", [""], ["img"] * 101])
+    def test_endpoint_rejects_invalid_image_ids(self, image_ids):
+        with Flask(__name__).test_request_context("/", method="POST", json={"image_ids": image_ids}):
+            _response, status = scoring(flask_request)
+
+        assert status == 400
+
+
+class TestProcessScoring:
+    """Tests for result delivery ordering in process_scoring."""
+
+    @patch("scoring.main.prune_backlog_buckets")
+    @patch("scoring.main._mark_notified")
+    @patch("scoring.main._deliver_result")
+    @patch("scoring.main.update_firestore")
+    @patch("scoring.main.generate_scores_with_vision_api")
+    def test_delivers_and_marks_notified(self, mock_generate, mock_update, mock_deliver, mock_mark, mock_progress):
+        mock_generate.return_value = {"total_score": 80.0, "notified_at": None}
+
+        result = process_scoring("img_1", "user_1", "req", event_id="evt_1")
+
+        assert result["scores"]["total_score"] == 80.0
+        mock_deliver.assert_called_once()
+        mock_update.assert_called_once()
+        mock_mark.assert_called_once_with("img_1")
+        mock_progress.assert_called_once_with("evt_1")
+
+    @patch("scoring.main.prune_backlog_buckets")
+    @patch("scoring.main._mark_notified")
+    @patch("scoring.main._deliver_result")
+    @patch("scoring.main.update_firestore")
+    @patch("scoring.main.generate_scores_with_vision_api")
+    def test_delivers_even_when_firestore_update_fails(
+        self, mock_generate, mock_update, mock_deliver, mock_mark, mock_progress
+    ):
+        mock_generate.return_value = {"total_score": 80.0, "notified_at": None}
+        mock_update.side_effect = Exception("transaction aborted")
+
+        with pytest.raises(ResultAlreadyDeliveredError):
+            process_scoring("img_1", "user_1", "req", event_id="evt_1")
+
+        mock_deliver.assert_called_once()
+        mock_mark.assert_called_once_with("img_1")
+        mock_progress.assert_not_called()
+
+    @patch("scoring.main.prune_backlog_buckets")
+    @patch("scoring.main._mark_notified")
+    @patch("scoring.main._send_line_message_with_retry", return_value=False)
+    @patch("scoring.main.update_firestore")
+    @patch("scoring.main.generate_scores_with_vision_api")
+    def test_failed_push_is_not_marked_notified(self, mock_generate, mock_update, mock_send, mock_mark, mock_progress):
+        mock_generate.return_value = {
+            "total_score": 80.0,
+            "smile_score": 50.0,
+            "ai_score": 30.0,
+            "comment": "",
+            "is_similar": False,
+            "face_count": 1,
+            "smiling_faces": 1,
+            "line_user_id": "U_line",
+            "notified_at": None,
+        }
+        mock_update.side_effect = Exception("transaction aborted")
+
+        with pytest.raises(Exception, match="transaction aborted") as excinfo:
+            process_scoring("img_1", "user_1", "req")
+
+        assert not isinstance(excinfo.value, ResultAlreadyDeliveredError)
+        mock_send.assert_called_once()
+        mock_mark.assert_not_called()
+
+    @patch("scoring.main.prune_backlog_buckets")
+    @patch("scoring.main._mark_notified")
+    @patch("scoring.main._deliver_result")
+    @patch("scoring.main.update_firestore")
+    @patch("scoring.main.generate_scores_with_vision_api")
+    def test_skips_delivery_when_already_notified(
+        self, mock_generate, mock_update, mock_deliver, mock_mark, mock_progress
+    ):
+        mock_generate.return_value = {"total_score": 80.0, "notified_at": datetime.now(UTC)}
+
+        process_scoring("img_1", "user_1", "req")
+
+        mock_deliver.assert_not_called()
+        mock_mark.assert_not_called()
+        mock_update.assert_called_once()
+
+    @patch("scoring.main.prune_backlog_buckets")
+    @patch("scoring.main._mark_notified")
+    @patch("scoring.main._deliver_result")
+    @patch("scoring.main.update_firestore")
+    @patch("scoring.main._send_provisional_result", return_value=True)
+    @patch("scoring.main.generate_scores_with_vision_api")
+    def test_two_phase_sends_smile_score_before_follow_up(
+        self, mock_generate, mock_provisional, mock_update, mock_deliver, mock_mark, mock_progress
+    ):
+        vision_result = {"smile_score": 300.0, "face_count": 3, "smiling_faces": 3}
+
+        def generate(image_id, request_id, image_bytes=None, on_smile_score=None):
+            on_smile_score("U_line", vision_result)
+            return {"total_score": 80.0, "notified_at": None}
+
+        mock_generate.side_effect = generate
+
+        process_scoring("img_1", "user_1", "req", event_id="evt_1", two_phase=True)
+
+        mock_provisional.assert_called_once_with("img_1", "evt_1", "U_line", vision_result)
+        assert mock_deliver.call_args[0][5] is True
+
+    @patch("scoring.main.prune_backlog_buckets")
+    @patch("scoring.main._mark_notified")
+    @patch("scoring.main._deliver_result")
+    @patch("scoring.main.update_firestore")
+    @patch("scoring.main.generate_scores_with_vision_api")
+    def test_two_phase_is_ignored_for_image_sets(
+        self, mock_generate, mock_update, mock_deliver, mock_mark, mock_progress
+    ):
+        mock_generate.return_value = {"total_score": 80.0, "notified_at": None}
+
+        process_scoring("img_1", "user_1", "req", image_set_id="set_1", image_set_index=1, two_phase=True)
+
+        assert mock_generate.call_args.kwargs["on_smile_score"] is None
+        assert mock_deliver.call_args[0][5] is False
+
+    @patch("scoring.main.send_error_to_line")
+    @patch("scoring.main.process_scoring")
+    def test_endpoint_skips_error_message_after_delivery(self, mock_process, mock_send_error):
+        mock_process.side_effect = ResultAlreadyDeliveredError("transaction aborted")
+
+        with Flask(__name__).test_request_context("/", method="POST", json={"image_id": "img_1", "user_id": "user_1"}):
+            _response, status = scoring(flask_request)
+
+        assert status == 500
+        mock_send_error.assert_not_called()
+
+
+class TestSendProvisionalResult:
+    """Tests for the provisional smile-score push of two-phase delivery."""
+
+    @patch("scoring.main._send_line_message_with_retry", return_value=True)
+    @patch("scoring.main.db")
+    def test_pushes_smile_score_and_counts_push(self, mock_db, mock_send):
+        vision_result = {"smile_score": 300.0, "face_count": 3, "smiling_faces": 2}
+
+        assert _send_provisional_result("img_1", "evt_1", "U_line", vision_result) is True
+
+        line_user_id, message = mock_send.call_args[0]
+        assert line_user_id == "U_line"
+        assert "300.0点" in message.text
+        assert "2人が笑顔" in message.text
+        mock_db.collection.assert_called_with("events")
+        mock_db.collection.return_value.document.assert_called_with("evt_1")
+        mock_db.collection.return_value.document.return_value.update.assert_called_once()
+
+    @patch("scoring.main._send_line_message_with_retry")
+    @patch("scoring.main.db")
+    def test_skips_estimated_smile_score(self, mock_db, mock_send):
+        vision_result = {"smile_score": 100.0, "face_count": 1, "error": "quota exceeded"}
+
+        assert _send_provisional_result("img_1", "evt_1", "U_line", vision_result) is False
+        mock_send.assert_not_called()
+
+    @patch("scoring.main._send_line_message_with_retry", return_value=False)
+    @patch("scoring.main.db")
+    def test_failed_push_is_not_counted(self, mock_db, mock_send):
+        vision_result = {"smile_score": 300.0, "face_count": 1}
+
+        assert _send_provisional_result("img_1", "evt_1", "U_line", vision_result) is False
+        mock_db.collection.return_value.document.return_value.update.assert_not_called()
+
+
+class TestUpdateImageAndUserStats:
+    """Tests for the image/user stats transaction."""
+
+    def _refs(self, image_status):
+        image_ref, user_ref = Mock(), Mock()
+        image_ref.get.return_value.exists = True
+        image_ref.get.return_value.to_dict.return_value = {"status": image_status}
+        user_ref.get.return_value.exists = True
+        user_ref.get.return_value.to_dict.return_value = {"best_score": 50}
+        return image_ref, user_ref
+
+    def _scores(self):
+        return {
+            "smile_score": 1,
+            "ai_score": 1,
+            "total_score": 70,
+            "comment": "",
+            "average_hash": "0",
+            "is_similar": False,
+            "face_count": 1,
+        }
+
+    def test_new_result_counts_upload(self):
+        transaction = MagicMock()
+        image_ref, user_ref = self._refs("pending")
+
+        _update_image_and_user_stats(transaction, image_ref, user_ref, self._scores())
+
+        user_update = transaction.update.call_args_list[-1][0][1]
+        assert "total_uploads" in user_update
+        assert user_update["best_score"] == 70
+
+    def test_rescoring_does_not_count_upload_again(self):
+        transaction = MagicMock()
+        image_ref, user_ref = self._refs("completed")
+
+        _update_image_and_user_stats(transaction, image_ref, user_ref, self._scores())
+
+        assert "total_uploads" not in transaction.update.call_args_list[-1][0][1]
+
+    @patch("scoring.main.db")
+    def test_only_transition_out_of_pending_drains_backlog(self, mock_db):
+        scores = {**self._scores(), "event_id": "evt_1"}
+
+        transaction = MagicMock()
+        _update_image_and_user_stats(transaction, *self._refs("pending"), scores)
+        mock_db.collection.assert_called_with("scoring_backlog")
+        gauge_update = transaction.set.call_args[0][1]
+        assert gauge_update["pending"] == firestore.Increment(-1)
+        assert transaction.set.call_args.kwargs == {"merge": True}
+
+        for status in ("completed", "poisoned"):
+            transaction = MagicMock()
+            _update_image_and_user_stats(transaction, *self._refs(status), scores)
+            transaction.set.assert_not_called()
+
+
+class TestRecordImageSetResult:
+    """Tests for combined results of multi-image sends."""
+
+    def _setup_set(self, mock_db, **data):
+        snapshot = Mock()
+        snapshot.exists = True
+        snapshot.to_dict.return_value = {
+            "user_id": "U_line",
+            "total": 2,
+            "results": [],
+            "skipped": 0,
+            "failed": 0,
+            "notified": False,
+            **data,
+        }
+        set_ref = mock_db.collection.return_value.document.return_value
+        set_ref.get.return_value = snapshot
+        return set_ref
+
+    @patch("scoring.main.firestore.transactional", lambda f: f)
+    @patch("scoring.main._send_line_message_with_retry")
+    @patch("scoring.main.db")
+    def test_waits_for_remaining_images(self, mock_db, mock_send):
+        self._setup_set(mock_db)
+
+        record_image_set_result("set_1", "img_1", {"total_score": 80, "is_similar": False}, 1)
+
+        mock_send.assert_not_called()
+        update = mock_db.transaction.return_value.update.call_args[0][1]
+        assert update["results"][0]["image_id"] == "img_1"
+        assert "notified" not in update
+
+    @patch("scoring.main.firestore.transactional", lambda f: f)
+    @patch("scoring.main._send_line_message_with_retry")
+    @patch("scoring.main.db")
+    def test_last_image_sends_one_combined_message(self, mock_db, mock_send):
+        set_ref = self._setup_set(
+            mock_db,
+            results=[{"image_id": "img_2", "index": 2, "total_score": 90, "is_similar": False}],
+        )
+
+        record_image_set_result("set_1", "img_1", {"total_score": 70, "is_similar": True}, 1)
+
+        mock_send.assert_called_once()
+        line_user_id, message = mock_send.call_args[0]
+        assert line_user_id == "U_line"
+        assert "ベスト: 90点" in message.text
+        assert message.text.index("1枚目") < message.text.index("2枚目")
+        assert "notifying_at" in mock_db.transaction.return_value.update.call_args[0][1]
+        assert set_ref.update.call_args[0][0] == {"notifying_at": firestore.DELETE_FIELD, "notified": True}
+
+    @patch("scoring.main.firestore.transactional", lambda f: f)
+    @patch("scoring.main._send_line_message_with_retry")
+    @patch("scoring.main.db")
+    def test_rate_limited_images_are_reported_separately(self, mock_db, mock_send):
+        self._setup_set(mock_db, total=3, skipped=1, rate_limited=1)
+
+        record_image_set_result("set_1", "img_1", {"total_score": 70, "is_similar": False}, 1)
+
+        text = mock_send.call_args[0][1].text
+        assert "1枚は投稿上限のため受け付けられませんでした" in text
+        assert "1枚は送信ペースが速すぎたため受け付けられませんでした" in text
+
+    @patch("scoring.main.firestore.transactional", lambda f: f)
+    @patch("scoring.main._send_line_message_with_retry", return_value=False)
+    @patch("scoring.main.db")
+    def test_failed_combined_push_is_not_marked_notified(self, mock_db, mock_send):
+        set_ref = self._setup_set(mock_db, total=1)
+
+        assert record_image_set_result("set_1", "img_1", {"total_score": 70, "is_similar": False}, 1) is False
+
+        assert set_ref.update.call_args[0][0] == {"notifying_at": firestore.DELETE_FIELD}
+
+    @patch("scoring.main.firestore.transactional", lambda f: f)
+    @patch("scoring.main._send_line_message_with_retry")
+    @patch("scoring.main.db")
+    def test_set_being_notified_is_not_sent_twice(self, mock_db, mock_send):
+        self._setup_set(mock_db, total=1, skipped=1, notifying_at=datetime.now(UTC))
+
+        record_image_set_result("set_1")
+
+        mock_send.assert_not_called()
+
+    @patch("scoring.main.firestore.transactional", lambda f: f)
+    @patch("scoring.main._send_line_message_with_retry")
+    @patch("scoring.main.db")
+    def test_retried_result_does_not_complete_set_early(self, mock_db, mock_send):
+        self._setup_set(mock_db, results=[{"image_id": "img_1", "index": 1, "total_score": 80, "is_similar": False}])
+
+        record_image_set_result("set_1", "img_1", {"total_score": 80, "is_similar": False}, 1)
+
+        mock_send.assert_not_called()
+        update = mock_db.transaction.return_value.update.call_args[0][1]
+        assert [r["image_id"] for r in update["results"]] == ["img_1"]
+        assert "notified" not in update
+
+    @patch("scoring.main.firestore.transactional", lambda f: f)
+    @patch("scoring.main._send_line_message_with_retry")
+    @patch("scoring.main.db")
+    def test_result_after_failed_attempt_replaces_the_failure(self, mock_db, mock_send):
+        self._setup_set(mock_db, failed_image_ids=["img_1"])
+
+        record_image_set_result("set_1", "img_1", {"total_score": 80, "is_similar": False}, 1)
+
+        mock_send.assert_not_called()
+        update = mock_db.transaction.return_value.update.call_args[0][1]
+        assert update["failed_image_ids"] == []
+        assert len(update["results"]) == 1
+
+    @patch("scoring.main.firestore.transactional", lambda f: f)
+    @patch("scoring.main._send_line_message_with_retry")
+    @patch("scoring.main.db")
+    def test_repeated_failure_is_counted_once(self, mock_db, mock_send):
+        self._setup_set(mock_db, failed_image_ids=["img_1"])
+
+        record_image_set_result("set_1", "img_1", None, 1)
+
+        mock_send.assert_not_called()
+        mock_db.transaction.return_value.update.assert_not_called()
+
+    @patch("scoring.main.firestore.transactional", lambda f: f)
+    @patch("scoring.main._send_line_message_with_retry")
+    @patch("scoring.main.db")
+    def test_already_notified_set_is_not_sent_again(self, mock_db, mock_send):
+        self._setup_set(mock_db, total=1, skipped=1, notified=True)
+
+        record_image_set_result("set_1")
+
+        mock_send.assert_not_called()
+
+
+class TestPruneBacklogBuckets:
+    """Tests for pruning completion buckets of the scoring backlog gauge."""
+
+    def setup_method(self):
+        _backlog_pruned_buckets.clear()
+
+    def _gauge_ref(self, mock_db, buckets):
+        gauge_ref = mock_db.collection.return_value.document.return_value
+        gauge_ref.get.return_value.exists = True
+        gauge_ref.get.return_value.to_dict.return_value = {"completed_minutes": buckets}
+        return gauge_ref
+
+    @patch("scoring.main.db")
+    def test_removes_every_bucket_outside_the_window(self, mock_db):
+        now = datetime.now(UTC)
+        keys = [(now - timedelta(minutes=m)).strftime("%Y%m%d%H%M") for m in (0, 9, 10, 11, 300)]
+        gauge_ref = self._gauge_ref(mock_db, dict.fromkeys(keys, 1))
+
+        prune_backlog_buckets("event_001")
+
+        assert gauge_ref.update.call_args[0][0] == {
+            f"completed_minutes.`{key}`": firestore.DELETE_FIELD for key in keys[2:]
+        }
+
+    @patch("scoring.main.db")
+    def test_prunes_once_per_minute_per_event(self, mock_db):
+        gauge_ref = self._gauge_ref(mock_db, {})
+
+        prune_backlog_buckets("event_001")
+        prune_backlog_buckets("event_001")
+
+        gauge_ref.get.assert_called_once()
+        gauge_ref.update.assert_not_called()
+
+    @patch("scoring.main.db")
+    def test_errors_are_ignored(self, mock_db):
+        mock_db.collection.return_value.document.return_value.get.side_effect = Exception("unavailable")
+
+        prune_backlog_buckets("event_001")
+
+
+class TestDecodeInlineImage:
+    """Tests for inline image handoff from the webhook."""
+
+    def _request(self, data=b"img", sha256=None):
+        return {
+            "image_base64": base64.b64encode(data).decode("ascii"),
+            "image_sha256": sha256 or hashlib.sha256(data).hexdigest(),
+        }
+
+    def test_valid_inline_image(self):
+        assert decode_inline_image(self._request()) == b"img"
+
+    def test_absent_inline_image(self):
+        assert decode_inline_image({"image_id": "img_1"}) is None
+
+    def test_checksum_mismatch_falls_back(self):
+        assert decode_inline_image(self._request(sha256="0" * 64)) is None
+
+    def test_invalid_base64_falls_back(self):
+        assert decode_inline_image({"image_base64": "not base64!", "image_sha256": "x"}) is None
+
+    @patch("scoring.main.INLINE_IMAGE_MAX_BYTES", 2)
+    def test_oversized_inline_image_falls_back(self):
+        assert decode_inline_image(self._request()) is None
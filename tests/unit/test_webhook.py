@@ -3,27 +3,107 @@ Unit tests for webhook functions (src/functions/webhook/main.py).
 Tests the multi-tenant JOIN flow, name registration, and image handling.
 """
 
+import base64
+import hashlib
+import hmac
+import io
+import json
 import sys
+from datetime import UTC, datetime, timedelta
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
+import pytest
+import urllib3
+from flask import Flask
+
 # Add src directory to path
 src_path = Path(__file__).parent.parent.parent / "src" / "functions" / "webhook"
 sys.path.insert(0, str(src_path.parent))
 
+import webhook.main as webhook_main  # noqa: E402
+from google.api_core.exceptions import Conflict  # noqa: E402
+from google.cloud import firestore  # noqa: E402
+from linebot.v3.messaging import ApiClient, Configuration, MessagingApiBlob  # noqa: E402
+from PIL import Image as PILImage  # noqa: E402
 from webhook.main import (  # noqa: E402
     DRAFT_UPLOAD_LIMIT,
     JOIN_PATTERN,
+    DeliveryInProgressError,
+    ImageTooLargeError,
+    WebhookEventsFailedError,
+    _acquire_upload_slot,
+    _acquire_upload_slot_transaction,
+    _build_loading_message,
+    _claim_delivery,
+    _claim_image_digest,
+    _claim_webhook_event,
+    _complete_webhook_event,
     _count_user_images,
+    _deactivate_other_registrations,
+    _find_event_by_code,
+    _find_registration,
     _find_user_by_status,
+    _get_event,
+    _get_event_handler,
+    _get_scoring_id_token,
+    _image_url_cache,
+    _invalidate_event,
     _join_event_transaction,
+    _rate_limit_retry_after,
     _register_name,
+    _release_image_digest,
+    _release_upload_transaction,
+    _reserve_draft_upload_transaction,
+    _seen_webhook_events,
+    backlog_status,
+    dispatch_events,
+    get_backlog_gauge,
     handle_command,
     handle_image_message,
     handle_join_event,
+    handle_unsend,
+    image_redirect,
+    process_webhook_delivery,
+    stream_message_content_to_storage,
+    transcode_image,
+    trigger_scoring_function,
+    webhook,
 )
 
 
+@pytest.fixture(autouse=True)
+def _reset_upload_rate_windows():
+    """Keep per-instance rate windows, gauges, registrations, event caches and handlers from leaking between tests."""
+    webhook_main._upload_times.clear()
+    webhook_main._backlog_gauges.clear()
+    webhook_main._registration_cache.clear()
+    webhook_main._event_code_cache.clear()
+    webhook_main._event_cache.clear()
+    webhook_main._event_watches.clear()
+    yield
+    webhook_main._event_handlers.pop((MagicMock, None), None)
+
+
+def _route_mock_events(func):
+    """Dispatch MagicMock events to func for the rest of the test."""
+    webhook_main._event_handlers[(MagicMock, None)] = func
+
+
+def _missing_line_users_ref():
+    """A line_users collection without a pointer for the guest (not backfilled)."""
+    mock_line_users_ref = MagicMock()
+    mock_line_users_ref.document.return_value.get.return_value.exists = False
+    return mock_line_users_ref
+
+
+def _missing_event_codes_ref():
+    """An event_codes collection without an index document for the code (not backfilled)."""
+    mock_event_codes_ref = MagicMock()
+    mock_event_codes_ref.document.return_value.get.return_value.exists = False
+    return mock_event_codes_ref
+
+
 def _get_reply_text(mock_messaging_api) -> str:
     """Extract text from the ReplyMessageRequest passed to messaging_api.reply_message."""
     req = mock_messaging_api.reply_message.call_args[0][0]
@@ -110,6 +190,10 @@ class TestTextNormalization:
         mock_users_ref.where.return_value.where.return_value.stream.return_value = []
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -166,7 +250,9 @@ class TestHandleJoinEvent:
         mock_query.stream.return_value = iter([])
         mock_events_ref = MagicMock()
         mock_events_ref.where.return_value.where.return_value.limit.return_value = mock_query
-        mock_db.collection.return_value = mock_events_ref
+        mock_db.collection.side_effect = lambda name: (
+            _missing_event_codes_ref() if name == "event_codes" else mock_events_ref
+        )
 
         handle_join_event("invalid-code", "user_123", "reply_token_1")
 
@@ -192,6 +278,10 @@ class TestHandleJoinEvent:
         mock_users_ref.where.return_value.where.return_value.stream.return_value = []
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -205,8 +295,8 @@ class TestHandleJoinEvent:
 
         # Verify user document created via transaction
         mock_users_ref.document.assert_any_call("user_123_event_001")
-        mock_transaction.set.assert_called_once()
-        set_args = mock_transaction.set.call_args[0]
+        assert mock_transaction.set.call_count == 2  # user document and line_users pointer
+        set_args = mock_transaction.set.call_args_list[0][0]
         assert set_args[0] is mock_user_ref
         set_data = set_args[1]
         assert set_data["line_user_id"] == "user_123"
@@ -239,6 +329,10 @@ class TestHandleJoinEvent:
         mock_users_ref.where.return_value.where.return_value.stream.return_value = []
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -250,7 +344,9 @@ class TestHandleJoinEvent:
 
         handle_join_event("valid-code", "user_123", "reply_token_1")
 
-        mock_transaction.set.assert_not_called()
+        # Only the missing line_users pointer is written
+        mock_transaction.set.assert_called_once()
+        assert mock_transaction.set.call_args[0][1]["join_status"] == "registered"
         assert "参加済み" in _get_reply_text(mock_messaging_api)
 
     @patch("webhook.main.messaging_api")
@@ -272,6 +368,10 @@ class TestHandleJoinEvent:
         mock_users_ref.where.return_value.where.return_value.stream.return_value = []
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -284,8 +384,8 @@ class TestHandleJoinEvent:
         handle_join_event("test-code", "user_456", "reply_token_2")
 
         mock_users_ref.document.assert_any_call("user_456_event_002")
-        mock_transaction.set.assert_called_once()
-        set_args = mock_transaction.set.call_args[0]
+        assert mock_transaction.set.call_count == 2  # user document and line_users pointer
+        set_args = mock_transaction.set.call_args_list[0][0]
         set_data = set_args[1]
         assert set_data["line_user_id"] == "user_456"
         assert set_data["event_id"] == "event_002"
@@ -310,6 +410,10 @@ class TestHandleJoinEvent:
         mock_users_ref.where.return_value.where.return_value.stream.return_value = []
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -321,7 +425,7 @@ class TestHandleJoinEvent:
 
         handle_join_event("draft-code", "user_789", "reply_token_3")
 
-        mock_transaction.set.assert_called_once()
+        assert mock_transaction.set.call_count == 2  # user document and line_users pointer
         reply_text = _get_reply_text(mock_messaging_api)
         assert "お試し版" in reply_text
         assert str(DRAFT_UPLOAD_LIMIT) in reply_text
@@ -334,7 +438,9 @@ class TestHandleJoinEvent:
         mock_query.stream.return_value = iter([])
         mock_events_ref = MagicMock()
         mock_events_ref.where.return_value.where.return_value.limit.return_value = mock_query
-        mock_db.collection.return_value = mock_events_ref
+        mock_db.collection.side_effect = lambda name: (
+            _missing_event_codes_ref() if name == "event_codes" else mock_events_ref
+        )
 
         handle_join_event("archived-code", "user_789", "reply_token_4")
 
@@ -369,6 +475,10 @@ class TestHandleJoinEvent:
         mock_users_ref.where.return_value.where.return_value.stream.return_value = iter([mock_old_doc])
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -382,8 +492,8 @@ class TestHandleJoinEvent:
 
         mock_old_doc_ref.update.assert_called_once_with({"join_status": "left"})
 
-        mock_transaction.set.assert_called_once()
-        set_args = mock_transaction.set.call_args[0]
+        assert mock_transaction.set.call_count == 2  # user document and line_users pointer
+        set_args = mock_transaction.set.call_args_list[0][0]
         set_data = set_args[1]
         assert set_data["event_id"] == "new_event"
         assert set_data["join_status"] == "pending_name"
@@ -411,6 +521,10 @@ class TestHandleJoinEvent:
         mock_users_ref.where.return_value.where.return_value.stream.return_value = []
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -449,6 +563,10 @@ class TestHandleJoinEvent:
         mock_users_ref.where.return_value.where.return_value.stream.return_value = []
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -466,80 +584,305 @@ class TestHandleJoinEvent:
         assert "お名前" in reply_text
 
 
+class TestFindEventByCode:
+    """Tests for _find_event_by_code (event_codes index + per-instance cache)."""
+
+    def _setup(self, mock_db, index=None):
+        mock_index_doc = MagicMock()
+        mock_index_doc.exists = index is not None
+        mock_index_doc.to_dict.return_value = index
+        mock_event_codes_ref = MagicMock()
+        mock_event_codes_ref.document.return_value.get.return_value = mock_index_doc
+        mock_events_ref = _setup_event_mock(mock_db, "event_legacy", "旧イベント", "legacy-code")
+        refs = {"event_codes": mock_event_codes_ref, "events": mock_events_ref}
+        mock_db.collection.side_effect = lambda name: refs[name]
+        return mock_event_codes_ref, mock_events_ref
+
+    @patch("webhook.main.db")
+    def test_index_hit_skips_query(self, mock_db):
+        """An index document resolves the code with one point read."""
+        index = {"event_id": "event_001", "event_name": "テスト結婚式", "status": "active"}
+        mock_event_codes_ref, mock_events_ref = self._setup(mock_db, index)
+
+        event = _find_event_by_code("valid-code")
+
+        assert event == {"event_id": "event_001", "event_name": "テスト結婚式", "status": "active"}
+        mock_event_codes_ref.document.assert_called_once_with("valid-code")
+        mock_events_ref.where.assert_not_called()
+
+    @patch("webhook.main.db")
+    def test_second_lookup_hits_cache(self, mock_db):
+        """A JOIN storm on one code costs a single read per instance."""
+        index = {"event_id": "event_001", "event_name": "テスト結婚式", "status": "draft"}
+        mock_event_codes_ref, _ = self._setup(mock_db, index)
+        hits_before = webhook_main.event_code_cache_stats["hits"]
+
+        for _ in range(5):
+            assert _find_event_by_code("valid-code")["event_id"] == "event_001"
+
+        assert mock_event_codes_ref.document.return_value.get.call_count == 1
+        assert webhook_main.event_code_cache_stats["hits"] == hits_before + 4
+
+    @patch("webhook.main.db")
+    def test_expired_entry_is_read_again(self, mock_db):
+        """Cached events expire so a status change elsewhere is picked up."""
+        index = {"event_id": "event_001", "event_name": "テスト結婚式", "status": "active"}
+        mock_event_codes_ref, _ = self._setup(mock_db, index)
+
+        with patch("webhook.main.time.monotonic", return_value=1000.0):
+            _find_event_by_code("valid-code")
+        index["status"] = "archived"
+        later = 1000.0 + webhook_main.EVENT_CODE_CACHE_TTL_SECONDS + 1
+        with patch("webhook.main.time.monotonic", return_value=later):
+            assert _find_event_by_code("valid-code") is None
+
+        assert mock_event_codes_ref.document.return_value.get.call_count == 2
+
+    @patch("webhook.main.db")
+    def test_archived_index_rejected_without_query(self, mock_db):
+        """An index document for a non-joinable event is final (no fallback query)."""
+        index = {"event_id": "event_001", "event_name": "テスト結婚式", "status": "archived"}
+        _, mock_events_ref = self._setup(mock_db, index)
+
+        assert _find_event_by_code("archived-code") is None
+        assert _find_event_by_code("archived-code") is None  # not cached
+        mock_events_ref.where.assert_not_called()
+
+    @patch("webhook.main.db")
+    def test_missing_index_falls_back_to_query(self, mock_db):
+        """Events without an index document (not backfilled) are found by query."""
+        _, mock_events_ref = self._setup(mock_db)
+        fallbacks_before = webhook_main.event_code_cache_stats["fallbacks"]
+
+        event = _find_event_by_code("legacy-code")
+
+        assert event == {"event_id": "event_legacy", "event_name": "旧イベント", "status": "active"}
+        mock_events_ref.where.assert_called_once()
+        assert webhook_main.event_code_cache_stats["fallbacks"] == fallbacks_before + 1
+
+
+class TestEventCache:
+    """Tests for the per-instance event metadata cache on the upload path."""
+
+    def _setup(self, mock_db, data=None):
+        mock_event_doc = MagicMock()
+        mock_event_doc.exists = data is not None
+        mock_event_doc.to_dict.return_value = data
+        mock_event_ref = MagicMock()
+        mock_event_ref.get.return_value = mock_event_doc
+        mock_db.collection.return_value.document.return_value = mock_event_ref
+        return mock_event_ref
+
+    @patch("webhook.main.db")
+    def test_repeated_lookups_read_once(self, mock_db):
+        """Uploads within the TTL reuse the cached status instead of reading the event."""
+        mock_event_ref = self._setup(
+            mock_db, {"status": "active", "event_name": "テスト結婚式", "settings": {"result_delivery": "two_phase"}}
+        )
+
+        for _ in range(3):
+            event = _get_event("event_001")
+
+        assert event["status"] == "active"
+        assert event["result_delivery"] == "two_phase"
+        assert mock_event_ref.get.call_count == 1
+
+    @patch("webhook.main.db")
+    def test_expired_entry_is_read_again(self, mock_db):
+        """A status change elsewhere is picked up once the entry expires."""
+        data = {"status": "active"}
+        mock_event_ref = self._setup(mock_db, data)
+
+        with patch("webhook.main.time.monotonic", return_value=1000.0):
+            _get_event("event_001")
+        data["status"] = "archived"
+        later = 1000.0 + webhook_main.EVENT_CACHE_TTL_SECONDS + 1
+        with patch("webhook.main.time.monotonic", return_value=later):
+            assert _get_event("event_001")["status"] == "archived"
+
+        assert mock_event_ref.get.call_count == 2
+
+    @patch("webhook.main.db")
+    def test_missing_event_not_cached(self, mock_db):
+        """Missing events are read again on every upload."""
+        mock_event_ref = self._setup(mock_db)
+
+        assert _get_event("gone") is None
+        assert _get_event("gone") is None
+        assert mock_event_ref.get.call_count == 2
+
+    @patch("webhook.main.db")
+    def test_invalidate_forces_read(self, mock_db):
+        """An invalidated event is read again on the next upload."""
+        mock_event_ref = self._setup(mock_db, {"status": "active"})
+
+        _get_event("event_001")
+        _invalidate_event("event_001")
+        _get_event("event_001")
+
+        assert mock_event_ref.get.call_count == 2
+
+    @patch("webhook.main.db")
+    def test_join_code_index_read_invalidates_event(self, mock_db):
+        """Resolving a JOIN code from the index drops the event's cached status."""
+        webhook_main._cache_event("event_001", {"status": "draft"}, 60)
+        mock_index_doc = MagicMock()
+        mock_index_doc.exists = True
+        mock_index_doc.to_dict.return_value = {"event_id": "event_001", "status": "active"}
+        mock_db.collection.return_value.document.return_value.get.return_value = mock_index_doc
+
+        _find_event_by_code("valid-code")
+
+        assert "event_001" not in webhook_main._event_cache
+
+    @patch("webhook.main.db")
+    def test_listener_not_started_by_default(self, mock_db):
+        """Without EVENT_LISTENER_ENABLED no Firestore listener is opened."""
+        mock_event_ref = self._setup(mock_db, {"status": "active"})
+
+        _get_event("event_001")
+
+        mock_event_ref.on_snapshot.assert_not_called()
+
+    @patch("webhook.main.EVENT_LISTENER_ENABLED", True)
+    @patch("webhook.main.db")
+    def test_listener_pushes_status_change(self, mock_db):
+        """With the listener, pushed snapshots update the cache without a read."""
+        mock_event_ref = self._setup(mock_db, {"status": "active", "event_code": "valid-code"})
+        webhook_main._event_code_cache["valid-code"] = ({"event_id": "event_001"}, float("inf"))
+
+        _get_event("event_001")
+        _get_event("event_001")
+        mock_event_ref.on_snapshot.assert_called_once()
+        callback = mock_event_ref.on_snapshot.call_args[0][0]
+
+        snapshot = MagicMock()
+        snapshot.exists = True
+        snapshot.to_dict.return_value = {"status": "archived", "event_code": "valid-code"}
+        callback([snapshot], [], None)
+
+        assert _get_event("event_001")["status"] == "archived"
+        assert mock_event_ref.get.call_count == 1
+        assert "valid-code" not in webhook_main._event_code_cache
+
+        callback([], [], None)  # Event deleted
+        assert "event_001" not in webhook_main._event_cache
+
+
 class TestJoinEventTransaction:
     """Tests for _join_event_transaction function directly."""
 
-    @patch("webhook.main.firestore.transactional", lambda f: f)
-    def test_transaction_new_user(self):
-        """Test transaction creates new user document."""
-        mock_transaction = MagicMock()
+    @staticmethod
+    def _setup(mock_db, user_data=None, pointer=None):
+        """Return (transaction, user_ref) for a user doc and the guest's line_users pointer."""
         mock_user_ref = MagicMock()
+        mock_user_ref.id = "user_1_evt_1"
         mock_doc = MagicMock()
-        mock_doc.exists = False
+        mock_doc.exists = user_data is not None
+        mock_doc.to_dict.return_value = user_data
         mock_user_ref.get.return_value = mock_doc
 
+        mock_pointer = MagicMock()
+        mock_pointer.exists = pointer is not None
+        mock_pointer.to_dict.return_value = pointer
+        mock_db.collection.return_value.document.return_value.get.return_value = mock_pointer
+        return MagicMock(), mock_user_ref
+
+    @staticmethod
+    def _pointer(join_status, name=None, user_doc_id="user_1_evt_1", event_id="evt_1"):
+        return {
+            "user_doc_id": user_doc_id,
+            "event_id": event_id,
+            "join_status": join_status,
+            "name": name,
+            "has_uploads": False,
+        }
+
+    @patch("webhook.main.db")
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    def test_transaction_new_user(self, mock_db):
+        """Test transaction creates new user document and points line_users at it."""
+        mock_transaction, mock_user_ref = self._setup(mock_db)
+
         message = _join_event_transaction(mock_transaction, mock_user_ref, "user_1", "evt_1", "Wedding")
-        mock_transaction.set.assert_called_once()
+        assert mock_transaction.set.call_count == 2
+        assert mock_transaction.set.call_args_list[0][0][0] is mock_user_ref
+        pointer_data = mock_transaction.set.call_args_list[1][0][1]
+        assert pointer_data["user_doc_id"] == "user_1_evt_1"
+        assert pointer_data["join_status"] == "pending_name"
         assert "Wedding" in message.text
 
+    @patch("webhook.main.db")
     @patch("webhook.main.firestore.transactional", lambda f: f)
-    def test_transaction_pending_name(self):
+    def test_transaction_pending_name(self, mock_db):
         """Test transaction returns prompt for pending_name user."""
-        mock_transaction = MagicMock()
-        mock_user_ref = MagicMock()
-        mock_doc = MagicMock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = {"join_status": "pending_name"}
-        mock_user_ref.get.return_value = mock_doc
+        mock_transaction, mock_user_ref = self._setup(
+            mock_db, {"join_status": "pending_name"}, self._pointer("pending_name")
+        )
 
         message = _join_event_transaction(mock_transaction, mock_user_ref, "user_1", "evt_1", "Wedding")
         mock_transaction.set.assert_not_called()
         mock_transaction.update.assert_not_called()
         assert "お名前" in message.text
 
+    @patch("webhook.main.db")
     @patch("webhook.main.firestore.transactional", lambda f: f)
-    def test_transaction_left_with_name(self):
+    def test_transaction_left_with_name(self, mock_db):
         """Test transaction reactivates left user with name to registered."""
-        mock_transaction = MagicMock()
-        mock_user_ref = MagicMock()
-        mock_doc = MagicMock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = {"join_status": "left", "name": "太郎"}
-        mock_user_ref.get.return_value = mock_doc
+        mock_transaction, mock_user_ref = self._setup(mock_db, {"join_status": "left", "name": "太郎"})
 
         message = _join_event_transaction(mock_transaction, mock_user_ref, "user_1", "evt_1", "Wedding")
         mock_transaction.update.assert_called_once_with(mock_user_ref, {"join_status": "registered"})
+        assert mock_transaction.set.call_args[0][1]["join_status"] == "registered"
         assert "おかえりなさい" in message.text
 
+    @patch("webhook.main.db")
     @patch("webhook.main.firestore.transactional", lambda f: f)
-    def test_transaction_left_without_name(self):
+    def test_transaction_left_without_name(self, mock_db):
         """Test transaction reactivates left user without name to pending_name."""
-        mock_transaction = MagicMock()
-        mock_user_ref = MagicMock()
-        mock_doc = MagicMock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = {"join_status": "left"}
-        mock_user_ref.get.return_value = mock_doc
+        mock_transaction, mock_user_ref = self._setup(mock_db, {"join_status": "left"})
 
         message = _join_event_transaction(mock_transaction, mock_user_ref, "user_1", "evt_1", "Wedding")
         mock_transaction.update.assert_called_once_with(mock_user_ref, {"join_status": "pending_name"})
         assert "再参加" in message.text
 
+    @patch("webhook.main.db")
     @patch("webhook.main.firestore.transactional", lambda f: f)
-    def test_transaction_registered(self):
+    def test_transaction_registered(self, mock_db):
         """Test transaction returns already-joined for registered user."""
-        mock_transaction = MagicMock()
-        mock_user_ref = MagicMock()
-        mock_doc = MagicMock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = {"join_status": "registered", "name": "太郎"}
-        mock_user_ref.get.return_value = mock_doc
+        mock_transaction, mock_user_ref = self._setup(
+            mock_db, {"join_status": "registered", "name": "太郎"}, self._pointer("registered", "太郎")
+        )
 
         message = _join_event_transaction(mock_transaction, mock_user_ref, "user_1", "evt_1", "Wedding")
         mock_transaction.set.assert_not_called()
         mock_transaction.update.assert_not_called()
         assert "参加済み" in message.text
 
+    @patch("webhook.main.db")
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    def test_transaction_deactivates_pointed_registration(self, mock_db):
+        """Test JOIN deactivates the registration the pointer named, without a scan."""
+        mock_transaction, mock_user_ref = self._setup(
+            mock_db, pointer=self._pointer("registered", "太郎", user_doc_id="user_1_old", event_id="old")
+        )
+        mock_previous_ref = MagicMock()
+        mock_previous_ref.get.return_value.exists = True
+        mock_previous_ref.get.return_value.to_dict.return_value = {"join_status": "registered"}
+        mock_line_users_ref = mock_db.collection.return_value
+        mock_users_ref = MagicMock()
+        mock_users_ref.document.return_value = mock_previous_ref
+        mock_db.collection.side_effect = lambda name: mock_users_ref if name == "users" else mock_line_users_ref
+
+        _join_event_transaction(mock_transaction, mock_user_ref, "user_1", "evt_1", "Wedding")
+
+        mock_transaction.update.assert_called_once_with(mock_previous_ref, {"join_status": "left"})
+        pointer_data = mock_transaction.set.call_args_list[1][0][1]
+        assert pointer_data["event_id"] == "evt_1"
+        assert pointer_data["user_doc_id"] == "user_1_evt_1"
+        mock_users_ref.document.assert_called_once_with("user_1_old")
+        mock_users_ref.where.assert_not_called()
+
 
 class TestFindUserByStatus:
     """Tests for _find_user_by_status helper."""
@@ -576,37 +919,172 @@ class TestFindUserByStatus:
         assert ref is None
 
 
+class TestRegistrationCache:
+    """Tests for registration lookups and the per-instance cache of registered guests."""
+
+    @staticmethod
+    def _setup_pointer(mock_db, pointer):
+        mock_pointer = MagicMock()
+        mock_pointer.exists = pointer is not None
+        mock_pointer.to_dict.return_value = pointer
+        mock_line_users_ref = MagicMock()
+        mock_line_users_ref.document.return_value.get.return_value = mock_pointer
+        mock_users_ref = MagicMock()
+        refs = {"line_users": mock_line_users_ref, "users": mock_users_ref}
+        mock_db.collection.side_effect = lambda name: refs.get(name, MagicMock())
+        return mock_line_users_ref.document.return_value, mock_users_ref
+
+    @staticmethod
+    def _registered_pointer():
+        return {
+            "user_doc_id": "user_123_event_001",
+            "event_id": "event_001",
+            "join_status": "registered",
+            "name": "テスト太郎",
+            "has_uploads": True,
+        }
+
+    @patch("webhook.main.db")
+    def test_lookup_is_one_point_read(self, mock_db):
+        pointer_ref, mock_users_ref = self._setup_pointer(mock_db, self._registered_pointer())
+
+        registration = _find_registration("user_123")
+
+        assert registration == {
+            "doc_id": "user_123_event_001",
+            "event_id": "event_001",
+            "join_status": "registered",
+            "name": "テスト太郎",
+            "has_uploads": True,
+        }
+        pointer_ref.get.assert_called_once()
+        mock_users_ref.where.assert_not_called()
+
+    @patch("webhook.main.db")
+    def test_repeated_lookups_read_once(self, mock_db):
+        pointer_ref, _users_ref = self._setup_pointer(mock_db, self._registered_pointer())
+        hits_before = webhook_main.registration_cache_stats["hits"]
+
+        first = _find_registration("user_123")
+        second = _find_registration("user_123")
+
+        assert first == second
+        assert pointer_ref.get.call_count == 1
+        assert webhook_main.registration_cache_stats["hits"] == hits_before + 1
+
+    @patch("webhook.main.db")
+    def test_pending_guest_is_not_cached(self, mock_db):
+        pointer = {**self._registered_pointer(), "join_status": "pending_name", "name": None}
+        pointer_ref, _users_ref = self._setup_pointer(mock_db, pointer)
+
+        assert _find_registration("user_123")["join_status"] == "pending_name"
+        assert _find_registration("user_123")["join_status"] == "pending_name"
+        assert pointer_ref.get.call_count == 2
+
+    @patch("webhook.main.db")
+    def test_guest_without_pointer_falls_back_to_query(self, mock_db):
+        _pointer_ref, mock_users_ref = self._setup_pointer(mock_db, None)
+        mock_doc = MagicMock()
+        mock_doc.id = "user_123_event_001"
+        mock_doc.to_dict.return_value = {"event_id": "event_001", "name": "テスト太郎", "total_uploads": 0}
+        mock_query = mock_users_ref.where.return_value.where.return_value.order_by.return_value.limit.return_value
+        mock_query.stream.side_effect = lambda: iter([mock_doc])
+
+        registration = _find_registration("user_123", include_pending=False)
+
+        assert registration["join_status"] == "registered"
+        assert registration["has_uploads"] is False
+        assert mock_query.stream.call_count == 1
+
+    @patch("webhook.main.time.monotonic")
+    @patch("webhook.main.db")
+    def test_entry_expires_after_ttl(self, mock_db, mock_monotonic):
+        pointer_ref, _users_ref = self._setup_pointer(mock_db, self._registered_pointer())
+        mock_monotonic.return_value = 1000.0
+        _find_registration("user_123")
+
+        mock_monotonic.return_value = 1000.0 + webhook_main.REGISTRATION_CACHE_TTL_SECONDS + 1
+        _find_registration("user_123")
+
+        assert pointer_ref.get.call_count == 2
+
+    @patch("webhook.main.db")
+    def test_deactivation_invalidates_entry(self, mock_db):
+        self._setup_pointer(mock_db, self._registered_pointer())
+        _find_registration("user_123")
+
+        _deactivate_other_registrations("user_123", "event_002")
+
+        assert "user_123" not in webhook_main._registration_cache
+
+
 class TestRegisterName:
     """Tests for _register_name function."""
 
+    @staticmethod
+    def _pending_registration():
+        return {
+            "doc_id": "user_123_event_001",
+            "event_id": "event_001",
+            "join_status": "pending_name",
+            "name": None,
+            "has_uploads": False,
+        }
+
+    @staticmethod
+    def _setup(mock_db):
+        mock_user_ref = MagicMock()
+        mock_user_ref.id = "user_123_event_001"
+        mock_user_ref.get.return_value.exists = True
+        mock_user_ref.get.return_value.to_dict.return_value = {"event_id": "event_001", "join_status": "pending_name"}
+        mock_pointer_ref = MagicMock()
+        mock_pointer_ref.get.return_value.exists = False
+        mock_db.collection.side_effect = lambda name: MagicMock(
+            document=MagicMock(return_value=mock_user_ref if name == "users" else mock_pointer_ref)
+        )
+        return mock_user_ref, mock_pointer_ref
+
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    @patch("webhook.main.db")
     @patch("webhook.main.messaging_api")
-    def test_register_name_success(self, mock_messaging_api):
+    def test_register_name_success(self, mock_messaging_api, mock_db):
         """Test successful name registration."""
-        mock_ref = MagicMock()
-        mock_doc = MagicMock()
+        mock_user_ref, mock_pointer_ref = self._setup(mock_db)
+        mock_transaction = mock_db.transaction.return_value
 
-        _register_name("テスト太郎", "user_123", mock_doc, mock_ref, "reply_token_1")
+        _register_name("テスト太郎", "user_123", self._pending_registration(), "reply_token_1")
 
-        mock_ref.update.assert_called_once_with(
+        mock_transaction.update.assert_called_once_with(
+            mock_user_ref,
             {
                 "name": "テスト太郎",
                 "join_status": "registered",
-            }
+            },
         )
+        pointer_ref, pointer_data = mock_transaction.set.call_args[0]
+        assert pointer_ref is mock_pointer_ref
+        assert pointer_data["join_status"] == "registered"
+        assert pointer_data["name"] == "テスト太郎"
         reply_text = _get_reply_text(mock_messaging_api)
         assert "テスト太郎" in reply_text
         assert "登録完了" in reply_text
 
+        registration, _valid_until = webhook_main._registration_cache["user_123"]
+        assert registration["join_status"] == "registered"
+        assert registration["name"] == "テスト太郎"
+
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    @patch("webhook.main.db")
     @patch("webhook.main.messaging_api")
-    def test_register_name_failure(self, mock_messaging_api):
+    def test_register_name_failure(self, mock_messaging_api, mock_db):
         """Test name registration failure."""
-        mock_ref = MagicMock()
-        mock_ref.update.side_effect = Exception("Firestore error")
-        mock_doc = MagicMock()
+        self._setup(mock_db)
+        mock_db.transaction.return_value.update.side_effect = Exception("Firestore error")
 
-        _register_name("テスト太郎", "user_123", mock_doc, mock_ref, "reply_token_1")
+        _register_name("テスト太郎", "user_123", self._pending_registration(), "reply_token_1")
 
         assert "失敗" in _get_reply_text(mock_messaging_api)
+        assert "user_123" not in webhook_main._registration_cache
 
 
 class TestHandleCommand:
@@ -634,11 +1112,21 @@ class TestHandleCommand:
         assert "アップロード" in _get_reply_text(mock_messaging_api)
 
 
-def _make_image_event(user_id="user_123", message_id="msg_001", reply_token="reply_token_img"):
+def _mock_line_content(mock_blob_api, data: bytes, content_length: int | None = None):
+    """Make the LINE content request return a streamable (non-preloaded) urllib3-like response."""
+    raw = MagicMock()
+    raw.headers = {"Content-Length": str(len(data) if content_length is None else content_length)}
+    raw.stream.return_value = iter([data[i : i + 4] for i in range(0, len(data), 4)])
+    mock_blob_api.api_client.request.return_value = raw
+    return raw
+
+
+def _make_image_event(user_id="user_123", message_id="msg_001", reply_token="reply_token_img", image_set=None):
     """Create a mock LINE ImageMessageContent event."""
     event = MagicMock()
     event.source.user_id = user_id
     event.message.id = message_id
+    event.message.image_set = image_set
     event.reply_token = reply_token
     return event
 
@@ -673,6 +1161,10 @@ class TestHandleImageMessage:
         mock_users_ref.document.return_value = mock_user_ref
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -713,6 +1205,10 @@ class TestHandleImageMessage:
         mock_users_ref.document.return_value = mock_user_ref
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -756,6 +1252,10 @@ class TestHandleImageMessage:
         mock_images_ref = MagicMock()
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -767,7 +1267,7 @@ class TestHandleImageMessage:
         mock_db.collection.side_effect = collection_side_effect
 
         # Mock LINE blob API to return image bytes
-        mock_blob_api.get_message_content.return_value = b"fake_image_data"
+        _mock_line_content(mock_blob_api, b"fake_image_data")
 
         # Mock storage
         mock_bucket = MagicMock()
@@ -790,6 +1290,8 @@ class TestHandleImageMessage:
             "name": "テスト太郎",
         }
         mock_user_ref = MagicMock()
+        # Joined before users.active_uploads existed: counted from images once
+        mock_user_ref.get.return_value.to_dict.return_value = {}
 
         mock_event_doc = MagicMock()
         mock_event_doc.exists = True
@@ -817,6 +1319,10 @@ class TestHandleImageMessage:
         mock_images_ref.where.return_value.where.return_value.select.return_value = mock_images_query
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -847,6 +1353,8 @@ class TestHandleImageMessage:
             "name": "テスト太郎",
         }
         mock_user_ref = MagicMock()
+        # Joined before users.active_uploads existed: counted from images once
+        mock_user_ref.get.return_value.to_dict.return_value = {}
 
         mock_event_doc = MagicMock()
         mock_event_doc.exists = True
@@ -874,6 +1382,10 @@ class TestHandleImageMessage:
         mock_images_ref.where.return_value.where.return_value.select.return_value = mock_images_query
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -884,7 +1396,7 @@ class TestHandleImageMessage:
 
         mock_db.collection.side_effect = collection_side_effect
 
-        mock_blob_api.get_message_content.return_value = b"fake_image_data"
+        _mock_line_content(mock_blob_api, b"fake_image_data")
         mock_bucket = MagicMock()
         mock_storage.bucket.return_value = mock_bucket
 
@@ -904,6 +1416,8 @@ class TestHandleImageMessage:
             "name": "テスト太郎",
         }
         mock_user_ref = MagicMock()
+        # Joined before users.active_uploads existed: counted from images once
+        mock_user_ref.get.return_value.to_dict.return_value = {}
 
         mock_event_doc = MagicMock()
         mock_event_doc.exists = True
@@ -934,6 +1448,10 @@ class TestHandleImageMessage:
         mock_images_ref.where.return_value.where.return_value.select.return_value = mock_images_query
 
         def collection_side_effect(name):
+            if name == "line_users":
+                return _missing_line_users_ref()
+            if name == "event_codes":
+                return _missing_event_codes_ref()
             if name == "events":
                 return mock_events_ref
             elif name == "users":
@@ -948,7 +1466,7 @@ class TestHandleImageMessage:
         # Should not raise / should not return limit message
         # Need storage mock since it will proceed to upload
         with patch("webhook.main.storage_client"), patch("webhook.main.messaging_api_blob") as mock_blob:
-            mock_blob.get_message_content.return_value = b"fake_image_data"
+            _mock_line_content(mock_blob, b"fake_image_data")
             handle_image_message(event)
 
         reply_text = _get_reply_text(mock_messaging_api)
@@ -999,3 +1517,1227 @@ class TestCountUserImages:
         mock_db.collection.return_value = mock_images_ref
 
         assert _count_user_images("user_1", "event_1") == 0
+
+
+class TestDraftUploadCounter:
+    """Tests for the users.active_uploads counter behind the draft upload limit."""
+
+    def _user_ref(self, exists=True, **data):
+        mock_user_ref = MagicMock()
+        mock_user_ref.get.return_value.exists = exists
+        mock_user_ref.get.return_value.to_dict.return_value = data
+        return mock_user_ref
+
+    @patch("webhook.main._count_user_images")
+    def test_reserve_increments_without_counting_images(self, mock_count):
+        """Under the limit a reservation is a compare-and-increment on the user document."""
+        mock_transaction = MagicMock()
+        mock_user_ref = self._user_ref(active_uploads=2)
+
+        assert _reserve_draft_upload_transaction(mock_transaction, mock_user_ref, "user_1", "event_1") == (True, 3)
+
+        mock_count.assert_not_called()
+        assert mock_transaction.update.call_args[0][1]["active_uploads"] == 3
+
+    @patch("webhook.main._count_user_images")
+    def test_reserve_rejected_at_limit_while_upload_in_flight(self, mock_count):
+        """A parallel upload at the limit is rejected without recounting (its sibling is not stored yet)."""
+        mock_transaction = MagicMock()
+        mock_user_ref = self._user_ref(active_uploads=DRAFT_UPLOAD_LIMIT, active_uploads_reserved_at=datetime.now(UTC))
+
+        assert _reserve_draft_upload_transaction(mock_transaction, mock_user_ref, "user_1", "event_1") == (
+            False,
+            DRAFT_UPLOAD_LIMIT,
+        )
+
+        mock_count.assert_not_called()
+        mock_transaction.update.assert_not_called()
+
+    @patch("webhook.main._count_user_images", return_value=2)
+    def test_reserve_recounts_idle_guest_at_limit(self, mock_count):
+        """Deletions that missed the counter are picked up once no upload is in flight."""
+        mock_transaction = MagicMock()
+        mock_user_ref = self._user_ref(
+            active_uploads=DRAFT_UPLOAD_LIMIT, active_uploads_reserved_at=datetime(2025, 1, 1, tzinfo=UTC)
+        )
+
+        assert _reserve_draft_upload_transaction(mock_transaction, mock_user_ref, "user_1", "event_1") == (True, 3)
+        mock_count.assert_called_once_with("user_1", "event_1")
+
+    @patch("webhook.main._count_user_images", return_value=DRAFT_UPLOAD_LIMIT)
+    def test_reserve_seeds_missing_counter(self, mock_count):
+        """Guests who joined before the counter existed are counted from images once."""
+        mock_transaction = MagicMock()
+        mock_user_ref = self._user_ref()
+
+        assert _reserve_draft_upload_transaction(mock_transaction, mock_user_ref, "user_1", "event_1") == (
+            False,
+            DRAFT_UPLOAD_LIMIT,
+        )
+        mock_transaction.update.assert_called_once_with(mock_user_ref, {"active_uploads": DRAFT_UPLOAD_LIMIT})
+
+    def test_reserve_missing_user_document(self):
+        mock_transaction = MagicMock()
+
+        result = _reserve_draft_upload_transaction(mock_transaction, self._user_ref(exists=False), "user_1", "event_1")
+
+        assert result == (False, None)
+        mock_transaction.update.assert_not_called()
+
+    def test_release_never_goes_below_zero(self):
+        mock_transaction = MagicMock()
+
+        _release_upload_transaction(mock_transaction, self._user_ref(active_uploads=2))
+        _release_upload_transaction(mock_transaction, self._user_ref(active_uploads=0))
+        _release_upload_transaction(mock_transaction, self._user_ref())
+
+        mock_transaction.update.assert_called_once()
+        assert mock_transaction.update.call_args[0][1] == {"active_uploads": 1}
+
+    @patch("webhook.main._release_upload")
+    @patch("webhook.main._acquire_upload_slot", return_value=12.3)
+    @patch("webhook.main._reserve_draft_upload_transaction", return_value=(True, 3))
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.db")
+    def test_rate_limited_draft_upload_gives_slot_back(
+        self, mock_db, mock_messaging_api, mock_reserve, mock_acquire, mock_release
+    ):
+        refs = _setup_active_event_db(mock_db, event_status="draft")
+
+        handle_image_message(_make_image_event())
+
+        mock_release.assert_called_once_with(refs["users"].document.return_value)
+
+    @patch("webhook.main._release_upload")
+    @patch("webhook.main._reserve_draft_upload_transaction", return_value=(True, 3))
+    @patch("webhook.main.messaging_api_blob")
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_stored_draft_upload_keeps_slot(
+        self, mock_db, mock_storage, mock_messaging_api, mock_blob, mock_reserve, mock_release
+    ):
+        """A reserved upload is not counted again at ingest, nor given back."""
+        refs = _setup_active_event_db(mock_db, event_status="draft")
+        _mock_line_content(mock_blob, b"img")
+
+        handle_image_message(_make_image_event())
+
+        mock_db.batch.return_value.commit.assert_called_once()
+        user_ref = refs["users"].document.return_value
+        assert all(c[0][0] is not user_ref for c in mock_db.batch.return_value.update.call_args_list)
+        mock_release.assert_not_called()
+
+    @patch("webhook.main.messaging_api_blob")
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_active_upload_counted_in_ingest_batch(self, mock_db, mock_storage, mock_messaging_api, mock_blob):
+        refs = _setup_active_event_db(mock_db)
+        _mock_line_content(mock_blob, b"img")
+
+        handle_image_message(_make_image_event())
+
+        user_ref = refs["users"].document.return_value
+        mock_db.batch.return_value.update.assert_any_call(
+            user_ref, {"active_uploads": webhook_main.firestore.Increment(1)}
+        )
+
+    @patch("webhook.main._release_upload")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_unsend_gives_upload_back(self, mock_db, mock_storage, mock_release):
+        image_doc = _make_image_doc(user_id="user_1")
+        mock_db.collection.return_value.where.return_value.limit.return_value.stream.return_value = iter([image_doc])
+        event = MagicMock()
+        event.source.user_id = "user_1"
+
+        handle_unsend(event)
+
+        mock_db.collection.return_value.document.assert_called_with("user_1_evt_1")
+        mock_release.assert_called_once()
+
+    @patch("webhook.main._release_upload")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_unsend_of_soft_deleted_image_not_counted_twice(self, mock_db, mock_storage, mock_release):
+        image_doc = _make_image_doc(user_id="user_1", deleted_at="2025-01-01")
+        mock_db.collection.return_value.where.return_value.limit.return_value.stream.return_value = iter([image_doc])
+        event = MagicMock()
+        event.source.user_id = "user_1"
+
+        handle_unsend(event)
+
+        mock_release.assert_not_called()
+
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    @patch("webhook.main._release_upload")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_unsend_of_pending_image_drains_backlog(self, mock_db, mock_storage, mock_release):
+        image_doc = _make_image_doc(user_id="user_1")
+        image_doc.reference.get.return_value = _make_image_doc(status="pending")
+        mock_db.collection.return_value.where.return_value.limit.return_value.stream.return_value = iter([image_doc])
+        event = MagicMock()
+        event.source.user_id = "user_1"
+
+        handle_unsend(event)
+
+        transaction = mock_db.transaction.return_value
+        transaction.delete.assert_called_once_with(image_doc.reference)
+        assert transaction.set.call_args[0][1]["pending"] == firestore.Increment(-1)
+
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    @patch("webhook.main._release_upload")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_unsend_of_scored_image_keeps_backlog(self, mock_db, mock_storage, mock_release):
+        image_doc = _make_image_doc(user_id="user_1")
+        image_doc.reference.get.return_value = _make_image_doc(status="completed")
+        mock_db.collection.return_value.where.return_value.limit.return_value.stream.return_value = iter([image_doc])
+        event = MagicMock()
+        event.source.user_id = "user_1"
+
+        handle_unsend(event)
+
+        mock_db.transaction.return_value.delete.assert_called_once_with(image_doc.reference)
+        mock_db.transaction.return_value.set.assert_not_called()
+
+
+def _make_image_doc(exists=True, **data):
+    doc = MagicMock()
+    doc.exists = exists
+    doc.to_dict.return_value = {"event_id": "evt_1", "storage_path": "original/evt_1/u/1.jpg", **data}
+    return doc
+
+
+class TestImageRedirect:
+    """Tests for the on-demand image redirect endpoint."""
+
+    def setup_method(self):
+        self.app = Flask(__name__)
+        _image_url_cache.clear()
+
+    def _call(self, path="/img_1", method="GET"):
+        with self.app.test_request_context(path, method=method):
+            from flask import request
+
+            return image_redirect(request)
+
+    @patch("webhook.main.generate_signed_url")
+    @patch("webhook.main.db")
+    def test_redirects_to_signed_url(self, mock_db, mock_sign):
+        mock_db.collection.return_value.document.return_value.get.return_value = _make_image_doc()
+        mock_sign.return_value = ("https://signed/1", None)
+
+        body, status, headers = self._call()
+
+        assert status == 302
+        assert headers["Location"] == "https://signed/1"
+        assert headers["Cache-Control"].startswith("public, max-age=")
+        mock_sign.assert_called_once()
+
+    @patch("webhook.main.generate_signed_url")
+    @patch("webhook.main.db")
+    def test_reuses_cached_signature(self, mock_db, mock_sign):
+        mock_db.collection.return_value.document.return_value.get.return_value = _make_image_doc()
+        mock_sign.return_value = ("https://signed/1", None)
+
+        self._call()
+        _, status, headers = self._call()
+
+        assert status == 302
+        assert headers["Location"] == "https://signed/1"
+        mock_sign.assert_called_once()
+
+    @patch("webhook.main.generate_signed_url")
+    @patch("webhook.main.db")
+    def test_deleted_image_returns_404(self, mock_db, mock_sign):
+        mock_db.collection.return_value.document.return_value.get.return_value = _make_image_doc(deleted_at="x")
+
+        _, status, headers = self._call()
+
+        assert status == 404
+        assert headers["Cache-Control"] == "no-store"
+        mock_sign.assert_not_called()
+
+    @patch("webhook.main.generate_signed_url")
+    @patch("webhook.main.db")
+    def test_cached_signature_is_not_served_after_soft_delete(self, mock_db, mock_sign):
+        image_get = mock_db.collection.return_value.document.return_value.get
+        image_get.return_value = _make_image_doc()
+        mock_sign.return_value = ("https://signed/1", None)
+        self._call()
+
+        image_get.return_value = _make_image_doc(deleted_at="x")
+        _, status, _ = self._call()
+
+        assert status == 404
+        assert "img_1" not in _image_url_cache
+
+    @patch("webhook.main.generate_signed_url")
+    @patch("webhook.main.db")
+    def test_image_of_deleted_event_returns_404(self, mock_db, mock_sign):
+        mock_db.collection.return_value.document.return_value.get.return_value = _make_image_doc(status="deleted")
+
+        _, status, _ = self._call()
+
+        assert status == 404
+        mock_sign.assert_not_called()
+
+    @patch("webhook.main.generate_signed_url")
+    @patch("webhook.main.db")
+    def test_missing_image_returns_404(self, mock_db, mock_sign):
+        mock_db.collection.return_value.document.return_value.get.return_value = _make_image_doc(exists=False)
+
+        _, status, _ = self._call()
+
+        assert status == 404
+        mock_sign.assert_not_called()
+
+    def test_invalid_id_returns_400(self):
+        _, status, _ = self._call("/bad$id")
+        assert status == 400
+
+
+class TestDeferredWebhook:
+    """Tests for acknowledge-first webhook processing."""
+
+    def _call(self):
+        app = Flask(__name__)
+        with app.test_request_context("/", method="POST", data='{"events": []}', headers={"X-Line-Signature": "sig"}):
+            from flask import request
+
+            return webhook(request)
+
+    @patch("webhook.main.WEBHOOK_PROCESSING_MODE", "deferred")
+    @patch("webhook.main.dispatch_events")
+    @patch("webhook.main.handler")
+    @patch("webhook.main.db")
+    def test_deferred_persists_without_handling(self, mock_db, mock_handler, mock_dispatch):
+        mock_handler.parser.parse.return_value = MagicMock(events=[MagicMock()])
+
+        _, status = self._call()
+
+        assert status == 200
+        saved = mock_db.collection.return_value.document.return_value.set.call_args[0][0]
+        assert saved["status"] == "pending"
+        assert saved["signature"] == "sig"
+        mock_dispatch.assert_not_called()
+
+    @patch("webhook.main.WEBHOOK_PROCESSING_MODE", "deferred")
+    @patch("webhook.main.dispatch_events")
+    @patch("webhook.main.handler")
+    @patch("webhook.main.db")
+    def test_deferred_falls_back_to_sync_when_persist_fails(self, mock_db, mock_handler, mock_dispatch):
+        mock_handler.parser.parse.return_value = MagicMock(events=[MagicMock()])
+        mock_dispatch.return_value = {"events": 1, "users": 1, "failed": 0}
+        mock_db.collection.return_value.document.return_value.set.side_effect = Exception("unavailable")
+
+        _, status = self._call()
+
+        assert status == 200
+        mock_dispatch.assert_called_once()
+
+    @patch("webhook.main.WEBHOOK_PROCESSING_MODE", "sync")
+    @patch("webhook.main.dispatch_events")
+    @patch("webhook.main.db")
+    def test_sync_mode_handles_inline(self, mock_db, mock_dispatch):
+        mock_dispatch.return_value = {"events": 1, "users": 1, "failed": 0}
+
+        _, status = self._call()
+
+        assert status == 200
+        mock_dispatch.assert_called_once_with('{"events": []}', "sig")
+        mock_db.collection.assert_not_called()
+
+    @patch("webhook.main.WEBHOOK_PROCESSING_MODE", "sync")
+    @patch("webhook.main.dispatch_events")
+    @patch("webhook.main.db")
+    def test_sync_mode_failed_events_return_error_for_redelivery(self, mock_db, mock_dispatch):
+        mock_dispatch.return_value = {"events": 2, "users": 2, "failed": 1}
+
+        _, status = self._call()
+
+        assert status == 500
+
+
+class TestProcessWebhookDelivery:
+    """Tests for the deferred delivery worker."""
+
+    @patch("webhook.main._claim_delivery")
+    @patch("webhook.main.dispatch_events")
+    @patch("webhook.main.db")
+    def test_processes_claimed_delivery(self, mock_db, mock_dispatch, mock_claim):
+        mock_claim.return_value = {"body": "{}", "signature": "sig", "event_count": 1}
+        mock_dispatch.return_value = {"events": 1, "users": 1, "failed": 0}
+
+        assert process_webhook_delivery("req_1") is True
+
+        mock_dispatch.assert_called_once_with("{}", "sig")
+        delivery_ref = mock_db.collection.return_value.document.return_value
+        assert delivery_ref.update.call_args[0][0]["status"] == "done"
+
+    @patch("webhook.main._claim_delivery", return_value=None)
+    @patch("webhook.main.dispatch_events")
+    @patch("webhook.main.db")
+    def test_skips_already_claimed_delivery(self, mock_db, mock_dispatch, mock_claim):
+        assert process_webhook_delivery("req_1") is False
+        mock_dispatch.assert_not_called()
+
+    @patch("webhook.main._claim_delivery")
+    @patch("webhook.main.dispatch_events")
+    @patch("webhook.main.db")
+    def test_marks_failed_delivery(self, mock_db, mock_dispatch, mock_claim):
+        mock_claim.return_value = {"body": "{}", "signature": "sig"}
+        mock_dispatch.side_effect = Exception("boom")
+
+        with pytest.raises(Exception, match="boom"):
+            process_webhook_delivery("req_1")
+
+        delivery_ref = mock_db.collection.return_value.document.return_value
+        assert delivery_ref.update.call_args[0][0]["status"] == "failed"
+
+    @patch("webhook.main._claim_delivery")
+    @patch("webhook.main.handler")
+    @patch("webhook.main.db")
+    def test_failed_event_fails_delivery_for_retry(self, mock_db, mock_handler, mock_claim):
+        _seen_webhook_events.clear()
+        mock_claim.return_value = {"body": "{}", "signature": "sig", "attempts": 0}
+        events = [_make_text_event("u1", "ok"), _make_text_event("u2", "fail")]
+        mock_handler.parser.parse.return_value = MagicMock(events=events)
+
+        def fake_handler(event):
+            if event.message.text == "fail":
+                raise RuntimeError("boom")
+
+        _route_mock_events(fake_handler)
+
+        with pytest.raises(WebhookEventsFailedError):
+            process_webhook_delivery("req_1")
+
+        delivery_ref = mock_db.collection.return_value.document.return_value
+        assert delivery_ref.update.call_args[0][0]["status"] == "failed"
+
+    def _delivery_ref(self, **data):
+        delivery_ref = MagicMock()
+        delivery_ref.get.return_value.exists = True
+        delivery_ref.get.return_value.to_dict.return_value = {"body": "{}", **data}
+        return delivery_ref
+
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    def test_failed_and_stale_deliveries_are_reclaimed(self):
+        stale = datetime.now(UTC) - timedelta(minutes=5)
+        for data in ({"status": "failed", "attempts": 1}, {"status": "processing", "attempts": 1, "started_at": stale}):
+            transaction = MagicMock()
+
+            assert _claim_delivery(transaction, self._delivery_ref(**data)) is not None
+            assert transaction.update.call_args[0][1]["attempts"] == 2
+
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    def test_running_delivery_is_retried_later(self):
+        delivery_ref = self._delivery_ref(status="processing", attempts=1, started_at=datetime.now(UTC))
+
+        with pytest.raises(DeliveryInProgressError):
+            _claim_delivery(MagicMock(), delivery_ref)
+
+    @patch("webhook.main.WEBHOOK_DELIVERY_MAX_ATTEMPTS", 3)
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    def test_done_or_exhausted_delivery_is_not_claimed(self):
+        for data in ({"status": "done", "attempts": 1}, {"status": "failed", "attempts": 3}):
+            transaction = MagicMock()
+
+            assert _claim_delivery(transaction, self._delivery_ref(**data)) is None
+            transaction.update.assert_not_called()
+
+
+def _make_text_event(user_id, text="hi"):
+    event = MagicMock()
+    event.source.user_id = user_id
+    event.message.text = text
+    event.webhook_event_id = f"evt_{user_id}_{text}"
+    return event
+
+
+class TestDispatchEvents:
+    """Tests for per-user concurrent event dispatch."""
+
+    def setup_method(self):
+        _seen_webhook_events.clear()
+
+    @patch("webhook.main.handler")
+    def test_keeps_per_user_order_and_isolates_failures(self, mock_handler):
+        calls = []
+
+        def fake_handler(event):
+            calls.append((event.source.user_id, event.message.text))
+            if event.message.text == "fail":
+                raise RuntimeError("boom")
+
+        events = [
+            _make_text_event("u1", "JOIN abc"),
+            _make_text_event("u2", "fail"),
+            _make_text_event("u1", "太郎"),
+            _make_text_event("u2", "after"),
+        ]
+        mock_handler.parser.parse.return_value = MagicMock(events=events)
+        _route_mock_events(fake_handler)
+
+        stats = dispatch_events("{}", "sig")
+
+        assert stats == {"events": 4, "users": 2, "failed": 1}
+        assert [c for c in calls if c[0] == "u1"] == [("u1", "JOIN abc"), ("u1", "太郎")]
+        assert [c for c in calls if c[0] == "u2"] == [("u2", "fail"), ("u2", "after")]
+
+
+def _setup_active_event_db(mock_db, set_exists=False, event_status="active"):
+    """Route db.collection() to a registered user in an event with the given status."""
+    mock_user_doc = MagicMock()
+    mock_user_doc.to_dict.return_value = {"event_id": "event_001", "name": "テスト太郎"}
+    mock_users_ref = MagicMock()
+    mock_users_ref.where.return_value.where.return_value.order_by.return_value.limit.return_value.stream.return_value = iter(
+        [mock_user_doc]
+    )
+
+    mock_event_doc = MagicMock()
+    mock_event_doc.exists = True
+    mock_event_doc.to_dict.return_value = {"status": event_status}
+    mock_events_ref = MagicMock()
+    mock_events_ref.document.return_value.get.return_value = mock_event_doc
+
+    mock_sets_ref = MagicMock()
+    if set_exists:
+        mock_sets_ref.document.return_value.create.side_effect = Conflict("exists")
+
+    refs = {
+        "users": mock_users_ref,
+        "events": mock_events_ref,
+        "image_sets": mock_sets_ref,
+        "line_users": _missing_line_users_ref(),
+    }
+    mock_db.collection.side_effect = lambda name: refs.get(name, MagicMock())
+    return refs
+
+
+class TestImageSet:
+    """Tests for grouped handling of multi-image sends."""
+
+    def _image_set(self, index=1):
+        image_set = MagicMock()
+        image_set.id = "set_1"
+        image_set.index = index
+        image_set.total = 3
+        return image_set
+
+    @patch("webhook.main.SCORING_FUNCTION_URL", "https://scoring")
+    @patch("webhook.main.trigger_scoring_function")
+    @patch("webhook.main.messaging_api_blob")
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_first_image_sends_single_loading_reply(
+        self, mock_db, mock_storage, mock_messaging_api, mock_blob, mock_trigger
+    ):
+        _setup_active_event_db(mock_db)
+        _mock_line_content(mock_blob, b"img")
+
+        handle_image_message(_make_image_event(image_set=self._image_set(index=1)))
+
+        assert "3枚" in _get_reply_text(mock_messaging_api)
+        image_doc = next(c[0][1] for c in mock_db.batch.return_value.set.call_args_list if "image_set_id" in c[0][1])
+        assert image_doc["image_set_index"] == 1
+        assert image_doc["upload_class"] == "first"
+        assert mock_trigger.call_args.kwargs == {
+            "image_set_id": "set_1",
+            "image_set_index": 1,
+            "image_bytes": b"img",
+            "event_id": "event_001",
+            "upload_class": "first",
+        }
+
+    @patch("webhook.main.SCORING_FUNCTION_URL", "https://scoring")
+    @patch("webhook.main.trigger_scoring_function")
+    @patch("webhook.main.messaging_api_blob")
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_later_images_do_not_reply(self, mock_db, mock_storage, mock_messaging_api, mock_blob, mock_trigger):
+        _setup_active_event_db(mock_db, set_exists=True)
+        _mock_line_content(mock_blob, b"img")
+
+        handle_image_message(_make_image_event(image_set=self._image_set(index=2)))
+
+        mock_messaging_api.reply_message.assert_not_called()
+        mock_trigger.assert_called_once()
+
+    @patch("webhook.main._count_image_set_item")
+    @patch("webhook.main.messaging_api_blob")
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_ingest_failure_is_counted_instead_of_pushed(
+        self, mock_db, mock_storage, mock_messaging_api, mock_blob, mock_count
+    ):
+        _setup_active_event_db(mock_db, set_exists=True)
+        mock_blob.api_client.request.side_effect = Exception("download failed")
+
+        handle_image_message(_make_image_event(image_set=self._image_set(index=2)))
+
+        mock_count.assert_called_once_with("set_1", "user_123", "failed")
+        mock_messaging_api.push_message.assert_not_called()
+
+
+class TestEventHandlerRegistry:
+    """Tests for resolving handlers of events parsed by the LINE SDK."""
+
+    MESSAGES = {
+        "text": {"type": "text", "text": "hi", "quoteToken": "q"},
+        "image": {"type": "image", "contentProvider": {"type": "line"}, "quoteToken": "q"},
+        "video": {"type": "video", "duration": 1000, "contentProvider": {"type": "line"}, "quoteToken": "q"},
+        "audio": {"type": "audio", "duration": 1000, "contentProvider": {"type": "line"}},
+        "sticker": {
+            "type": "sticker",
+            "packageId": "1",
+            "stickerId": "1",
+            "stickerResourceType": "STATIC",
+            "quoteToken": "q",
+        },
+        "location": {"type": "location", "latitude": 35.0, "longitude": 139.0},
+        "file": {"type": "file", "fileName": "a.pdf", "fileSize": 1},
+    }
+
+    def _parse(self, events):
+        common = {
+            "mode": "active",
+            "timestamp": 0,
+            "source": {"type": "user", "userId": "U1"},
+            "deliveryContext": {"isRedelivery": False},
+        }
+        body = json.dumps(
+            {"destination": "D1", "events": [{**common, "webhookEventId": f"e{i}", **e} for i, e in enumerate(events)]}
+        )
+        signature = base64.b64encode(
+            hmac.new(b"test_channel_secret", body.encode("utf-8"), hashlib.sha256).digest()
+        ).decode("utf-8")
+        return webhook_main.handler.parser.parse(body, signature, as_payload=True).events
+
+    def test_every_registered_handler_resolves(self):
+        events = self._parse(
+            [
+                {"type": "message", "replyToken": "r", "message": {"id": str(i), **message}}
+                for i, message in enumerate(self.MESSAGES.values())
+            ]
+            + [{"type": "unsend", "unsend": {"messageId": "1"}}]
+        )
+
+        resolved = [_get_event_handler(event) for event in events]
+
+        assert [func.__name__ for func in resolved] == [
+            *(f"handle_{name}_message" for name in self.MESSAGES),
+            "handle_unsend",
+        ]
+        assert set(resolved) == set(webhook_main._event_handlers.values())
+
+
+class TestWebhookEventIdempotency:
+    """Tests for redelivery-safe event processing."""
+
+    def setup_method(self):
+        _seen_webhook_events.clear()
+
+    def _existing_claim(self, mock_db, **data):
+        event_ref = mock_db.collection.return_value.document.return_value
+        event_ref.create.side_effect = Conflict("exists")
+        event_ref.get.return_value.exists = True
+        event_ref.get.return_value.to_dict.return_value = data
+        return event_ref
+
+    @patch("webhook.main.db")
+    def test_first_delivery_is_claimed(self, mock_db):
+        event = _make_text_event("u1")
+
+        assert _claim_webhook_event(event) is True
+        created = mock_db.collection.return_value.document.return_value.create.call_args[0][0]
+        assert "expire_at" in created
+        assert created["status"] == "processing"
+
+    @patch("webhook.main.db")
+    def test_duplicate_in_same_instance_skips_firestore(self, mock_db):
+        event = _make_text_event("u1")
+        _claim_webhook_event(event)
+        _complete_webhook_event(event)
+
+        assert _claim_webhook_event(event) is False
+        mock_db.collection.return_value.document.return_value.create.assert_called_once()
+        assert mock_db.collection.return_value.document.return_value.update.call_args[0][0]["status"] == "done"
+
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    @patch("webhook.main.db")
+    def test_duplicate_from_other_instance_is_skipped(self, mock_db):
+        self._existing_claim(mock_db, status="done")
+
+        assert _claim_webhook_event(_make_text_event("u1")) is False
+
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    @patch("webhook.main.db")
+    def test_stale_processing_claim_is_taken_over(self, mock_db):
+        self._existing_claim(mock_db, status="processing", claimed_at=datetime.now(UTC) - timedelta(minutes=5))
+
+        assert _claim_webhook_event(_make_text_event("u1")) is True
+        claim = mock_db.transaction.return_value.set.call_args[0][1]
+        assert claim["status"] == "processing"
+
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    @patch("webhook.main.handler")
+    @patch("webhook.main.db")
+    def test_event_in_progress_elsewhere_is_failed_not_skipped(self, mock_db, mock_handler):
+        event_ref = self._existing_claim(mock_db, status="processing", claimed_at=datetime.now(UTC))
+        func = MagicMock()
+        mock_handler.parser.parse.return_value = MagicMock(events=[_make_text_event("u1")])
+        _route_mock_events(func)
+
+        stats = dispatch_events("{}", "sig")
+
+        assert stats["failed"] == 1
+        func.assert_not_called()
+        event_ref.delete.assert_not_called()
+
+    @patch("webhook.main.db")
+    def test_firestore_error_fails_open(self, mock_db):
+        mock_db.collection.return_value.document.return_value.create.side_effect = Exception("unavailable")
+
+        assert _claim_webhook_event(_make_text_event("u1")) is True
+
+    @patch("webhook.main.handler")
+    @patch("webhook.main.db")
+    def test_failed_event_is_released_for_redelivery(self, mock_db, mock_handler):
+        event = _make_text_event("u1")
+        mock_handler.parser.parse.return_value = MagicMock(events=[event])
+        _route_mock_events(MagicMock(side_effect=RuntimeError("boom")))
+
+        dispatch_events("{}", "sig")
+
+        mock_db.collection.return_value.document.return_value.delete.assert_called_once()
+        assert _claim_webhook_event(event) is True
+
+
+class TestStreamMessageContent:
+    """Tests for streaming LINE content into Cloud Storage."""
+
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.messaging_api_blob")
+    def test_streams_chunks_and_hashes(self, mock_blob_api, mock_storage):
+        raw = _mock_line_content(mock_blob_api, b"fake_image_data")
+        writer = mock_storage.bucket.return_value.blob.return_value.open.return_value
+
+        info = stream_message_content_to_storage("msg_1", "evt/original/u/1.jpg")
+
+        assert info == {
+            "size_bytes": 15,
+            "sha256": hashlib.sha256(b"fake_image_data").hexdigest(),
+            "content": b"fake_image_data",
+            "committed": True,
+            "original": {"format": None, "width": None, "height": None, "size_bytes": 15},
+        }
+        assert b"".join(c.args[0] for c in writer.write.call_args_list) == b"fake_image_data"
+        writer.close.assert_called_once()
+        raw.release_conn.assert_called_once()
+
+    @patch("webhook.main.INLINE_IMAGE_MAX_BYTES", 8)
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.messaging_api_blob")
+    def test_large_image_is_not_kept_for_inline_handoff(self, mock_blob_api, mock_storage):
+        _mock_line_content(mock_blob_api, b"0123456789abc", content_length=0)
+
+        info = stream_message_content_to_storage("msg_1", "path.jpg")
+
+        assert info["size_bytes"] == 13
+        assert info["content"] is None
+
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.messaging_api_blob")
+    def test_rejects_large_content_length_before_reading(self, mock_blob_api, mock_storage):
+        raw = _mock_line_content(mock_blob_api, b"x", content_length=10**9)
+
+        with pytest.raises(ImageTooLargeError):
+            stream_message_content_to_storage("msg_1", "path.jpg")
+
+        raw.stream.assert_not_called()
+        mock_storage.bucket.assert_not_called()
+
+    @patch("webhook.main.MAX_IMAGE_BYTES", 8)
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.messaging_api_blob")
+    def test_aborts_without_finalizing_when_stream_exceeds_limit(self, mock_blob_api, mock_storage):
+        raw = _mock_line_content(mock_blob_api, b"0123456789abc", content_length=0)
+        writer = mock_storage.bucket.return_value.blob.return_value.open.return_value
+
+        with pytest.raises(ImageTooLargeError):
+            stream_message_content_to_storage("msg_1", "path.jpg")
+
+        writer.close.assert_not_called()
+        raw.release_conn.assert_called_once()
+
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.messaging_api_blob")
+    def test_upload_is_abandoned_when_commit_declined(self, mock_blob_api, mock_storage):
+        raw = _mock_line_content(mock_blob_api, b"img")
+        writer = mock_storage.bucket.return_value.blob.return_value.open.return_value
+        should_commit = MagicMock(return_value=False)
+
+        info = stream_message_content_to_storage("msg_1", "path.jpg", should_commit)
+
+        should_commit.assert_called_once_with(hashlib.sha256(b"img").hexdigest())
+        assert info["committed"] is False
+        writer.close.assert_not_called()
+        raw.release_conn.assert_called_once()
+
+    @patch("webhook.main.storage_client")
+    def test_streams_through_real_sdk_client(self, mock_storage):
+        """The SDK's ApiResponse preloads raw_data as bytes; the raw urllib3 response is streamed instead."""
+        blob_api = MessagingApiBlob(ApiClient(Configuration(access_token="token")))
+        body = urllib3.HTTPResponse(
+            body=io.BytesIO(b"fake_image_data"),
+            headers={"Content-Length": "15"},
+            status=200,
+            preload_content=False,
+        )
+        writer = mock_storage.bucket.return_value.blob.return_value.open.return_value
+
+        with (
+            patch.object(blob_api.api_client.rest_client.pool_manager, "request", return_value=body) as mock_request,
+            patch("webhook.main.messaging_api_blob", blob_api),
+        ):
+            info = stream_message_content_to_storage("msg_1", "path.jpg")
+
+        assert info["sha256"] == hashlib.sha256(b"fake_image_data").hexdigest()
+        assert b"".join(c.args[0] for c in writer.write.call_args_list) == b"fake_image_data"
+        method, url = mock_request.call_args.args
+        assert (method, url) == ("GET", "https://api-data.line.me/v2/bot/message/msg_1/content")
+        assert mock_request.call_args.kwargs["preload_content"] is False
+
+
+def _encode_image(size, fmt, mode="RGB", noisy=False):
+    """Encode a solid-color (or noisy, i.e. photo-like in size) test image."""
+    img = PILImage.effect_noise(size, 64).convert(mode) if noisy else PILImage.new(mode, size, "red")
+    output = io.BytesIO()
+    img.save(output, format=fmt)
+    return output.getvalue()
+
+
+class TestTranscodeImage:
+    """Tests for ingest-time transcoding of stored masters."""
+
+    def test_small_jpeg_is_kept_byte_for_byte(self):
+        data = _encode_image((100, 80), "JPEG")
+
+        stored, info = transcode_image(io.BytesIO(data))
+
+        assert stored.read() == data
+        assert info == {"format": "JPEG", "original_width": 100, "original_height": 80, "transcoded": False}
+
+    def test_png_with_alpha_is_converted_to_jpeg(self):
+        stored, info = transcode_image(io.BytesIO(_encode_image((64, 64), "PNG", mode="RGBA", noisy=True)))
+
+        assert info["format"] == "PNG"
+        assert info["transcoded"] is True
+        assert PILImage.open(stored).format == "JPEG"
+
+    def test_original_is_kept_when_conversion_is_not_smaller(self):
+        data = _encode_image((64, 64), "PNG")
+
+        stored, info = transcode_image(io.BytesIO(data))
+
+        assert stored.read() == data
+        assert info["transcoded"] is False
+
+    @patch("webhook.main.INGEST_MAX_LONG_EDGE", 100)
+    def test_oversized_image_is_downscaled_to_long_edge(self):
+        stored, info = transcode_image(io.BytesIO(_encode_image((400, 200), "JPEG")))
+
+        assert (info["original_width"], info["original_height"]) == (400, 200)
+        assert PILImage.open(stored).size == (100, 50)
+
+    @patch("webhook.main.INGEST_MAX_PIXELS", 1000)
+    def test_rejects_images_above_pixel_limit(self):
+        with pytest.raises(ImageTooLargeError):
+            transcode_image(io.BytesIO(_encode_image((100, 100), "PNG")))
+
+    @patch("webhook.main.INGEST_MAX_LONG_EDGE", 100)
+    @patch("webhook.main.INGEST_MAX_DECODE_PIXELS", 20_000)
+    def test_oversized_jpeg_decodes_at_reduced_scale_within_decode_limit(self):
+        stored, info = transcode_image(io.BytesIO(_encode_image((400, 400), "JPEG", noisy=True)))
+
+        assert info["transcoded"] is True
+        assert PILImage.open(stored).size == (100, 100)
+
+    @patch("webhook.main.INGEST_MAX_LONG_EDGE", 100)
+    @patch("webhook.main.INGEST_MAX_DECODE_PIXELS", 20_000)
+    def test_rejects_full_decodes_above_decode_limit(self):
+        with pytest.raises(ImageTooLargeError):
+            transcode_image(io.BytesIO(_encode_image((400, 400), "PNG")))
+
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.messaging_api_blob")
+    def test_stream_records_original_and_stores_jpeg(self, mock_blob_api, mock_storage):
+        _mock_line_content(mock_blob_api, _encode_image((32, 16), "PNG", noisy=True))
+        writer = mock_storage.bucket.return_value.blob.return_value.open.return_value
+
+        info = stream_message_content_to_storage("msg_1", "path.jpg")
+
+        assert info["original"]["format"] == "PNG"
+        assert (info["original"]["width"], info["original"]["height"]) == (32, 16)
+        assert 0 < info["size_bytes"] < info["original"]["size_bytes"]
+        assert PILImage.open(io.BytesIO(info["content"])).format == "JPEG"
+        assert b"".join(c.args[0] for c in writer.write.call_args_list) == info["content"]
+
+    @patch("webhook.main.transcode_image")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.messaging_api_blob")
+    def test_duplicate_is_detected_before_transcoding(self, mock_blob_api, mock_storage, mock_transcode):
+        _mock_line_content(mock_blob_api, _encode_image((32, 16), "PNG", noisy=True))
+
+        info = stream_message_content_to_storage("msg_1", "path.jpg", MagicMock(return_value=False))
+
+        mock_transcode.assert_not_called()
+        assert info["committed"] is False
+
+
+class TestDuplicateImages:
+    """Tests for the per-event exact-duplicate short-circuit."""
+
+    def _existing_image(self, mock_db, refs, data):
+        existing_doc = MagicMock()
+        existing_doc.exists = True
+        existing_doc.to_dict.return_value = data
+        digests_ref = MagicMock()
+        digests_ref.document.return_value.create.side_effect = Conflict("exists")
+        digests_ref.document.return_value.get.return_value.to_dict.return_value = {"image_id": "img_old"}
+        images_ref = MagicMock()
+        images_ref.document.return_value.get.return_value = existing_doc
+        refs.update({"image_digests": digests_ref, "images": images_ref})
+        return digests_ref
+
+    @patch("webhook.main.trigger_scoring_function")
+    @patch("webhook.main.messaging_api_blob")
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_duplicate_replies_with_existing_score(
+        self, mock_db, mock_storage, mock_messaging_api, mock_blob, mock_trigger
+    ):
+        refs = _setup_active_event_db(mock_db)
+        self._existing_image(mock_db, refs, {"status": "completed", "total_score": 88.5})
+        _mock_line_content(mock_blob, b"img")
+        writer = mock_storage.bucket.return_value.blob.return_value.open.return_value
+
+        handle_image_message(_make_image_event())
+
+        push_text = mock_messaging_api.push_message.call_args[0][0].messages[0].text
+        assert "88.5点" in push_text
+        writer.close.assert_not_called()
+        mock_db.batch.return_value.commit.assert_not_called()
+        mock_trigger.assert_not_called()
+
+    @patch("webhook.main.SCORING_FUNCTION_URL", "https://scoring")
+    @patch("webhook.main.trigger_scoring_function")
+    @patch("webhook.main.messaging_api_blob")
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_deleted_original_is_taken_over(self, mock_db, mock_storage, mock_messaging_api, mock_blob, mock_trigger):
+        refs = _setup_active_event_db(mock_db)
+        digests_ref = self._existing_image(mock_db, refs, {"deleted_at": "2026-01-01"})
+        _mock_line_content(mock_blob, b"img")
+
+        handle_image_message(_make_image_event())
+
+        digest_writes = [
+            c
+            for c in mock_db.transaction.return_value.set.call_args_list
+            if c[0][0] is digests_ref.document.return_value
+        ]
+        assert len(digest_writes) == 1
+        mock_db.batch.return_value.commit.assert_called_once()
+        mock_trigger.assert_called_once()
+
+    def _in_flight_entry(self, created_at):
+        digest_ref = MagicMock()
+        digest_ref.get.return_value.to_dict.return_value = {"image_id": "img_other", "created_at": created_at}
+        missing_image = MagicMock()
+        missing_image.exists = False
+        images_ref = MagicMock()
+        images_ref.document.return_value.get.return_value = missing_image
+        return digest_ref, images_ref
+
+    @patch("webhook.main.db")
+    def test_concurrent_upload_of_same_content_is_a_duplicate(self, mock_db):
+        """A second upload that sees the entry before the first image doc exists must not take it over."""
+        digest_ref, images_ref = self._in_flight_entry(datetime.now(UTC))
+        digest_ref.create.side_effect = Conflict("exists")
+        mock_db.collection.side_effect = lambda name: (
+            images_ref if name == "images" else MagicMock(document=MagicMock(return_value=digest_ref))
+        )
+
+        existing = _claim_image_digest("event_001", "abc", "img_1", "user_123")
+
+        assert existing == {"image_id": "img_other", "status": "pending"}
+        mock_db.transaction.return_value.set.assert_not_called()
+        digest_ref.set.assert_not_called()
+
+    @patch("webhook.main.db")
+    def test_abandoned_entry_is_taken_over_after_timeout(self, mock_db):
+        digest_ref, images_ref = self._in_flight_entry(datetime.now(UTC) - timedelta(minutes=10))
+        digest_ref.create.side_effect = Conflict("exists")
+        mock_db.collection.side_effect = lambda name: (
+            images_ref if name == "images" else MagicMock(document=MagicMock(return_value=digest_ref))
+        )
+
+        assert _claim_image_digest("event_001", "abc", "img_1", "user_123") is None
+        mock_db.transaction.return_value.set.assert_called_once()
+        assert mock_db.transaction.return_value.set.call_args[0][1]["image_id"] == "img_1"
+
+    @patch("webhook.main._count_image_set_item")
+    @patch("webhook.main.messaging_api_blob")
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_duplicate_in_image_set_is_counted(self, mock_db, mock_storage, mock_messaging_api, mock_blob, mock_count):
+        refs = _setup_active_event_db(mock_db, set_exists=True)
+        self._existing_image(mock_db, refs, {"status": "processing"})
+        _mock_line_content(mock_blob, b"img")
+        image_set = MagicMock(id="set_1", index=2, total=3)
+
+        handle_image_message(_make_image_event(image_set=image_set))
+
+        mock_count.assert_called_once_with("set_1", "user_123", "duplicates")
+        mock_messaging_api.push_message.assert_not_called()
+
+    @patch("webhook.main.db")
+    def test_release_only_deletes_matching_entry(self, mock_db):
+        digest_ref = mock_db.collection.return_value.document.return_value
+        digest_ref.get.return_value.exists = True
+        digest_ref.get.return_value.to_dict.return_value = {"image_id": "img_other"}
+
+        _release_image_digest("event_001", "abc", "img_1")
+        digest_ref.delete.assert_not_called()
+
+        digest_ref.get.return_value.to_dict.return_value = {"image_id": "img_1"}
+        _release_image_digest("event_001", "abc", "img_1")
+        digest_ref.delete.assert_called_once()
+
+
+class TestUploadRateLimit:
+    """Tests for per-user upload rate limiting."""
+
+    def test_sliding_window_limits(self):
+        now = 1000.0
+        assert _rate_limit_retry_after([now - 30, now - 20], now, burst=2, sustained=3) is None
+        assert _rate_limit_retry_after([now - 5, now - 2], now, burst=2, sustained=10) == 5
+        assert _rate_limit_retry_after([now - 50, now - 40, now - 30], now, burst=2, sustained=3) == 10
+
+    @patch("webhook.main.firestore.transactional", lambda f: f)
+    def test_transaction_prunes_and_records_upload(self):
+        mock_transaction = MagicMock()
+        mock_rate_ref = MagicMock()
+        mock_rate_ref.get.return_value.exists = True
+        mock_rate_ref.get.return_value.to_dict.return_value = {"times": [100.0, 990.0]}
+
+        retry_after, times = _acquire_upload_slot_transaction(mock_transaction, mock_rate_ref, 1000.0, 5, 10)
+
+        assert retry_after is None
+        assert times == [990.0, 1000.0]
+        assert mock_transaction.set.call_args[0][1]["times"] == [990.0, 1000.0]
+
+    @patch("webhook.main.UPLOAD_RATE_LIMITS", {"active": (2, 10), "draft": (1, 1)})
+    @patch("webhook.main._acquire_upload_slot_transaction")
+    @patch("webhook.main.db")
+    def test_local_window_sheds_without_firestore(self, mock_db, mock_txn):
+        mock_txn.side_effect = lambda _t, _ref, now, _b, _s: (None, [now - 1, now])
+
+        assert _acquire_upload_slot("user_1", "event_001", "active") is None
+        assert _acquire_upload_slot("user_1", "event_001", "active") > 0
+        mock_txn.assert_called_once()
+
+    @patch("webhook.main.UPLOAD_TIMES_MAX_ENTRIES", 2)
+    @patch("webhook.main._acquire_upload_slot_transaction")
+    @patch("webhook.main.db")
+    def test_local_windows_are_bounded(self, mock_db, mock_txn):
+        mock_txn.side_effect = lambda _t, _ref, now, _b, _s: (None, [now])
+
+        for user_id in ("user_1", "user_2", "user_3"):
+            _acquire_upload_slot(user_id, "event_001", "active")
+
+        assert list(webhook_main._upload_times) == ["event_001_user_2", "event_001_user_3"]
+
+    @patch("webhook.main._acquire_upload_slot_transaction", side_effect=Exception("unavailable"))
+    @patch("webhook.main.db")
+    def test_firestore_failure_fails_open(self, mock_db, mock_txn):
+        assert _acquire_upload_slot("user_1", "event_001", "active") is None
+
+    @patch("webhook.main._acquire_upload_slot", return_value=12.3)
+    @patch("webhook.main.messaging_api_blob")
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_limited_upload_gets_slow_down_reply(self, mock_db, mock_storage, mock_messaging_api, mock_blob, _):
+        _setup_active_event_db(mock_db)
+
+        handle_image_message(_make_image_event())
+
+        assert "約12秒後" in _get_reply_text(mock_messaging_api)
+        mock_blob.api_client.request.assert_not_called()
+        mock_storage.bucket.assert_not_called()
+
+    @patch("webhook.main._count_image_set_item")
+    @patch("webhook.main._acquire_upload_slot", return_value=12.3)
+    @patch("webhook.main.messaging_api_blob")
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_limited_set_item_is_counted_as_rate_limited(
+        self, mock_db, mock_storage, mock_messaging_api, mock_blob, _, mock_count
+    ):
+        _setup_active_event_db(mock_db, set_exists=True)
+        image_set = MagicMock(id="set_1", index=2, total=3)
+
+        handle_image_message(_make_image_event(image_set=image_set))
+
+        mock_count.assert_called_once_with("set_1", "user_123", "rate_limited")
+
+
+class TestBacklogGauge:
+    """Tests for the scoring backlog gauge and backlog-aware replies."""
+
+    def _gauge_doc(self, mock_db, pending, completed_last_minute):
+        bucket = datetime.now(UTC).strftime("%Y%m%d%H%M")
+        snapshot = mock_db.collection.return_value.document.return_value.get.return_value
+        snapshot.exists = True
+        snapshot.to_dict.return_value = {
+            "pending": pending,
+            "completed_minutes": {bucket: completed_last_minute, "200001010000": 999},
+        }
+
+    @patch("webhook.main.db")
+    def test_estimates_wait_from_throughput(self, mock_db):
+        self._gauge_doc(mock_db, pending=30, completed_last_minute=10)
+
+        gauge = get_backlog_gauge("event_001")
+
+        assert gauge["throughput_per_minute"] == 2
+        assert gauge["estimated_wait_seconds"] == 900
+
+    @patch("webhook.main.db")
+    def test_gauge_is_cached_per_instance(self, mock_db):
+        self._gauge_doc(mock_db, pending=1, completed_last_minute=1)
+
+        get_backlog_gauge("event_001")
+        get_backlog_gauge("event_001")
+
+        assert mock_db.collection.return_value.document.return_value.get.call_count == 1
+
+    @patch("webhook.main.get_backlog_gauge")
+    def test_loading_message_mentions_wait_when_behind(self, mock_gauge):
+        mock_gauge.return_value = {"pending": 40, "throughput_per_minute": 4, "estimated_wait_seconds": 600}
+
+        text = _build_loading_message("event_001", None).text
+
+        assert "40枚が順番待ち" in text
+        assert "約10分" in text
+
+    @patch("webhook.main.get_backlog_gauge", side_effect=Exception("unavailable"))
+    def test_loading_message_falls_back_without_gauge(self, mock_gauge):
+        assert "しばらくお待ちください" in _build_loading_message("event_001", None).text
+
+    @patch("webhook.main.db")
+    def test_admin_endpoint_lists_pending_events(self, mock_db):
+        doc = MagicMock(id="event_001")
+        doc.to_dict.return_value = {"pending": 3}
+        mock_db.collection.return_value.where.return_value.stream.return_value = [doc]
+
+        with Flask(__name__).test_request_context("/", method="GET"):
+            from flask import request
+
+            response, status = backlog_status(request)
+
+        assert status == 200
+        assert response.get_json()["events"][0]["pending"] == 3
+
+
+class TestScoringIdToken:
+    """Tests for the cached scoring function ID token."""
+
+    def setup_method(self):
+        webhook_main._scoring_id_token = None
+
+    @patch.dict("os.environ", {"K_SERVICE": "webhook"})
+    @patch("webhook.main.id_token.fetch_id_token", return_value="token_1")
+    def test_token_is_reused(self, mock_fetch):
+        assert _get_scoring_id_token() == "token_1"
+        assert _get_scoring_id_token() == "token_1"
+        mock_fetch.assert_called_once()
+
+    @patch.dict("os.environ", {"K_SERVICE": "webhook"})
+    @patch("webhook.main.id_token.fetch_id_token", side_effect=["token_1", "token_2"])
+    def test_force_refresh_fetches_new_token(self, mock_fetch):
+        _get_scoring_id_token()
+
+        assert _get_scoring_id_token(force_refresh=True) == "token_2"
+
+
+class TestIngestSteps:
+    """Tests for the concurrent ingest path in handle_image_message."""
+
+    @patch("webhook.main.STORE_SIGNED_URLS", True)
+    @patch("webhook.main.SCORING_FUNCTION_URL", "https://scoring")
+    @patch("webhook.main.trigger_scoring_function")
+    @patch("webhook.main._get_scoring_id_token")
+    @patch("webhook.main.generate_signed_url", side_effect=Exception("iam unavailable"))
+    @patch("webhook.main.messaging_api_blob")
+    @patch("webhook.main.messaging_api")
+    @patch("webhook.main.storage_client")
+    @patch("webhook.main.db")
+    def test_signing_failure_still_writes_document_and_triggers(
+        self, mock_db, mock_storage, mock_messaging_api, mock_blob, mock_sign, mock_token, mock_trigger
+    ):
+        _setup_active_event_db(mock_db)
+        _mock_line_content(mock_blob, b"img")
+
+        handle_image_message(_make_image_event())
+
+        image_doc = mock_db.batch.return_value.set.call_args_list[0][0][1]
+        assert "storage_url" not in image_doc
+        assert image_doc["sha256"] == hashlib.sha256(b"img").hexdigest()
+        mock_db.batch.return_value.commit.assert_called_once()
+        mock_trigger.assert_called_once()
+        mock_token.assert_called_once()
+
+
+class TestTriggerScoringFunction:
+    """Tests for the scoring trigger payload."""
+
+    @patch("webhook.main.SCORING_FUNCTION_URL", "https://scoring")
+    @patch("webhook.main._get_scoring_id_token", return_value="token")
+    @patch("webhook.main.requests.post")
+    def test_inline_image_is_sent_with_checksum(self, mock_post, mock_token):
+        trigger_scoring_function("img_1", "user_1", image_bytes=b"img")
+
+        payload = mock_post.call_args.kwargs["json"]
+        assert base64.b64decode(payload["image_base64"]) == b"img"
+        assert payload["image_sha256"] == hashlib.sha256(b"img").hexdigest()
+
+    @patch("webhook.main.SCORING_FUNCTION_URL", "https://scoring")
+    @patch("webhook.main._get_scoring_id_token", return_value="token")
+    @patch("webhook.main.requests.post")
+    def test_without_image_bytes_scoring_reads_storage(self, mock_post, mock_token):
+        trigger_scoring_function("img_1", "user_1")
+
+        assert mock_post.call_args.kwargs["json"] == {"image_id": "img_1", "user_id": "user_1"}
+
+    @patch("webhook.main.SCORING_FUNCTION_URL", "https://scoring")
+    @patch("webhook.main._get_scoring_id_token", return_value="token")
+    @patch("webhook.main.requests.post")
+    def test_result_delivery_mode_is_forwarded(self, mock_post, mock_token):
+        trigger_scoring_function("img_1", "user_1", result_delivery="two_phase")
+
+        assert mock_post.call_args.kwargs["json"]["result_delivery"] == "two_phase"